@@ -0,0 +1,26 @@
+import os
+
+from passlib.context import CryptContext
+
+# Хэши паролей - bcrypt; deprecated="auto" позволяет сменить схему без миграции хранилища
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=int(os.getenv('PASSWORD_HASH_ROUNDS', '12')),
+)
+
+
+def hash_password(password: str) -> str:
+    """
+    Хэш пароля для хранения
+    Вычисление занимает сотни миллисекунд: из обработчиков вызывать через asyncio.to_thread
+    """
+    return pwd_context.hash(password)
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    """Проверяет пароль по хэшу; нераспознанный хэш не совпадает ни с одним паролем"""
+    try:
+        return pwd_context.verify(password, password_hash)
+    except ValueError:
+        return False
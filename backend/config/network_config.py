@@ -60,10 +60,11 @@ class NetworkConfig:
         
         local_inference_port = os.getenv('LOCAL_INFERENCE_PORT', '8001')
         
-        # Пытаемся подключиться к локальному inference серверу
+        # Пытаемся подключиться к локальному inference серверу: /readyz отвечает 200, только когда
+        # модель загружена и сервер принимает генерации (из кэшированного снимка, без проверок на запрос)
         try:
             import requests
-            response = requests.get(f"http://{local_inference_ip}:{local_inference_port}/health", timeout=2)
+            response = requests.get(f"http://{local_inference_ip}:{local_inference_port}/readyz", timeout=2)
             if response.status_code == 200:
                 return 'direct'  # Прямое подключение к локальному ПК
         except:
@@ -1,9 +1,9 @@
 import os
+import time
 import asyncio
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
-from uuid import uuid4
+from typing import Dict, Any, List, Optional
 
 
 from dotenv import load_dotenv
@@ -12,14 +12,28 @@ from dotenv import load_dotenv
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
 
 import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, BackgroundTasks, Query, Request, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from backend.services.connection_manager import manager, ConnectionMode
+from backend.services.chat_store import chat_store, MessageRecord, MessageRole
+from backend.services.search_index import search_index
+from backend.services.change_log import change_log
+from backend.services.chat_journal import chat_journal, DurableAckMiddleware
+from backend.services.session_archive import session_archive
+from backend.services.content_codec import content_codec
+from backend.services.chat_transfer import ChatImporter, export_history
+from backend.services.idempotency import idempotency_store, IdempotencyConflict
+from backend.services.rate_limiter import rate_limiter, RateLimitExceeded, client_ip, estimate_tokens
+from backend.services.metrics import metrics, MetricsMiddleware
+from backend.services.tracing import tracer, TracingMiddleware
+from backend.services.loop_monitor import loop_monitor
 from backend.config.network_config import NetworkConfig
 from backend.auth.jwt_manager import JWTManager
+from backend.auth.passwords import hash_password, verify_password
 from backend.auth.offline_verifier import OfflineTokenVerifier
 
 
@@ -43,7 +57,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Total-Count", "X-Before-Cursor", "X-After-Cursor", "Retry-After", "Server-Timing"],
 )
+# При CHAT_JOURNAL_FSYNC=always ответ ждет fsync журнала; задержка видна в метриках и трассах
+app.add_middleware(DurableAckMiddleware, journal=chat_journal)
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+app.add_middleware(TracingMiddleware, tracer=tracer)
 
 # Security
 security = HTTPBearer()
@@ -55,6 +74,35 @@ token_verifier = OfflineTokenVerifier()
 # Network configuration
 network_config = NetworkConfig()
 
+# Поисковый индекс и журнал изменений обновляются при каждой мутации хранилища
+chat_store.subscribe(search_index.on_store_change)
+chat_store.subscribe(change_log.on_store_change)
+
+# Архив подключается всегда: снимок журнала может ссылаться на уже выгруженные сессии
+chat_store.attach_archive(session_archive)
+
+# Статистика сервисов в /metrics: кэш сессий (архив), идемпотентные повторы, лимиты, сжатие
+metrics.register_stats({
+    "gateway_chat_store": (chat_store.get_archive_stats, {
+        "resident_sessions": "gauge", "archived_sessions": "gauge", "resident_bytes": "gauge",
+        "reloads": "counter", "archived_total": "counter",
+    }),
+    "gateway_idempotency": (idempotency_store.get_stats, {
+        "keys": "gauge", "in_flight": "gauge", "executed": "counter", "replayed": "counter",
+        "attached": "counter", "conflicts": "counter",
+    }),
+    "gateway_rate_limit": (rate_limiter.get_stats, {
+        "allowed": "counter", "limited": "counter", "local_buckets": "gauge",
+    }),
+    "gateway_content_compression": (content_codec.get_stats, {
+        "packed_messages": "counter", "raw_bytes": "counter", "packed_bytes": "counter", "unpacked": "counter",
+    }),
+    "gateway_inference": (lambda: manager.stats, {"expired": "counter"}),
+    "gateway_event_loop": (loop_monitor.get_stats, {
+        "max_lag_seconds": "gauge", "stalls": "counter", "failed_handlers": "counter",
+    }),
+})
+
 
 # Pydantic Models
 class LoginRequest(BaseModel):
@@ -78,44 +126,95 @@ class UpdateSessionRequest(BaseModel):
 class SendMessageRequest(BaseModel):
     session_id: str
     message: str
+    # Продолжить с указанного сообщения (новая ветка); по умолчанию - конец активной ветки
+    parent_id: Optional[str] = None
 
 
 class RegenerateRequest(BaseModel):
     session_id: str
     message_id: str
+    # Число вариантов ответа; все сохраняются соседними ветками
+    n: int = 1
 
 
 class UpdateMessageRequest(BaseModel):
     content: str
 
 
-# Simple in-memory storage for demonstration
-users_db = {}
-sessions_db = {}
-messages_db = {}
+class BranchRequest(BaseModel):
+    message_id: str
+
+
+class BatchOperation(BaseModel):
+    op: str
+    session_id: Optional[str] = None
+    message_id: Optional[str] = None
+    title: Optional[str] = None
+    content: Optional[str] = None
+    limit: Optional[int] = Field(None, ge=1)
+    before: Optional[int] = Field(None, ge=1)
+    after: Optional[int] = Field(None, ge=0)
+    preview: Optional[int] = Field(None, ge=1)
+
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+
+# Журнал мутаций хранилища на диске
+CHAT_JOURNAL_ENABLED = os.getenv('CHAT_JOURNAL_ENABLED', 'true').lower() == 'true'
+
+# Фоновая выгрузка холодных сессий в архив и размер порции за один проход цикла событий
+CHAT_ARCHIVE_ENABLED = os.getenv('CHAT_ARCHIVE_ENABLED', 'true').lower() == 'true'
+ARCHIVE_BATCH_SIZE = 20
+archive_task: Optional[asyncio.Task] = None
+# Будит фоновую выгрузку, когда память сообщений превышает бюджет
+archive_wakeup = asyncio.Event()
+# Фоновая компактификация поискового индекса и событие, которое ее будит
+search_task: Optional[asyncio.Task] = None
+search_compaction_wakeup = asyncio.Event()
+
+# Размер окна сообщений по умолчанию и максимальный размер страницы
+DEFAULT_MESSAGES_LIMIT = int(os.getenv('MESSAGES_PAGE_SIZE', '50'))
+MAX_MESSAGES_LIMIT = 500
+MAX_PREVIEW_CHARS = 2000
+
+# Максимальное число вариантов ответа в одном запросе перегенерации
+MAX_REGENERATE_CANDIDATES = int(os.getenv('MAX_REGENERATE_CANDIDATES', '4'))
+
+# Максимальное число операций в одном запросе /api/batch
+MAX_BATCH_OPERATIONS = 100
+
+# Импорт истории: строк в одном пакете и максимальная длина строки
+IMPORT_BATCH_SIZE = 1000
+MAX_IMPORT_LINE_BYTES = 16 * 1024 * 1024
 
 
 def get_user_by_username(username: str):
     """Simple user lookup for demo purposes"""
-    return users_db.get(username)
+    return chat_store.get_user_by_username(username)
 
 
-def create_user(username: str, password: str):
+async def create_user(username: str, password: str):
     """Simple user creation for demo purposes"""
-    user_id = str(uuid4())
-    users_db[username] = {
-        "id": user_id,
-        "username": username,
-        "password": password,  # In real app, hash the password
-        "created_at": datetime.now().isoformat()
-    }
-    return users_db[username]
+    # Хэширование занимает десятки миллисекунд - вне цикла событий
+    password_hash = await asyncio.to_thread(hash_password, password)
+    # Пока считался хэш, имя могли занять параллельной регистрацией
+    if get_user_by_username(username):
+        return None
+    return chat_store.create_user(username, password_hash)
+
+
+def public_user(user: Dict[str, Any]) -> Dict[str, Any]:
+    """Пользователь для ответа клиенту - без хэша пароля"""
+    return {key: value for key, value in user.items() if key != "password_hash"}
 
 
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
     """Проверяет JWT токен"""
     try:
-        payload = token_verifier.verify_token(credentials.credentials)
+        with tracer.span("auth"):
+            payload = token_verifier.verify_token(credentials.credentials)
         if payload is None:
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
         return payload
@@ -127,11 +226,12 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security))
 @app.get("/")
 async def root():
     """Корневой эндпоинт"""
+    # Определение сетевого режима опрашивает сеть с таймаутами: вне цикла событий
     return {
         "message": "Hybrid Chatbot API Gateway is running",
         "timestamp": datetime.now().isoformat(),
-        "connection_mode": network_config.get_connection_mode(),
-        "inference_endpoint": network_config.get_inference_endpoint()
+        "connection_mode": await asyncio.to_thread(network_config.get_connection_mode),
+        "inference_endpoint": await asyncio.to_thread(network_config.get_inference_endpoint)
     }
 
 
@@ -141,27 +241,40 @@ async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "connection_mode": network_config.get_connection_mode(),
+        "connection_mode": await asyncio.to_thread(network_config.get_connection_mode),
         "active_connections": len(manager.active_connections),
+        "expired_inference_requests": manager.stats["expired"],
         "network_config": {
-            "local_ip": network_config.detect_local_ip(),
-            "inference_endpoint": network_config.get_inference_endpoint()
-        }
+            "local_ip": await asyncio.to_thread(network_config.detect_local_ip),
+            "inference_endpoint": await asyncio.to_thread(network_config.get_inference_endpoint)
+        },
+        "event_loop": loop_monitor.get_stats(),
+        "chat_store": chat_store.get_archive_stats(),
+        "content_compression": content_codec.get_stats(),
+        "idempotency": idempotency_store.get_stats(),
+        "rate_limit": rate_limiter.get_stats()
     }
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в формате Prometheus"""
+    data, content_type = metrics.render()
+    return Response(content=data, media_type=content_type)
+
+
 @app.post("/auth/login")
 async def login(request: LoginRequest):
     """Аутентификация пользователя"""
     user = get_user_by_username(request.username)
     
-    if user and user["password"] == request.password:  # In real app, verify hashed password
+    if user and await asyncio.to_thread(verify_password, request.password, user["password_hash"]):
         token = jwt_manager.create_token({
             "user_id": user["id"],
             "username": user["username"], 
             "exp": datetime.utcnow() + timedelta(hours=24)
         })
-        return {"access_token": token, "token_type": "bearer", "user": user}
+        return {"access_token": token, "token_type": "bearer", "user": public_user(user)}
     else:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
@@ -172,14 +285,16 @@ async def register(request: RegisterRequest):
     if get_user_by_username(request.username):
         raise HTTPException(status_code=400, detail="Username already exists")
     
-    user = create_user(request.username, request.password)
+    user = await create_user(request.username, request.password)
+    if user is None:
+        raise HTTPException(status_code=400, detail="Username already exists")
     token = jwt_manager.create_token({
         "user_id": user["id"],
         "username": user["username"], 
         "exp": datetime.utcnow() + timedelta(hours=24)
     })
     
-    return {"access_token": token, "token_type": "bearer", "user": user}
+    return {"access_token": token, "token_type": "bearer", "user": public_user(user)}
 
 
 @app.get("/auth/verify")
@@ -189,9 +304,13 @@ async def verify_token_endpoint(payload: Dict[str, Any] = Depends(verify_token))
 
 
 @app.websocket("/ws/{client_id}")
-async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    """WebSocket endpoint для реального времени общения"""
-    await manager.connect(websocket, client_id)
+async def websocket_endpoint(websocket: WebSocket, client_id: str, token: Optional[str] = Query(None)):
+    """
+    WebSocket endpoint для реального времени общения
+    С токеном (?token=...) запросы клиента идут в очередь инференса от имени пользователя
+    """
+    payload = token_verifier.verify_token(token) if token else None
+    await manager.connect(websocket, client_id, payload.get("user_id") if payload else None, client_ip(websocket))
     
     try:
         while True:
@@ -202,45 +321,73 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
         logger.info(f"Client {client_id} disconnected")
 
 
+def make_etag(*parts: Any) -> str:
+    """Строгий ETag из версии ресурса и параметров запроса"""
+    return '"' + "-".join(str(part) for part in parts) + '"'
+
+
+def check_not_modified(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """
+    Выставляет ETag для ответа и возвращает 304, если клиент прислал совпадающий If-None-Match
+    Проверка выполняется до чтения и сериализации данных
+    """
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    
+    if if_none_match:
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in candidates or etag in candidates:
+            return Response(status_code=304, headers=headers)
+    
+    response.headers.update(headers)
+    return None
+
+
 # Chat Session Endpoints
 @app.get("/api/sessions")
-async def get_sessions(payload: Dict[str, Any] = Depends(verify_token)):
+async def get_sessions(request: Request, response: Response, payload: Dict[str, Any] = Depends(verify_token)):
     """Получить все сессии чата для текущего пользователя"""
-    username = payload.get("username")
-    user_sessions = []
+    user_id = payload.get("user_id")
     
-    for session_id, session in sessions_db.items():
-        if session.get("user_id") == payload.get("user_id"):
-            user_sessions.append(session)
+    not_modified = check_not_modified(request, response, make_etag("sessions", chat_store.sessions_version(user_id)))
+    if not_modified:
+        return not_modified
     
-    # Сортируем по дате обновления
-    user_sessions.sort(key=lambda x: x.get("updated_at", ""), reverse=True)
-    return user_sessions
+    return chat_store.list_sessions(user_id)
 
 
 @app.post("/api/sessions")
 async def create_session(request: CreateSessionRequest, payload: Dict[str, Any] = Depends(verify_token)):
     """Создать новую сессию чата"""
-    session_id = str(uuid4())
-    timestamp = datetime.now().isoformat()
-    
-    session = {
-        "id": session_id,
-        "user_id": payload.get("user_id"),
-        "title": request.title,
-        "created_at": timestamp,
-        "updated_at": timestamp
-    }
-    
-    sessions_db[session_id] = session
-    
-    return session
+    return chat_store.create_session(payload.get("user_id"), request.title)
 
 
-@app.get("/api/sessions/{session_id}")
-async def get_session(session_id: str, payload: Dict[str, Any] = Depends(verify_token)):
-    """Получить конкретную сессию"""
-    session = sessions_db.get(session_id)
+async def ensure_resident(session_id: str):
+    """Загружает архивную сессию в память; чтение и распаковка архива выполняются в потоке"""
+    if session_id not in chat_store.archived_sessions:
+        return
+    try:
+        archived = await asyncio.to_thread(chat_store.read_archived, session_id)
+        chat_store.install_archived(session_id, archived)
+    except (KeyError, FileNotFoundError):
+        # Сессию удалили, пока читался архив
+        if session_id in chat_store.archived_sessions:
+            raise
+
+
+async def resident_message(msg_id: Optional[int]) -> Optional[MessageRecord]:
+    """Сообщение по внутреннему id; его архивная сессия загружается без блокировки цикла событий"""
+    if msg_id is None:
+        return None
+    session_id = chat_store.archived_session(msg_id)
+    if session_id is not None:
+        await ensure_resident(session_id)
+    return chat_store.find_message(msg_id)
+
+
+async def get_owned_session(session_id: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Возвращает сессию, если она принадлежит текущему пользователю"""
+    session = chat_store.sessions.get(session_id)
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -248,245 +395,601 @@ async def get_session(session_id: str, payload: Dict[str, Any] = Depends(verify_
     if session.get("user_id") != payload.get("user_id"):
         raise HTTPException(status_code=403, detail="Access denied")
     
+    await ensure_resident(session_id)
+    session = chat_store.get_session(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
     return session
 
 
-@app.put("/api/sessions/{session_id}")
-async def update_session(session_id: str, request: UpdateSessionRequest, payload: Dict[str, Any] = Depends(verify_token)):
-    """Обновить сессию"""
-    session = sessions_db.get(session_id)
+async def get_owned_message(message_id: str, payload: Dict[str, Any]) -> MessageRecord:
+    """Возвращает сообщение, если оно принадлежит сессии текущего пользователя"""
+    msg_id = chat_store.parse_id(message_id)
+    session_id = chat_store.archived_session(msg_id) if msg_id is not None else None
+    if session_id is not None:
+        # Чужую архивную сессию не загружаем
+        session = chat_store.sessions.get(session_id)
+        if not session or session.get("user_id") != payload.get("user_id"):
+            raise HTTPException(status_code=403, detail="Access denied")
     
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+    message = await resident_message(msg_id)
     
-    if session.get("user_id") != payload.get("user_id"):
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    
+    session = chat_store.sessions.get(message.session_id)
+    if not session or session.get("user_id") != payload.get("user_id"):
         raise HTTPException(status_code=403, detail="Access denied")
     
-    session["title"] = request.title
-    session["updated_at"] = datetime.now().isoformat()
+    return message
+
+
+@app.get("/api/sessions/{session_id}")
+async def get_session(session_id: str, request: Request, response: Response, payload: Dict[str, Any] = Depends(verify_token)):
+    """Получить конкретную сессию"""
+    session = await get_owned_session(session_id, payload)
+    
+    not_modified = check_not_modified(request, response, make_etag("session", chat_store.session_version(session_id)))
+    if not_modified:
+        return not_modified
     
     return session
 
 
+@app.put("/api/sessions/{session_id}")
+async def update_session(session_id: str, request: UpdateSessionRequest, payload: Dict[str, Any] = Depends(verify_token)):
+    """Обновить сессию"""
+    await get_owned_session(session_id, payload)
+    return chat_store.update_session(session_id, request.title)
+
+
 @app.delete("/api/sessions/{session_id}")
 async def delete_session(session_id: str, payload: Dict[str, Any] = Depends(verify_token)):
     """Удалить сессию и связанные сообщения"""
-    session = sessions_db.get(session_id)
-    
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    if session.get("user_id") != payload.get("user_id"):
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    # Удаляем все сообщения этой сессии
-    messages_to_delete = []
-    for msg_id, msg in messages_db.items():
-        if msg.get("session_id") == session_id:
-            messages_to_delete.append(msg_id)
-    
-    for msg_id in messages_to_delete:
-        del messages_db[msg_id]
-    
-    # Удаляем саму сессию
-    del sessions_db[session_id]
+    await get_owned_session(session_id, payload)
+    chat_store.delete_session(session_id)
     
     return {"success": True}
 
 
 # Message Endpoints
 @app.get("/api/sessions/{session_id}/messages")
-async def get_messages(session_id: str, payload: Dict[str, Any] = Depends(verify_token)):
-    """Получить все сообщения для сессии"""
-    session = sessions_db.get(session_id)
-    
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    if session.get("user_id") != payload.get("user_id"):
-        raise HTTPException(status_code=403, detail="Access denied")
+async def get_messages(
+    session_id: str,
+    request: Request,
+    response: Response,
+    limit: int = Query(DEFAULT_MESSAGES_LIMIT, ge=1, le=MAX_MESSAGES_LIMIT),
+    before: Optional[int] = Query(None, ge=1),
+    after: Optional[int] = Query(None, ge=0),
+    preview: Optional[int] = Query(None, ge=1, le=MAX_PREVIEW_CHARS),
+    payload: Dict[str, Any] = Depends(verify_token)
+):
+    """
+    Получить страницу сообщений сессии
+    По умолчанию возвращает последние limit сообщений; курсоры before/after - значения seq.
+    Общее число сообщений и курсоры соседних страниц передаются в заголовках.
+    С preview содержимое обрезается до preview символов (флаг truncated)
+    """
+    await get_owned_session(session_id, payload)
+    
+    etag = make_etag("messages", chat_store.session_version(session_id), limit, before or "",
+                     after if after is not None else "", preview or "")
+    not_modified = check_not_modified(request, response, etag)
+    if not_modified:
+        return not_modified
+    
+    page, has_before, has_after = chat_store.get_messages(session_id, limit, before=before, after=after)
+    
+    response.headers["X-Total-Count"] = str(chat_store.count_messages(session_id))
+    if page and has_before:
+        response.headers["X-Before-Cursor"] = str(page[0].seq)
+    if page and has_after:
+        response.headers["X-After-Cursor"] = str(page[-1].seq)
+    
+    return [chat_store.serialize_message(message, preview) for message in page]
+
+
+# Максимальная длина заголовка Idempotency-Key
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+
+async def run_idempotent(
+    idempotency_key: Optional[str],
+    payload: Dict[str, Any],
+    response: Response,
+    parts: tuple,
+    handler
+):
+    """
+    Выполняет обработчик с учетом заголовка Idempotency-Key
+    Повтор запроса с тем же ключом не генерирует ответ заново: он дожидается
+    выполняющегося запроса или получает сохраненный результат (с заголовком Idempotent-Replayed)
+    """
+    if idempotency_key is None:
+        return await handler()
+    if not idempotency_key or len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key")
     
-    session_messages = []
-    for msg_id, message in messages_db.items():
-        if message.get("session_id") == session_id:
-            session_messages.append(message)
+    try:
+        result, replayed = await idempotency_store.run(
+            payload.get("user_id"), idempotency_key, idempotency_store.fingerprint(*parts), handler
+        )
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different request")
     
-    # Сортируем по времени создания
-    session_messages.sort(key=lambda x: x.get("created_at", ""))
-    return session_messages
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+async def enforce_rate_limit(http_request: Request, payload: Dict[str, Any], prompt: str, n: int = 1):
+    """Списывает генерацию из лимитов пользователя и IP; при превышении - 429 с Retry-After"""
+    try:
+        with tracer.span("rate_limit"):
+            await rate_limiter.acquire(
+                payload.get("user_id"), client_ip(http_request), estimate_tokens(prompt, rate_limiter.response_tokens * n)
+            )
+    except RateLimitExceeded as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, round(e.retry_after)))}
+        )
+
+
+def chat_deadline(x_request_budget_ms: Optional[float] = Header(None, ge=0)) -> float:
+    """
+    Дедлайн генерации по часам шлюза: INFERENCE_TIMEOUT или меньший бюджет клиента
+    X-Request-Budget-Ms - оставшееся у клиента время в миллисекундах
+    """
+    return manager.deadline_after(x_request_budget_ms / 1000 if x_request_budget_ms is not None else None)
+
+
+def check_deadline(deadline: float):
+    """Клиент уже не ждет ответа (например, бюджет ушел на ожидание лимита) - генерацию не начинаем"""
+    if time.time() >= deadline:
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
 
 
 @app.post("/api/chat/send")
-async def send_message(request: SendMessageRequest, payload: Dict[str, Any] = Depends(verify_token)):
+async def send_message(
+    request: SendMessageRequest,
+    http_request: Request,
+    response: Response,
+    payload: Dict[str, Any] = Depends(verify_token),
+    idempotency_key: Optional[str] = Header(None),
+    deadline: float = Depends(chat_deadline)
+):
     """Отправить сообщение и получить ответ от бота"""
-    session = sessions_db.get(request.session_id)
-    
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    if session.get("user_id") != payload.get("user_id"):
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    # Сохраняем сообщение пользователя
-    user_msg_id = str(uuid4())
-    timestamp = datetime.now().isoformat()
-    
-    user_message = {
-        "id": user_msg_id,
-        "session_id": request.session_id,
-        "role": "user",
-        "content": request.message,
-        "created_at": timestamp
-    }
-    
-    messages_db[user_msg_id] = user_message
-    
-    # Генерируем ответ от бота (в реальном приложении здесь вызов LLM)
-    bot_response = generate_bot_response(request.message)
-    
-    # Сохраняем ответ бота
-    bot_msg_id = str(uuid4())
-    
-    bot_message = {
-        "id": bot_msg_id,
-        "session_id": request.session_id,
-        "role": "assistant",
-        "content": bot_response,
-        "created_at": datetime.now().isoformat()
-    }
-    
-    messages_db[bot_msg_id] = bot_message
-    
-    # Обновляем время обновления сессии
-    session["updated_at"] = timestamp
+    await get_owned_session(request.session_id, payload)
+    
+    async def send():
+        await enforce_rate_limit(http_request, payload, request.message)
+        check_deadline(deadline)
+        
+        parent_id = None
+        if request.parent_id is not None:
+            parent = await get_owned_message(request.parent_id, payload)
+            if parent.session_id != request.session_id:
+                raise HTTPException(status_code=404, detail="Parent message not found")
+            parent_id = parent.id
+        
+        # Сохраняем сообщение пользователя
+        with tracer.span("storage"):
+            user_message = chat_store.add_message(request.session_id, MessageRole.USER, request.message, parent_id)
+        
+        # Генерируем ответ от бота (в реальном приложении здесь вызов LLM)
+        with tracer.span("generate"):
+            bot_response = generate_bot_response(request.message, deadline)
+        
+        with tracer.span("storage"):
+            # Сохраняем ответ бота
+            bot_message = chat_store.add_message(request.session_id, MessageRole.ASSISTANT, bot_response, user_message.id)
+            
+            # Обновляем время обновления сессии
+            chat_store.touch_session(request.session_id, user_message.created_at)
+        
+        # Сообщения с серверными id: клиент не получит их повторно при синхронизации
+        return {
+            "response": bot_response,
+            "user_message": chat_store.serialize_message(user_message),
+            "message": chat_store.serialize_message(bot_message)
+        }
     
-    return {"response": bot_response}
+    return await run_idempotent(
+        idempotency_key, payload, response,
+        ("send", request.session_id, request.message, request.parent_id), send
+    )
 
 
 @app.post("/api/chat/regenerate")
-async def regenerate_response(request: RegenerateRequest, payload: Dict[str, Any] = Depends(verify_token)):
-    """Перегенерировать последний ответ"""
-    session = sessions_db.get(request.session_id)
-    
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    if session.get("user_id") != payload.get("user_id"):
-        raise HTTPException(status_code=403, detail="Access denied")
+async def regenerate_response(
+    request: RegenerateRequest,
+    http_request: Request,
+    response: Response,
+    payload: Dict[str, Any] = Depends(verify_token),
+    idempotency_key: Optional[str] = Header(None),
+    deadline: float = Depends(chat_deadline)
+):
+    """
+    Перегенерировать ответ: новые ответы становятся альтернативами прежним, а не заменяют их
+    С n > 1 за один вызов генерируется n вариантов (промпт обрабатывается один раз);
+    активным становится последний из них
+    """
+    if not 1 <= request.n <= MAX_REGENERATE_CANDIDATES:
+        raise HTTPException(status_code=422, detail=f"n must be between 1 and {MAX_REGENERATE_CANDIDATES}")
+    
+    await get_owned_session(request.session_id, payload)
+    
+    async def regenerate():
+        # Находим сообщение пользователя, которое нужно перегенерировать
+        user_message = await resident_message(chat_store.parse_id(request.message_id))
+        
+        if not user_message or user_message.role != MessageRole.USER or user_message.session_id != request.session_id:
+            raise HTTPException(status_code=404, detail="User message not found")
+        
+        await enforce_rate_limit(http_request, payload, user_message.text, request.n)
+        check_deadline(deadline)
+        
+        # Генерируем новые ответы
+        with tracer.span("generate"):
+            candidates = generate_bot_responses(user_message.text, request.n, deadline)
+        
+        # Создаем сообщения бота соседними ветками после сообщения пользователя одной записью в журнал
+        with tracer.span("storage"), chat_journal.batch():
+            messages = [
+                chat_store.add_message(request.session_id, MessageRole.ASSISTANT, candidate, user_message.id)
+                for candidate in candidates
+            ]
+        
+        return {
+            "response": candidates[-1],
+            "message": chat_store.serialize_message(messages[-1]),
+            "candidates": [chat_store.serialize_message(message) for message in messages]
+        }
     
-    # Находим сообщение пользователя, которое нужно перегенерировать
-    user_message = messages_db.get(request.message_id)
-    
-    if not user_message or user_message.get("role") != "user":
-        raise HTTPException(status_code=404, detail="User message not found")
-    
-    # Удаляем старый ответ бота (находим последний ответ после этого сообщения)
-    session_messages = []
-    for msg_id, msg in messages_db.items():
-        if msg.get("session_id") == request.session_id:
-            session_messages.append(msg)
-    
-    # Сортируем по времени создания
-    session_messages.sort(key=lambda x: x.get("created_at", ""))
-    
-    # Находим позицию пользовательского сообщения и следующее за ним сообщение бота
-    user_msg_index = -1
-    for i, msg in enumerate(session_messages):
-        if msg["id"] == request.message_id:
-            user_msg_index = i
-            break
-    
-    if user_msg_index != -1 and user_msg_index + 1 < len(session_messages):
-        next_msg = session_messages[user_msg_index + 1]
-        if next_msg.get("role") == "assistant":
-            # Удаляем старый ответ бота
-            del messages_db[next_msg["id"]]
-    
-    # Генерируем новый ответ
-    new_response = generate_bot_response(user_message["content"])
-    
-    # Создаем новое сообщение бота
-    new_bot_msg_id = str(uuid4())
-    
-    new_bot_message = {
-        "id": new_bot_msg_id,
-        "session_id": request.session_id,
-        "role": "assistant",
-        "content": new_response,
-        "created_at": datetime.now().isoformat()
-    }
+    return await run_idempotent(
+        idempotency_key, payload, response,
+        ("regenerate", request.session_id, request.message_id, request.n), regenerate
+    )
+
+
+async def edit_owned_message(message_id: str, content: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Редактирует сообщение пользователя (ответы ассистента не редактируются)"""
+    message = await get_owned_message(message_id, payload)
     
-    messages_db[new_bot_msg_id] = new_bot_message
+    # Проверяем, что это сообщение пользователя (не ответ ассистента)
+    if message.role != MessageRole.USER:
+        raise HTTPException(status_code=400, detail="Only user messages can be edited")
     
-    return {"response": new_response}
+    return chat_store.serialize_message(chat_store.update_message(message, content))
 
 
 @app.put("/api/messages/{message_id}")
 async def update_message(message_id: str, request: UpdateMessageRequest, payload: Dict[str, Any] = Depends(verify_token)):
     """Обновить сообщение"""
-    message = messages_db.get(message_id)
+    return await edit_owned_message(message_id, request.content, payload)
+
+
+@app.post("/api/messages/{message_id}/fork")
+async def fork_message(
+    message_id: str,
+    request: UpdateMessageRequest,
+    http_request: Request,
+    payload: Dict[str, Any] = Depends(verify_token),
+    deadline: float = Depends(chat_deadline)
+):
+    """
+    Отредактировать сообщение пользователя новой веткой
+    Исправленное сообщение становится альтернативой исходному, история исходной ветки сохраняется
+    """
+    message = await get_owned_message(message_id, payload)
+    if message.role != MessageRole.USER:
+        raise HTTPException(status_code=400, detail="Only user messages can be edited")
     
-    if not message:
-        raise HTTPException(status_code=404, detail="Message not found")
+    await enforce_rate_limit(http_request, payload, request.content)
+    check_deadline(deadline)
     
-    # Проверяем, что сообщение принадлежит сессии пользователя
-    session = sessions_db.get(message.get("session_id"))
-    if not session or session.get("user_id") != payload.get("user_id"):
-        raise HTTPException(status_code=403, detail="Access denied")
+    with tracer.span("storage"):
+        user_message = chat_store.add_message(message.session_id, MessageRole.USER, request.content, message.parent_id)
+    with tracer.span("generate"):
+        bot_response = generate_bot_response(request.content, deadline)
+    with tracer.span("storage"):
+        chat_store.add_message(message.session_id, MessageRole.ASSISTANT, bot_response, user_message.id)
+        chat_store.touch_session(message.session_id, user_message.created_at)
     
-    # Проверяем, что это сообщение пользователя (не ответ ассистента)
-    if message.get("role") != "user":
-        raise HTTPException(status_code=400, detail="Only user messages can be edited")
+    return {"response": bot_response, "message": chat_store.serialize_message(user_message)}
+
+
+@app.get("/api/messages/{message_id}/siblings")
+async def get_message_siblings(
+    message_id: str,
+    preview: Optional[int] = Query(None, ge=1, le=MAX_PREVIEW_CHARS),
+    payload: Dict[str, Any] = Depends(verify_token)
+):
+    """Альтернативы сообщения (соседние ветки) в порядке создания, включая само сообщение"""
+    message = await get_owned_message(message_id, payload)
+    siblings = chat_store.get_siblings(message)
+    
+    return {
+        "message_id": message_id,
+        "index": siblings.index(message),
+        "siblings": [chat_store.serialize_message(sibling, preview) for sibling in siblings]
+    }
+
+
+@app.post("/api/sessions/{session_id}/branch")
+async def switch_branch(session_id: str, request: BranchRequest, payload: Dict[str, Any] = Depends(verify_token)):
+    """
+    Сделать активной ветку, проходящую через сообщение
+    Активным становится самое свежее продолжение этого сообщения
+    """
+    await get_owned_session(session_id, payload)
+    message = await get_owned_message(request.message_id, payload)
+    if message.session_id != session_id:
+        raise HTTPException(status_code=404, detail="Message not found")
     
-    message["content"] = request.content
-    message["updated_at"] = datetime.now().isoformat()
+    leaf = chat_store.switch_branch(message)
     
-    return message
+    return {"active_message_id": chat_store.public_id(leaf.id), "total": chat_store.count_messages(session_id)}
 
 
 @app.delete("/api/messages/{message_id}")
 async def delete_message(message_id: str, payload: Dict[str, Any] = Depends(verify_token)):
-    """Удалить сообщение и все последующие"""
-    message = messages_db.get(message_id)
+    """Удалить сообщение и все его продолжения; соседние ветки сохраняются"""
+    message = await get_owned_message(message_id, payload)
+    chat_store.delete_branch(message)
     
-    if not message:
-        raise HTTPException(status_code=404, detail="Message not found")
-    
-    # Проверяем, что сообщение принадлежит сессии пользователя
-    session = sessions_db.get(message.get("session_id"))
-    if not session or session.get("user_id") != payload.get("user_id"):
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    # Находим все сообщения в сессии и сортируем по времени
-    session_messages = []
-    for msg_id, msg in messages_db.items():
-        if msg.get("session_id") == message.get("session_id"):
-            session_messages.append(msg)
+    return {"success": True}
+
+
+@app.get("/api/search")
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=500),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    preview: Optional[int] = Query(None, ge=1, le=MAX_PREVIEW_CHARS),
+    payload: Dict[str, Any] = Depends(verify_token)
+):
+    """Полнотекстовый поиск по сообщениям пользователя (BM25)"""
+    total, ranked = search_index.search(payload.get("user_id"), q, limit=limit, offset=offset)
     
-    session_messages.sort(key=lambda x: x.get("created_at", ""))
+    results = []
+    for msg_id, score in ranked:
+        message = await resident_message(msg_id)
+        if message:
+            results.append({**chat_store.serialize_message(message, preview), "score": round(score, 4)})
     
-    # Находим индекс удаляемого сообщения
-    delete_index = -1
-    for i, msg in enumerate(session_messages):
-        if msg["id"] == message_id:
-            delete_index = i
-            break
+    return {
+        "query": q,
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+        "results": results
+    }
+
+
+@app.get("/api/sync")
+async def sync_changes(
+    since: Optional[str] = Query(None, max_length=64),
+    limit: int = Query(1000, ge=1, le=10000),
+    payload: Dict[str, Any] = Depends(verify_token)
+):
+    """
+    Дельта-синхронизация: изменения сессий и сообщений после курсора since
+    Создание и обновление следует применять как upsert. Смена активной ветки
+    приходит как entity=branch с id сессии. Если full_resync=true (в том числе
+    без since и после перезапуска сервера), клиент должен заново загрузить
+    данные и продолжить с возвращенного cursor
+    """
+    cursor, full_resync, changes, has_more = change_log.get_changes(payload.get("user_id"), since, limit)
+    
+    result = []
+    for change_seq, entity, op, obj_id in changes:
+        data = None
+        if entity == "session":
+            if op != "delete":
+                data = chat_store.sessions.get(obj_id)
+        elif entity == "branch":
+            # Смена активной ветки: id - сессия, данные - текущий лист
+            leaf = None
+            if obj_id in chat_store.sessions:
+                await ensure_resident(obj_id)
+                leaf = chat_store.active_leaf(obj_id) if obj_id in chat_store.sessions else None
+            if leaf is not None:
+                data = {"session_id": obj_id, "active_message_id": chat_store.public_id(leaf.id)}
+        else:
+            if op != "delete":
+                message = await resident_message(obj_id)
+                data = chat_store.serialize_message(message) if message else None
+            obj_id = chat_store.public_id(obj_id)
+        result.append({"seq": change_seq, "entity": entity, "op": op, "id": obj_id, "data": data})
     
-    # Удаляем это сообщение и все последующие
-    messages_to_delete = []
-    for i, msg in enumerate(session_messages):
-        if i >= delete_index:
-            messages_to_delete.append(msg["id"])
+    return {
+        "cursor": change_log.cursor(result[-1]["seq"]) if has_more else cursor,
+        "full_resync": full_resync,
+        "has_more": has_more,
+        "changes": result
+    }
+
+
+# Операции пакетного API: принимают операцию и уже проверенный токен
+def require_field(operation: BatchOperation, name: str):
+    value = getattr(operation, name)
+    if value is None:
+        raise HTTPException(status_code=422, detail=f"Field '{name}' is required for {operation.op}")
+    return value
+
+
+async def batch_get_session(operation: BatchOperation, payload: Dict[str, Any]):
+    return await get_owned_session(require_field(operation, "session_id"), payload)
+
+
+async def batch_list_messages(operation: BatchOperation, payload: Dict[str, Any]):
+    session_id = require_field(operation, "session_id")
+    await get_owned_session(session_id, payload)
     
-    for msg_id in messages_to_delete:
-        if msg_id in messages_db:
-            del messages_db[msg_id]
+    limit = operation.limit if operation.limit is not None else DEFAULT_MESSAGES_LIMIT
+    if limit > MAX_MESSAGES_LIMIT:
+        raise HTTPException(status_code=422, detail=f"limit must be between 1 and {MAX_MESSAGES_LIMIT}")
+    if operation.preview is not None and operation.preview > MAX_PREVIEW_CHARS:
+        raise HTTPException(status_code=422, detail=f"preview must be between 1 and {MAX_PREVIEW_CHARS}")
     
+    page, has_before, has_after = chat_store.get_messages(session_id, limit, before=operation.before, after=operation.after)
+    return {
+        "messages": [chat_store.serialize_message(message, operation.preview) for message in page],
+        "total": chat_store.count_messages(session_id),
+        "has_before": has_before,
+        "has_after": has_after
+    }
+
+
+async def batch_rename_session(operation: BatchOperation, payload: Dict[str, Any]):
+    session_id = require_field(operation, "session_id")
+    await get_owned_session(session_id, payload)
+    return chat_store.update_session(session_id, require_field(operation, "title"))
+
+
+async def batch_delete_session(operation: BatchOperation, payload: Dict[str, Any]):
+    session_id = require_field(operation, "session_id")
+    await get_owned_session(session_id, payload)
+    chat_store.delete_session(session_id)
+    return {"success": True}
+
+
+async def batch_update_message(operation: BatchOperation, payload: Dict[str, Any]):
+    return await edit_owned_message(require_field(operation, "message_id"), require_field(operation, "content"), payload)
+
+
+async def batch_delete_message(operation: BatchOperation, payload: Dict[str, Any]):
+    message = await get_owned_message(require_field(operation, "message_id"), payload)
+    chat_store.delete_branch(message)
     return {"success": True}
 
 
-def generate_bot_response(user_message: str) -> str:
+BATCH_OPERATIONS = {
+    "get_session": batch_get_session,
+    "list_messages": batch_list_messages,
+    "rename_session": batch_rename_session,
+    "delete_session": batch_delete_session,
+    "update_message": batch_update_message,
+    "delete_message": batch_delete_message,
+}
+
+
+@app.post("/api/batch")
+async def run_batch(request: BatchRequest, payload: Dict[str, Any] = Depends(verify_token)):
+    """
+    Пакет операций над сессиями и сообщениями за один запрос
+    Токен проверяется один раз, операции выполняются по порядку, а их записи уходят
+    в журнал одной записью. Ошибка одной операции (включая непредвиденную - статус 500)
+    не отменяет остальные: для каждой возвращается статус и результат или ошибка
+    """
+    if len(request.operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_OPERATIONS} operations per batch")
+    
+    results = []
+    with chat_journal.batch():
+        for operation in request.operations:
+            handler = BATCH_OPERATIONS.get(operation.op)
+            if handler is None:
+                results.append({"status": 400, "error": f"Unknown operation: {operation.op}"})
+                continue
+            try:
+                results.append({"status": 200, "result": await handler(operation, payload)})
+            except HTTPException as e:
+                results.append({"status": e.status_code, "error": e.detail})
+            except Exception as e:
+                logger.exception(f"Batch operation {operation.op} failed: {e}")
+                results.append({"status": 500, "error": "Internal server error"})
+    
+    return {"results": results}
+
+
+@app.get("/api/export")
+async def export_chat_history(payload: Dict[str, Any] = Depends(verify_token)):
+    """Потоковый экспорт истории пользователя в NDJSON с постоянным расходом памяти"""
+    user_id = payload.get("user_id")
+    
+    async def stream():
+        # Асинхронная обертка: синхронный генератор StreamingResponse выполнял бы в пуле потоков
+        for block in export_history(chat_store, user_id):
+            yield block
+    
+    return StreamingResponse(
+        stream(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="chat-history.ndjson"'}
+    )
+
+
+@app.post("/api/import")
+async def import_chat_history(request: Request, payload: Dict[str, Any] = Depends(verify_token)):
+    """
+    Импорт истории из NDJSON (формат /api/export), тело читается потоком
+    Строки применяются пакетами, записи каждого пакета уходят в журнал одной записью.
+    Повторный импорт того же файла не создает дубликатов. Если импорт прерван
+    (слишком длинная строка, обрыв соединения), примененная часть откатывается
+    """
+    importer = ChatImporter(chat_store, payload.get("user_id"))
+    batch = []
+    tail = []
+    tail_size = 0
+    
+    try:
+        async for chunk in request.stream():
+            if b"\n" not in chunk:
+                tail.append(chunk)
+                tail_size += len(chunk)
+                if tail_size > MAX_IMPORT_LINE_BYTES:
+                    raise HTTPException(status_code=413, detail="Import line is too long")
+                continue
+            
+            lines = chunk.split(b"\n")
+            if tail:
+                lines[0] = b"".join(tail) + lines[0]
+            tail = [lines.pop()]
+            tail_size = len(tail[0])
+            if tail_size > MAX_IMPORT_LINE_BYTES:
+                raise HTTPException(status_code=413, detail="Import line is too long")
+            batch.extend(lines)
+            
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                with chat_journal.batch():
+                    importer.apply(batch)
+                batch = []
+                # Отдаем управление циклу событий между пакетами
+                await asyncio.sleep(0)
+    except (Exception, asyncio.CancelledError):
+        with chat_journal.batch():
+            importer.rollback()
+        raise
+    
+    if tail:
+        batch.append(b"".join(tail))
+    with chat_journal.batch():
+        importer.apply(batch)
+    
+    report = importer.report()
+    logger.info(
+        f"Imported history for user {payload.get('user_id')}: {report['messages_imported']} messages, "
+        f"{report['bytes'] / 2 ** 20:.1f} MiB in {report['seconds']}s ({report['mb_per_second']} MiB/s)"
+    )
+    return report
+
+
+def generate_bot_response(user_message: str, deadline: Optional[float] = None) -> str:
     """Генерация ответа от бота (заглушка, в реальном приложении здесь будет вызов LLM)"""
+    return generate_bot_responses(user_message, 1, deadline)[0]
+
+
+def generate_bot_responses(user_message: str, n: int, deadline: Optional[float] = None) -> List[str]:
+    """
+    Генерация n вариантов ответа за один вызов (заглушка; с LLM - запрос /generate с n,
+    где промпт обрабатывается один раз, а варианты отличаются seed сэмплирования,
+    и с X-Request-Budget-Ms - остатком до deadline, как в ConnectionManager._forward_to_inference)
+    """
     import random
     
     responses = [
@@ -497,23 +1000,83 @@ def generate_bot_response(user_message: str) -> str:
         f"Благодарю вас за информацию. Вот что я могу сказать по теме: '{user_message[:20]}...'"
     ]
     
-    return random.choice(responses)
+    seed = random.getrandbits(32)
+    return [random.Random(seed + i).choice(responses) for i in range(n)]
 
 
 @app.get("/network/config")
 async def get_network_config():
     """Возвращает текущую конфигурацию сети"""
+    with tracer.span("network_mode"):
+        connection_mode = await asyncio.to_thread(network_config.get_connection_mode)
     return {
-        "local_ip": network_config.detect_local_ip(),
-        "connection_mode": network_config.get_connection_mode(),
-        "inference_endpoint": network_config.get_inference_endpoint(),
+        "local_ip": await asyncio.to_thread(network_config.detect_local_ip),
+        "connection_mode": connection_mode,
+        "inference_endpoint": await asyncio.to_thread(network_config.get_inference_endpoint),
         "network_detection_time": datetime.now().isoformat()
     }
 
 
+async def archive_sessions(session_ids: List[str]) -> int:
+    """Выгружает сессии в архив: запись файлов - в потоке, изменение хранилища - в цикле событий"""
+    archived = 0
+    for session_id in session_ids:
+        job = chat_store.prepare_archive(session_id)
+        if job is None:
+            continue
+        await asyncio.to_thread(chat_store.write_archive, job)
+        # Если сессию успели изменить или прочитать, она остается в памяти; файл перезапишется позже
+        archived += chat_store.commit_archive(job)
+    return archived
+
+
+async def archive_cold_sessions():
+    """
+    Выгружает простаивающие сессии в архив и удерживает бюджет памяти
+    Просыпается по интервалу обхода или сразу, когда хранилище сообщает о превышении бюджета
+    """
+    while True:
+        try:
+            await asyncio.wait_for(archive_wakeup.wait(), timeout=session_archive.sweep_interval)
+        except asyncio.TimeoutError:
+            pass
+        archive_wakeup.clear()
+        try:
+            while True:
+                idle = chat_store.idle_sessions(limit=ARCHIVE_BATCH_SIZE)
+                await archive_sessions(idle)
+                if len(idle) < ARCHIVE_BATCH_SIZE:
+                    break
+            await archive_sessions(chat_store.over_budget_sessions())
+        except Exception as e:
+            logger.error(f"Session archiving failed: {e}")
+
+
+async def compact_search_index():
+    """Компактификация поискового индекса вне обработчиков запросов: перестройка - в потоке"""
+    while True:
+        await search_compaction_wakeup.wait()
+        search_compaction_wakeup.clear()
+        for user_id in search_index.take_compaction_due():
+            job = search_index.prepare_compaction(user_id)
+            if job is None:
+                continue
+            try:
+                await asyncio.to_thread(job.run)
+            except asyncio.CancelledError:
+                job.index.abort_compaction()
+                raise
+            except Exception as e:
+                job.index.abort_compaction()
+                logger.error(f"Search index compaction failed: {e}")
+                continue
+            search_index.commit_compaction(job)
+
+
 @app.on_event("startup")
 async def startup_event():
     """Действия при запуске приложения"""
+    global archive_task, search_task
     logger.info("Starting Hybrid Chatbot API Gateway...")
     
     # Выполняем первоначальную настройку, если это первый запуск
@@ -521,14 +1084,46 @@ async def startup_event():
     setup = FirstRunSetup()
     setup.run_setup()
     
+    # Восстанавливаем хранилище из снимка и хвоста журнала, затем индексируем сообщения.
+    # Архивные сессии при запуске не читаются: они индексируются при загрузке из архива
+    if CHAT_JOURNAL_ENABLED:
+        chat_journal.open(chat_store)
+        for message in chat_store.messages.values():
+            search_index.add_message(chat_store.sessions[message.session_id]["user_id"], message.id, message.text)
+        chat_store.subscribe(chat_journal.on_store_change)
+    chat_store.on_reload = search_index.add_messages
+    
+    search_compaction_wakeup.clear()
+    search_index.on_compaction_needed = search_compaction_wakeup.set
+    search_task = asyncio.create_task(compact_search_index())
+    
+    # Архивы удаленных сессий (или всех, если хранилище не восстанавливалось) больше не нужны
+    session_archive.prune(chat_store.sessions)
+    if CHAT_ARCHIVE_ENABLED:
+        archive_wakeup.clear()
+        chat_store.on_over_budget = archive_wakeup.set
+        archive_task = asyncio.create_task(archive_cold_sessions())
+    
     logger.info(f"Network configuration: {network_config.get_connection_mode()}")
     logger.info(f"Inference endpoint: {network_config.get_inference_endpoint()}")
+    
+    # Сторож запускается после синхронной настройки выше, чтобы не принять ее за блокировку
+    loop_monitor.start(metrics.event_loop_lag.observe)
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Действия при выключении приложения"""
     logger.info("Shutting down Hybrid Chatbot API Gateway...")
+    loop_monitor.stop()
+    
+    if archive_task is not None:
+        archive_task.cancel()
+    if search_task is not None:
+        search_task.cancel()
+    
+    if CHAT_JOURNAL_ENABLED:
+        chat_journal.close()
 
 
 if __name__ == "__main__":
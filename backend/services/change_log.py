@@ -0,0 +1,105 @@
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Union
+from uuid import uuid4
+
+
+class _UserChangeLog:
+    """
+    Журнал изменений одного пользователя
+    Для каждой сущности хранится только последнее изменение, поэтому журнал
+    сжимается сам собой; floor - seq, до которого записи уже вытеснены
+    """
+
+    __slots__ = ("seq", "floor", "entries")
+
+    def __init__(self):
+        self.seq = 0
+        self.floor = 0
+        self.entries: "OrderedDict[Tuple[str, Union[str, int]], Tuple[int, str]]" = OrderedDict()
+
+    def record(self, entity: str, op: str, obj_id: Union[str, int], max_entries: int):
+        self.seq += 1
+        key = (entity, obj_id)
+        self.entries.pop(key, None)
+        self.entries[key] = (self.seq, op)
+
+        if len(self.entries) > max_entries:
+            # Вытесняем самые старые записи; клиенты, не видевшие их, получат сигнал полной синхронизации
+            while len(self.entries) > max_entries * 3 // 4:
+                _, (seq, _) = self.entries.popitem(last=False)
+                self.floor = seq
+
+    def changes_since(self, since: int) -> List[Tuple[int, str, str, Union[str, int]]]:
+        """Изменения с seq > since в порядке возрастания; стоимость O(числа изменений)"""
+        changes = []
+        for (entity, obj_id), (seq, op) in reversed(self.entries.items()):
+            if seq <= since:
+                break
+            changes.append((seq, entity, op, obj_id))
+        changes.reverse()
+        return changes
+
+
+class ChangeLog:
+    """
+    Журнал изменений сессий и сообщений для дельта-синхронизации клиентов
+    Журнал живет только в памяти процесса, поэтому курсор клиента - "<эпоха>:<seq>":
+    курсор другой эпохи (выданный до перезапуска) всегда ведет к полной синхронизации
+    """
+
+    def __init__(self):
+        self.max_entries = int(os.getenv('CHANGE_LOG_MAX_ENTRIES', '5000'))
+        self.user_logs: Dict[str, _UserChangeLog] = {}
+        self.epoch = uuid4().hex[:8]
+
+    def cursor(self, seq: int) -> str:
+        return f"{self.epoch}:{seq}"
+
+    def parse_cursor(self, cursor: Optional[str]) -> Optional[int]:
+        """seq из курсора этой эпохи; None - курсор отсутствует, некорректен или из другой эпохи"""
+        epoch, _, seq = (cursor or "").partition(":")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def on_store_change(self, op: str, entity: str, user_id: str, obj):
+        """Фиксирует изменение из хранилища чатов; сообщения хранятся по внутреннему целому id"""
+        if entity == "user":
+            return
+        log = self.user_logs.get(user_id)
+        if log is None:
+            log = self.user_logs[user_id] = _UserChangeLog()
+        if entity == "session":
+            obj_id = obj["id"]
+        elif entity == "branch":
+            # Для смены ветки важен только последний лист сессии
+            obj_id = obj.session_id
+        else:
+            obj_id = obj.id
+        log.record(entity, op, obj_id, self.max_entries)
+
+    def get_changes(self, user_id: str, cursor: Optional[str],
+                    limit: Optional[int] = None) -> Tuple[str, bool, List[Tuple[int, str, str, Union[str, int]]], bool]:
+        """
+        Возвращает (текущий курсор, нужна ли полная синхронизация, изменения, есть ли еще)
+        Полная синхронизация нужна, если курсора нет или он выдан до перезапуска сервера,
+        если часть изменений после него уже вытеснена или он указывает в будущее
+        """
+        since = self.parse_cursor(cursor)
+        log = self.user_logs.get(user_id)
+        if log is None:
+            return self.cursor(0), since != 0, [], False
+
+        if since is None or since < log.floor or since > log.seq:
+            return self.cursor(log.seq), True, [], False
+
+        changes = log.changes_since(since)
+        has_more = limit is not None and len(changes) > limit
+        if has_more:
+            changes = changes[:limit]
+        return self.cursor(log.seq), False, changes, has_more
+
+
+# Глобальный экземпляр журнала изменений
+change_log = ChangeLog()
@@ -0,0 +1,433 @@
+import gc
+import os
+import json
+import asyncio
+import time
+import queue
+import pickle
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from backend.services.chat_store import ChatStore, MessageRecord, ROLES_BY_VALUE
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = "segment-"
+SNAPSHOT_PREFIX = "snapshot-"
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+def _resolve(future: asyncio.Future, error: Optional[Exception]):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+def _file_lsn(path: Path) -> int:
+    """LSN из имени файла сегмента или снимка"""
+    return int(path.stem.rsplit("-", 1)[1])
+
+
+class ChatJournal:
+    """
+    Журнал мутаций хранилища чатов
+    Каждая мутация дописывается строкой JSON в текущий сегмент. Запись в файл и fsync
+    выполняет отдельный поток записи: обработчики только ставят строку в очередь, а поток
+    пишет накопившиеся записи одним вызовом и синхронизирует их с диском по политике
+    CHAT_JOURNAL_FSYNC. При always fsync выполняется после каждой группы записей, а ответ
+    клиенту задерживается (DurableAckMiddleware), пока записи запроса не окажутся на диске:
+    подтвержденная мутация переживает сбой. interval и never - асинхронные политики,
+    при сбое теряются последние подтвержденные мутации. Периодически снимается
+    снимок состояния: в цикле событий копируются только контейнеры, а сериализация,
+    запись и удаление покрытых снимком сегментов выполняются в фоновом потоке.
+    Снимок нечеткий (fuzzy): записи журнала идемпотентны, поэтому при старте
+    достаточно загрузить последний снимок и повторить хвост журнала после его LSN
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = Path(directory or os.getenv('CHAT_JOURNAL_DIR', 'data/chat_journal'))
+        self.fsync_policy = os.getenv('CHAT_JOURNAL_FSYNC', 'interval')
+        if self.fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown CHAT_JOURNAL_FSYNC policy: {self.fsync_policy}")
+        self.fsync_interval = float(os.getenv('CHAT_JOURNAL_FSYNC_INTERVAL', '1.0'))
+        self.segment_bytes = int(os.getenv('CHAT_JOURNAL_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+        self.snapshot_every = int(os.getenv('CHAT_JOURNAL_SNAPSHOT_EVERY', '1000000'))
+
+        self.store: Optional[ChatStore] = None
+        self.lsn = 0
+        self.segment = None
+        self.segment_size = 0
+        self.records_since_snapshot = 0
+        self.last_fsync = 0.0
+        self.batch_depth = 0
+        self.pending: List[bytes] = []
+        self.snapshot_thread: Optional[threading.Thread] = None
+        self.files_lock = threading.Lock()
+        # Очередь потока записи: (данные, LSN последней записи в них), Event - начать новый сегмент, None - стоп
+        self.queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self.writer_thread: Optional[threading.Thread] = None
+        # Последний записанный в файл LSN и есть ли записи без fsync (только для потока записи)
+        self.written_lsn = 0
+        self.unsynced = False
+        # LSN, записанный и синхронизированный с диском, и ожидающие его ответы (LSN, future цикла событий)
+        self.durable_lsn = 0
+        self.waiters: List[Tuple[int, asyncio.Future]] = []
+        self.waiters_lock = threading.Lock()
+
+    # Запуск и восстановление
+    def open(self, store: ChatStore):
+        """Восстанавливает хранилище из снимка и хвоста журнала и начинает новый сегмент"""
+        self.store = store
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        start = time.perf_counter()
+        replayed = self.recover(store)
+        logger.info(
+            f"Chat journal recovered at LSN {self.lsn}: {len(store.sessions)} sessions, "
+            f"{len(store.messages)} messages, {replayed} log records replayed "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+
+        self.written_lsn = self.durable_lsn = self.lsn
+        self._open_segment(self.lsn + 1)
+        self.writer_thread = threading.Thread(target=self._writer, name="chat-journal-writer", daemon=True)
+        self.writer_thread.start()
+        if self.lsn == 0:
+            # Префикс публичных id сообщений должен пережить перезапуск и до первого снимка
+            self._append(["c", "meta", store.id_prefix, store.id_key])
+
+    def recover(self, store: ChatStore) -> int:
+        """Загружает последний снимок и повторяет записи после него; возвращает число повторенных записей"""
+        # Массовое создание объектов без циклических ссылок: сборщик мусора только тратит время
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._recover(store)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _recover(self, store: ChatStore) -> int:
+        snapshot_lsn = 0
+        snapshots = self._list_files(SNAPSHOT_PREFIX, ".pkl")
+        if snapshots:
+            with open(snapshots[-1], "rb") as f:
+                state = pickle.load(f)
+            store.load_state(state)
+            snapshot_lsn = state["lsn"]
+        self.lsn = snapshot_lsn
+
+        replayed = 0
+        segments = self._list_files(SEGMENT_PREFIX, ".log")
+        for i, path in enumerate(segments):
+            if i + 1 < len(segments) and _file_lsn(segments[i + 1]) - 1 <= snapshot_lsn:
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        # Оборванная последняя запись после сбоя
+                        logger.warning(f"Ignoring torn record at the end of {path.name}")
+                        break
+                    record = json.loads(line)
+                    if record[0] <= snapshot_lsn:
+                        continue
+                    self._apply(store, record)
+                    self.lsn = record[0]
+                    replayed += 1
+        return replayed
+
+    def _apply(self, store: ChatStore, record: list):
+        _, op, entity, *fields = record
+        if entity == "message":
+            if op == "c":
+                message = MessageRecord(*fields)
+                message.role = ROLES_BY_VALUE[message.role]
+                store.restore_message(message)
+            elif op == "u":
+                store.restore_message_content(*fields)
+            else:
+                store.drop_message(fields[0])
+        elif entity == "branch":
+            store.restore_branch(fields[0])
+        elif entity == "session":
+            if op == "d":
+                store.drop_session(fields[0])
+            else:
+                session_id, user_id, title, created_at, updated_at = fields
+                store.restore_session({
+                    "id": session_id,
+                    "user_id": user_id,
+                    "title": title,
+                    "created_at": created_at,
+                    "updated_at": updated_at
+                })
+        elif entity == "user":
+            user_id, username, password_hash, created_at = fields
+            store.restore_user({
+                "id": user_id,
+                "username": username,
+                "password_hash": password_hash,
+                "created_at": created_at
+            })
+        elif entity == "meta":
+            store.restore_meta(*fields)
+
+    # Запись
+    def on_store_change(self, op: str, entity: str, user_id: str, obj):
+        """Дописывает мутацию хранилища в журнал"""
+        code = op[0]
+        if entity == "message":
+            if op == "create":
+                self._append([code, entity, *obj.as_tuple()])
+            elif op == "update":
+                self._append([code, entity, obj.id, obj.text, obj.updated_at])
+            else:
+                self._append([code, entity, obj.id])
+        elif entity == "branch":
+            self._append([code, entity, obj.id])
+        elif entity == "session":
+            if op == "delete":
+                self._append([code, entity, obj["id"]])
+            else:
+                self._append([code, entity, obj["id"], obj["user_id"], obj["title"],
+                              obj["created_at"], obj["updated_at"]])
+        elif entity == "user":
+            self._append([code, entity, obj["id"], obj["username"], obj["password_hash"], obj["created_at"]])
+
+    def _append(self, fields: list):
+        self.lsn += 1
+        data = (json.dumps([self.lsn, *fields], ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        if self.batch_depth:
+            self.pending.append(data)
+            return
+        self._write(data, 1)
+
+    def _write(self, data: bytes, records: int):
+        self.queue.put((data, self.lsn))
+        self.records_since_snapshot += records
+        if self.records_since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def _writer(self):
+        """Поток записи: все накопившиеся в очереди записи пишутся одним вызовом"""
+        timeout = self.fsync_interval if self.fsync_policy == "interval" else None
+        while True:
+            try:
+                item = self.queue.get(timeout=timeout if self.unsynced else None)
+            except queue.Empty:
+                # Записи без fsync, а новых нет: синхронизируем, не дожидаясь следующей записи
+                self._sync()
+                continue
+            group = []
+            while True:
+                if item is None or isinstance(item, threading.Event):
+                    self._flush(group)
+                    group = []
+                    if item is None:
+                        return
+                    # Новый сегмент для снимка: все записи до него уже в файле
+                    self._open_segment(self.written_lsn + 1)
+                    item.set()
+                else:
+                    group.append(item)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._flush(group)
+
+    def _flush(self, group: List[tuple]):
+        if not group:
+            return
+        data = b"".join(chunk for chunk, _ in group)
+        try:
+            self.segment.write(data)
+            self.segment_size += len(data)
+            self.written_lsn = group[-1][1]
+            self.unsynced = True
+
+            if self.fsync_policy == "always":
+                self._sync()
+            elif self.fsync_policy == "interval" and time.monotonic() - self.last_fsync >= self.fsync_interval:
+                self._sync()
+        except OSError as e:
+            logger.error(f"Chat journal write failed: {e}")
+            self._release(group[-1][1], e)
+            return
+
+        if self.segment_size >= self.segment_bytes:
+            self._open_segment(self.written_lsn + 1)
+
+    def _sync(self):
+        if self.fsync_policy != "never":
+            os.fsync(self.segment.fileno())
+        self.last_fsync = time.monotonic()
+        self.unsynced = False
+        self._release(self.written_lsn)
+
+    # Подтверждение записи при политике always
+    async def wait_durable(self):
+        """Дожидается, пока все уже поставленные в очередь записи окажутся на диске (только при always)"""
+        if self.fsync_policy != "always" or self.writer_thread is None:
+            return
+        # Записи незавершенного пакета еще не в очереди
+        lsn = self.lsn - len(self.pending)
+        with self.waiters_lock:
+            if lsn <= self.durable_lsn:
+                return
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.append((lsn, future))
+        await future
+
+    def _release(self, lsn: int, error: Optional[Exception] = None):
+        """Будит ответы, ждущие записей до lsn (из потока записи): после fsync или с ошибкой записи"""
+        with self.waiters_lock:
+            if error is None:
+                self.durable_lsn = max(self.durable_lsn, lsn)
+            ready = [future for waiting_lsn, future in self.waiters if waiting_lsn <= lsn]
+            if not ready:
+                return
+            self.waiters = [(waiting_lsn, future) for waiting_lsn, future in self.waiters if waiting_lsn > lsn]
+        for future in ready:
+            try:
+                future.get_loop().call_soon_threadsafe(_resolve, future, error)
+            except RuntimeError:
+                # Цикл событий уже закрыт: ждать подтверждения некому
+                pass
+
+    @contextmanager
+    def batch(self):
+        """Группирует записи пакета: одна запись в файл и не больше одного fsync"""
+        self.batch_depth += 1
+        try:
+            yield
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth and self.pending:
+                pending, self.pending = self.pending, []
+                self._write(b"".join(pending), len(pending))
+
+    def _open_segment(self, first_lsn: int):
+        """Закрывает текущий сегмент и начинает новый с LSN first_lsn"""
+        with self.files_lock:
+            if self.segment is not None:
+                if self.fsync_policy != "never":
+                    os.fsync(self.segment.fileno())
+                self.segment.close()
+            self.unsynced = False
+            path = self.directory / f"{SEGMENT_PREFIX}{first_lsn:020d}.log"
+            # Без буферизации: каждая запись сразу уходит в ОС и переживает падение процесса
+            self.segment = open(path, "ab", buffering=0)
+            self.segment_size = 0
+
+    # Снимки и компактификация
+    def snapshot(self) -> bool:
+        """Запускает создание снимка в фоне; возвращает False, если снимок уже создается"""
+        if self.snapshot_thread is not None and self.snapshot_thread.is_alive():
+            return False
+
+        lsn = self.lsn
+        state = self.store.capture_state()
+        # Сегмент с lsn + 1 открывает поток записи, дописав все записи до снимка
+        rotated = threading.Event()
+        self.queue.put(rotated)
+        self.records_since_snapshot = 0
+
+        self.snapshot_thread = threading.Thread(
+            target=self._write_snapshot, args=(lsn, state, rotated), name="chat-journal-snapshot", daemon=True
+        )
+        self.snapshot_thread.start()
+        return True
+
+    def _write_snapshot(self, lsn: int, state: dict, rotated: threading.Event):
+        try:
+            start = time.perf_counter()
+            state["lsn"] = lsn
+            state["messages"] = [message.as_tuple() for message in state["messages"]]
+
+            path = self.directory / f"{SNAPSHOT_PREFIX}{lsn:020d}.pkl"
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+
+            rotated.wait()
+            self._compact(lsn)
+            logger.info(f"Chat journal snapshot at LSN {lsn} written in {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            logger.error(f"Chat journal snapshot failed: {e}")
+
+    def _compact(self, snapshot_lsn: int):
+        """Удаляет старые снимки и сегменты, целиком покрытые снимком"""
+        with self.files_lock:
+            for path in self._list_files(SNAPSHOT_PREFIX, ".pkl"):
+                if _file_lsn(path) < snapshot_lsn:
+                    path.unlink()
+            segments = self._list_files(SEGMENT_PREFIX, ".log")
+            for path, next_path in zip(segments, segments[1:]):
+                if _file_lsn(next_path) - 1 <= snapshot_lsn:
+                    path.unlink()
+
+    def _list_files(self, prefix: str, suffix: str) -> List[Path]:
+        return sorted(self.directory.glob(f"{prefix}*{suffix}"), key=_file_lsn)
+
+    def close(self):
+        """Дожидается фонового снимка и записи очереди и закрывает текущий сегмент"""
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        if self.writer_thread is not None:
+            self.queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+        with self.files_lock:
+            if self.segment is not None:
+                if self.fsync_policy != "never":
+                    os.fsync(self.segment.fileno())
+                self.segment.close()
+                self.segment = None
+        self._release(self.lsn)
+
+    def get_stats(self) -> dict:
+        return {
+            "lsn": self.lsn,
+            "fsync_policy": self.fsync_policy,
+            "records_since_snapshot": self.records_since_snapshot,
+            "queued_writes": self.queue.qsize(),
+            "segments": len(self._list_files(SEGMENT_PREFIX, ".log")),
+            "snapshot_in_progress": self.snapshot_thread is not None and self.snapshot_thread.is_alive(),
+        }
+
+
+class DurableAckMiddleware:
+    """
+    ASGI-middleware: при CHAT_JOURNAL_FSYNC=always ответ (и каждое сообщение WebSocket)
+    уходит клиенту только после fsync записей журнала, сделанных к этому моменту
+    """
+
+    def __init__(self, app, journal: ChatJournal):
+        self.app = app
+        self.journal = journal
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket") or self.journal.fsync_policy != "always":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_durable(message):
+            if message["type"] in ("http.response.start", "http.response.body", "websocket.send"):
+                await self.journal.wait_durable()
+            await send(message)
+
+        await self.app(scope, receive, send_durable)
+
+
+# Глобальный экземпляр журнала хранилища чатов
+chat_journal = ChatJournal()
@@ -0,0 +1,1185 @@
+import time
+import hashlib
+import logging
+import secrets
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from datetime import datetime
+from enum import IntEnum
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+from uuid import UUID, uuid4, uuid5
+
+from backend.services.content_codec import content_codec, Content
+
+logger = logging.getLogger(__name__)
+
+
+class MessageRole(IntEnum):
+    """Роль автора сообщения; хранится как небольшое целое вместо строки"""
+    USER = 0
+    ASSISTANT = 1
+    SYSTEM = 2
+
+
+ROLE_NAMES = tuple(role.name.lower() for role in MessageRole)
+# Быстрое преобразование целого в MessageRole при восстановлении
+ROLES_BY_VALUE = tuple(MessageRole)
+
+
+def now_us() -> int:
+    """Текущее время в микросекундах от эпохи"""
+    return time.time_ns() // 1000
+
+
+def format_timestamp(timestamp_us: int) -> str:
+    """Переводит метку времени в ISO-формат, в котором она отдается клиентам"""
+    return datetime.fromtimestamp(timestamp_us / 1_000_000).isoformat()
+
+
+def parse_timestamp(value: str) -> int:
+    """Обратное к format_timestamp: ISO-время в микросекунды от эпохи"""
+    moment = datetime.fromisoformat(value)
+    return round(moment.timestamp() * 1_000_000)
+
+
+# Оценка памяти резидентного сообщения сверх текста: запись со слотами, id, ссылки в словаре и колонках
+MESSAGE_OVERHEAD = 200
+
+
+def message_size(content: Content) -> int:
+    """
+    Приблизительный объем памяти, занимаемый сообщением
+    sys.getsizeof не подходит: он растет, когда у строки появляется кэш UTF-8 (после json/pickle)
+    """
+    return MESSAGE_OVERHEAD + content_codec.size(content)
+
+
+class MessageRecord:
+    """
+    Компактная запись сообщения
+    Вместо словаря со строковыми ключами - слоты; id - целое, роль - MessageRole,
+    время - целые микросекунды. В JSON-форму сообщение переводится только при ответе клиенту.
+    Длинное содержимое хранится сжатым (PackedText), полный текст дает свойство text.
+    parent_id - предыдущее сообщение ветки (0 у первого сообщения)
+    """
+
+    __slots__ = ("id", "session_id", "seq", "role", "content", "created_at", "updated_at", "parent_id")
+
+    def __init__(self, msg_id: int, session_id: str, seq: int, role: MessageRole,
+                 content: Content, created_at: int, updated_at: Optional[int] = None,
+                 parent_id: int = 0):
+        self.id = msg_id
+        self.session_id = session_id
+        self.seq = seq
+        self.role = role
+        self.content = content
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.parent_id = parent_id
+
+    @property
+    def text(self) -> str:
+        """Полный текст сообщения (сжатое содержимое распаковывается)"""
+        return content_codec.unpack(self.content)
+
+    def as_tuple(self) -> tuple:
+        """Поля записи для журнала, снимков и архивов; текст всегда несжатый"""
+        return (self.id, self.session_id, self.seq, int(self.role),
+                self.text, self.created_at, self.updated_at, self.parent_id)
+
+
+class _SessionMessages:
+    """
+    Упорядоченный по seq список сообщений одной сессии (колонки в массивах)
+    Сообщения образуют дерево: parents - колонка родителей, forks - развилки
+    (родитель -> потомки в порядке создания, только для родителей с несколькими потомками).
+    Активная ветка задается листом leaf (0 - последнее по seq сообщение, оно всегда лист)
+    и для сессий с развилками материализуется в path_seqs/path_ids.
+    forks и path_* строятся лениво: None означает, что их нужно пересчитать
+    """
+
+    __slots__ = ("seqs", "ids", "parents", "next_seq", "last_access", "forks", "leaf", "path_seqs", "path_ids")
+
+    def __init__(self, last_access: Optional[float] = None):
+        self.seqs = array("Q")
+        self.ids = array("Q")
+        self.parents = array("Q")
+        self.next_seq = 1
+        # Время последнего обращения (time.time()), по нему холодные сессии уходят в архив
+        self.last_access = time.time() if last_access is None else last_access
+        self.forks: Optional[Dict[int, List[int]]] = None
+        self.leaf = 0
+        self.path_seqs: Optional[array] = None
+        self.path_ids: Optional[array] = None
+
+    def index_of(self, seq: int) -> int:
+        """Позиция сообщения с данным seq или -1"""
+        i = bisect_left(self.seqs, seq)
+        if i < len(self.seqs) and self.seqs[i] == seq:
+            return i
+        return -1
+
+    def insert(self, seq: int, msg_id: int, parent_id: int):
+        """Вставляет сообщение по seq"""
+        if not self.seqs or seq > self.seqs[-1]:
+            self.seqs.append(seq)
+            self.ids.append(msg_id)
+            self.parents.append(parent_id)
+        else:
+            i = bisect_left(self.seqs, seq)
+            self.seqs.insert(i, seq)
+            self.ids.insert(i, msg_id)
+            self.parents.insert(i, parent_id)
+
+    def remove_at(self, positions: List[int]):
+        """Удаляет сообщения в позициях positions (по возрастанию)"""
+        if positions[-1] - positions[0] + 1 == len(positions):
+            del self.seqs[positions[0]:positions[-1] + 1]
+            del self.ids[positions[0]:positions[-1] + 1]
+            del self.parents[positions[0]:positions[-1] + 1]
+            return
+        removed = set(positions)
+        for name in ("seqs", "ids", "parents"):
+            column = getattr(self, name)
+            setattr(self, name, array("Q", [value for i, value in enumerate(column) if i not in removed]))
+
+    def invalidate(self):
+        """Сбрасывает развилки и материализованную ветку после изменения дерева"""
+        self.forks = None
+        self.path_seqs = self.path_ids = None
+
+
+class _ArchivedIds:
+    """
+    Сессии выгруженных сообщений: отсортированные диапазоны подряд идущих id одной сессии
+    Сообщения сессии создаются парами и сериями (вопрос - ответ, перегенерация), поэтому
+    диапазон обычно покрывает несколько id; три параллельных столбца вместо записи словаря
+    на каждое архивное сообщение. Ссылки удаленных архивных сессий вычищаются лениво
+    """
+
+    __slots__ = ("starts", "ends", "sessions", "count", "stale")
+
+    def __init__(self):
+        self.starts = array("Q")
+        self.ends = array("Q")
+        self.sessions: List[str] = []
+        # Число покрытых id и сколько из них принадлежат удаленным сессиям
+        self.count = 0
+        self.stale = 0
+
+    def __len__(self) -> int:
+        return self.count - self.stale
+
+    @staticmethod
+    def _runs(ids: Iterator[int]) -> Iterator[Tuple[int, int]]:
+        start = end = None
+        for msg_id in sorted(ids):
+            if start is not None and msg_id == end + 1:
+                end = msg_id
+                continue
+            if start is not None:
+                yield start, end
+            start = end = msg_id
+        if start is not None:
+            yield start, end
+
+    def add(self, session_id: str, ids: Iterator[int]):
+        for start, end in self._runs(ids):
+            i = bisect_left(self.starts, start)
+            self.starts.insert(i, start)
+            self.ends.insert(i, end)
+            self.sessions.insert(i, session_id)
+            self.count += end - start + 1
+
+    def remove(self, session_id: str, ids: Iterator[int]):
+        for start, end in self._runs(ids):
+            i = bisect_left(self.starts, start)
+            if i < len(self.starts) and self.starts[i] == start and self.sessions[i] == session_id:
+                self._delete(i)
+
+    def _delete(self, i: int):
+        self.count -= self.ends[i] - self.starts[i] + 1
+        del self.starts[i], self.ends[i], self.sessions[i]
+
+    def get(self, msg_id: int) -> Optional[str]:
+        i = bisect_right(self.starts, msg_id) - 1
+        if i >= 0 and msg_id <= self.ends[i]:
+            return self.sessions[i]
+        return None
+
+    def discard(self, msg_id: int):
+        """Удаляет устаревший диапазон, содержащий msg_id"""
+        i = bisect_right(self.starts, msg_id) - 1
+        if i >= 0 and msg_id <= self.ends[i]:
+            size = self.ends[i] - self.starts[i] + 1
+            self._delete(i)
+            self.stale = max(0, self.stale - size)
+
+    def prune(self, keep: Dict[str, int]):
+        """Перестраивает столбцы без диапазонов сессий, которых нет в keep"""
+        live = [i for i, session_id in enumerate(self.sessions) if session_id in keep]
+        self.starts = array("Q", (self.starts[i] for i in live))
+        self.ends = array("Q", (self.ends[i] for i in live))
+        self.sessions = [self.sessions[i] for i in live]
+        self.count = sum(end - start + 1 for start, end in zip(self.starts, self.ends))
+        self.stale = 0
+
+    def capture(self) -> tuple:
+        return array("Q", self.starts), array("Q", self.ends), list(self.sessions)
+
+
+class _ArchiveJob:
+    """Выгрузка сессии: сообщения на момент подготовки и отметки для проверки, что сессия не менялась"""
+
+    __slots__ = ("session_id", "entry", "version", "last_access", "next_seq", "leaf", "messages")
+
+    def __init__(self, session_id: str, entry: "_SessionMessages", version: int, messages: List["MessageRecord"]):
+        self.session_id = session_id
+        self.entry = entry
+        self.version = version
+        self.last_access = entry.last_access
+        self.next_seq = entry.next_seq
+        self.leaf = entry.leaf
+        self.messages = messages
+
+
+# Подписчик на изменения: (op, entity, user_id, obj), op - create/update/delete,
+# entity - user/session/message/branch, obj - словарь пользователя или сессии либо MessageRecord
+# (для branch - новый лист активной ветки сессии)
+StoreListener = Callable[[str, str, str, Union[dict, MessageRecord]], None]
+
+# Биты варианта RFC 4122 в младшей половине UUID; остальные 62 бита - зашифрованный целочисленный id
+_UUID_VARIANT = 0b10 << 62
+_UUID_ID_MASK = (1 << 62) - 1
+# Шифр id - сеть Фейстеля на двух половинах по 31 бит
+_HALF_BITS = 31
+_HALF_MASK = (1 << _HALF_BITS) - 1
+_FEISTEL_ROUNDS = 4
+
+
+class ChatStore:
+    """
+    Хранилище пользователей, сессий и сообщений в памяти
+    Сообщения каждой сессии хранятся в порядке возрастания seq,
+    поэтому выборка страницы по курсору стоит O(log n + размер страницы).
+    Производные структуры (поиск, журнал изменений) подписываются на мутации через subscribe.
+    Счетчики версий списка сессий пользователя и каждой сессии позволяют отвечать
+    на условные запросы без обращения к данным.
+    Внутри сообщения адресуются целыми id; наружу они отдаются как UUID,
+    старшие 64 бита которого - префикс хранилища, а младшие - id, зашифрованный
+    секретным ключом (перестановка 62-битных чисел): соседние id не угадываются по выданным.
+    Сообщения холодных сессий выгружаются в сжатый архив (см. attach_archive);
+    метаданные сессий всегда остаются в памяти, а сообщения загружаются обратно
+    при первом обращении. session_messages упорядочен по давности обращения (LRU).
+    Сообщения сессии - дерево: правка и перегенерация создают соседнюю ветку
+    со ссылкой на общего родителя, поэтому ответвление стоит O(1) и не копирует
+    общий префикс. Страницы сообщений отдаются по активной ветке
+    """
+
+    def __init__(self):
+        self.users: Dict[str, dict] = {}
+        self.sessions: Dict[str, dict] = {}
+        self.messages: Dict[int, MessageRecord] = {}
+        self.user_sessions: Dict[str, Dict[str, None]] = {}
+        self.session_messages: "OrderedDict[str, _SessionMessages]" = OrderedDict()
+        self.listeners: List[StoreListener] = []
+        self.user_versions: Dict[str, int] = {}
+        self.session_versions: Dict[str, int] = {}
+        # Эпоха меняется при каждом запуске, чтобы версии не совпадали между перезапусками
+        self.epoch = uuid4().hex[:8]
+        # Старшая половина UUID сообщений с выставленной версией 4 и ключ шифра, скрывающего счетчик id
+        self.id_prefix = (secrets.randbits(64) & ~(0xF << 12)) | (0x4 << 12)
+        self.id_key = secrets.randbits(128)
+        self._id_hash = self._make_id_hash(self.id_key)
+        self.next_message_id = 1
+
+        # Холодные сессии: число сообщений в архиве и сессии выгруженных сообщений (диапазоны id)
+        self.archive = None
+        self.archived_sessions: Dict[str, int] = {}
+        self.archived_messages = _ArchivedIds()
+        self.resident_bytes = 0
+        # Вызывается, когда память сообщений превысила бюджет: выгрузку выполняет фоновая задача
+        self.on_over_budget: Optional[Callable[[], None]] = None
+        # Вызывается с (user_id, сообщения) после загрузки сессии из архива
+        self.on_reload: Optional[Callable[[str, List[MessageRecord]], None]] = None
+        self.archive_stats = {
+            "archived_total": 0,
+            "reloads": 0,
+            "reload_seconds_total": 0.0,
+            "reload_seconds_max": 0.0,
+        }
+
+    def subscribe(self, listener: StoreListener):
+        """Регистрирует подписчика на изменения сессий и сообщений"""
+        self.listeners.append(listener)
+
+    def _notify(self, op: str, entity: str, user_id: str, obj: Union[dict, MessageRecord]):
+        if entity == "session":
+            self.user_versions[user_id] = self.user_versions.get(user_id, 0) + 1
+            self.session_versions[obj["id"]] = self.session_versions.get(obj["id"], 0) + 1
+        elif entity in ("message", "branch"):
+            self.session_versions[obj.session_id] = self.session_versions.get(obj.session_id, 0) + 1
+
+        for listener in self.listeners:
+            listener(op, entity, user_id, obj)
+
+    def _message_owner(self, message: MessageRecord) -> str:
+        return self.sessions[message.session_id]["user_id"]
+
+    def sessions_version(self, user_id: str) -> str:
+        """Версия списка сессий пользователя"""
+        return f"{self.epoch}.{self.user_versions.get(user_id, 0)}"
+
+    def session_version(self, session_id: str) -> str:
+        """Версия сессии и ее сообщений"""
+        return f"{self.epoch}.{self.session_versions.get(session_id, 0)}"
+
+    # Преобразование на границе API
+    @staticmethod
+    def _make_id_hash(id_key: int):
+        return hashlib.blake2b(key=id_key.to_bytes(16, "big"), digest_size=4)
+
+    def _id_round(self, half: int, round_no: int) -> int:
+        h = self._id_hash.copy()
+        h.update((half << 3 | round_no).to_bytes(5, "big"))
+        return int.from_bytes(h.digest(), "big") & _HALF_MASK
+
+    def _encrypt_id(self, msg_id: int) -> int:
+        left, right = msg_id >> _HALF_BITS, msg_id & _HALF_MASK
+        for round_no in range(_FEISTEL_ROUNDS):
+            left, right = right, left ^ self._id_round(right, round_no)
+        return (left << _HALF_BITS) | right
+
+    def _decrypt_id(self, value: int) -> int:
+        left, right = value >> _HALF_BITS, value & _HALF_MASK
+        for round_no in reversed(range(_FEISTEL_ROUNDS)):
+            left, right = right ^ self._id_round(left, round_no), left
+        return (left << _HALF_BITS) | right
+
+    def public_id(self, msg_id: int) -> str:
+        """UUID сообщения для клиента"""
+        return str(UUID(int=(self.id_prefix << 64) | _UUID_VARIANT | self._encrypt_id(msg_id)))
+
+    def parse_id(self, message_id: str) -> Optional[int]:
+        """Целочисленный id сообщения по его UUID или None, если UUID выдан не этим хранилищем"""
+        try:
+            value = UUID(message_id).int
+        except (ValueError, AttributeError, TypeError):
+            return None
+        if value >> 64 != self.id_prefix or value & ~_UUID_ID_MASK & ((1 << 64) - 1) != _UUID_VARIANT:
+            return None
+        return self._decrypt_id(value & _UUID_ID_MASK)
+
+    def serialize_message(self, message: MessageRecord, preview: Optional[int] = None) -> dict:
+        """
+        JSON-представление сообщения
+        С preview отдаются только первые preview символов и флаг truncated;
+        короткое превью берется из несжатого начала без распаковки.
+        У сообщения с альтернативами (соседними ветками) есть siblings и sibling_index
+        """
+        data = {
+            "id": self.public_id(message.id),
+            "session_id": message.session_id,
+            "seq": message.seq,
+            "parent_id": self.public_id(message.parent_id) if message.parent_id else None,
+            "role": ROLE_NAMES[message.role],
+            "content": message.text if preview is None else content_codec.preview(message.content, preview),
+            "created_at": format_timestamp(message.created_at)
+        }
+        if preview is not None:
+            data["truncated"] = content_codec.length(message.content) > preview
+        if message.updated_at is not None:
+            data["updated_at"] = format_timestamp(message.updated_at)
+        entry = self.session_messages.get(message.session_id)
+        if entry is not None:
+            siblings = self._forks(entry).get(message.parent_id)
+            if siblings is not None and message.id in siblings:
+                data["siblings"] = len(siblings)
+                data["sibling_index"] = siblings.index(message.id)
+        return data
+
+    # Пользователи
+    def get_user_by_username(self, username: str) -> Optional[dict]:
+        return self.users.get(username)
+
+    def create_user(self, username: str, password_hash: str) -> dict:
+        """Пароль хранится (и попадает в журнал и снимки) только в виде хэша"""
+        user = {
+            "id": str(uuid4()),
+            "username": username,
+            "password_hash": password_hash,
+            "created_at": datetime.now().isoformat()
+        }
+        self.users[username] = user
+        self._notify("create", "user", user["id"], user)
+        return user
+
+    # Сессии
+    def create_session(self, user_id: str, title: str) -> dict:
+        timestamp = datetime.now().isoformat()
+        session = {
+            "id": str(uuid4()),
+            "user_id": user_id,
+            "title": title,
+            "created_at": timestamp,
+            "updated_at": timestamp
+        }
+        self.sessions[session["id"]] = session
+        self.user_sessions.setdefault(user_id, {})[session["id"]] = None
+        self.session_messages[session["id"]] = _SessionMessages()
+        self._notify("create", "session", user_id, session)
+        return session
+
+    def get_session(self, session_id: str) -> Optional[dict]:
+        """Сессия по id; сообщения архивной сессии при этом загружаются в память"""
+        session = self.sessions.get(session_id)
+        if session is not None:
+            self._entry(session_id)
+        return session
+
+    def list_sessions(self, user_id: str) -> List[dict]:
+        """Сессии пользователя, отсортированные по дате обновления"""
+        sessions = [self.sessions[session_id] for session_id in self.user_sessions.get(user_id, ())]
+        sessions.sort(key=lambda x: x.get("updated_at", ""), reverse=True)
+        return sessions
+
+    def update_session(self, session_id: str, title: str) -> dict:
+        session = self.sessions[session_id]
+        session["title"] = title
+        session["updated_at"] = datetime.now().isoformat()
+        self._notify("update", "session", session["user_id"], session)
+        return session
+
+    def touch_session(self, session_id: str, timestamp_us: int):
+        session = self.sessions[session_id]
+        session["updated_at"] = format_timestamp(timestamp_us)
+        self._notify("update", "session", session["user_id"], session)
+
+    def delete_session(self, session_id: str) -> List[int]:
+        """Удаляет сессию, возвращает id удаленных сообщений"""
+        session = self.sessions[session_id]
+        # Подписчикам нужны удаляемые сообщения, поэтому архивная сессия сначала загружается
+        self._entry(session_id)
+        entry = self.session_messages.pop(session_id)
+        removed = entry.ids.tolist()
+        for msg_id in removed:
+            message = self.messages.pop(msg_id)
+            self.resident_bytes -= message_size(message.content)
+            self._notify("delete", "message", session["user_id"], message)
+
+        del self.sessions[session_id]
+        self.user_sessions.get(session["user_id"], {}).pop(session_id, None)
+        self._notify("delete", "session", session["user_id"], session)
+        self.session_versions.pop(session_id, None)
+        # Архив удаляется только после записи об удалении сессии в журнале
+        if self.archive is not None:
+            self.archive.delete(session_id)
+        return removed
+
+    # Сообщения
+    def add_message(self, session_id: str, role: MessageRole, content: str,
+                    parent_id: Optional[int] = None) -> MessageRecord:
+        """
+        Добавляет сообщение после parent_id (по умолчанию - в конец активной ветки)
+        Если у родителя уже есть продолжение, создается новая ветка; новое сообщение становится активным
+        """
+        entry = self._entry(session_id)
+        if parent_id is None:
+            parent_id = self._leaf(entry)
+        siblings = self._children(entry, parent_id)
+        message = MessageRecord(
+            self.next_message_id,
+            # Ссылаемся на строку id из самой сессии, чтобы не хранить копию из запроса
+            self.sessions[session_id]["id"],
+            entry.next_seq,
+            role,
+            content,
+            now_us(),
+            parent_id=parent_id
+        )
+        self.next_message_id += 1
+        entry.next_seq += 1
+        entry.insert(message.seq, message.id, parent_id)
+        self._link(entry, message, siblings)
+        self.messages[message.id] = message
+        # Подписчики получают несжатый текст, сжатие - после уведомления
+        self._notify("create", "message", self._message_owner(message), message)
+        message.content = content_codec.pack(content)
+        self.resident_bytes += message_size(message.content)
+        self._check_budget()
+        return message
+
+    def archived_session(self, msg_id: int) -> Optional[str]:
+        """Архивная сессия сообщения или None, если сообщение в памяти (или его нет)"""
+        if msg_id in self.messages:
+            return None
+        session_id = self.archived_messages.get(msg_id)
+        if session_id is not None and session_id not in self.archived_sessions:
+            # Ссылка осталась от удаленной архивной сессии
+            self.archived_messages.discard(msg_id)
+            return None
+        return session_id
+
+    def find_message(self, msg_id: int) -> Optional[MessageRecord]:
+        """Сообщение по внутреннему id; архивная сессия при необходимости загружается"""
+        message = self.messages.get(msg_id)
+        if message is None:
+            session_id = self.archived_session(msg_id)
+            if session_id is None:
+                return None
+            self._entry(session_id)
+            message = self.messages.get(msg_id)
+        return message
+
+    def get_message(self, message_id: str) -> Optional[MessageRecord]:
+        """Сообщение по публичному UUID"""
+        msg_id = self.parse_id(message_id)
+        return self.find_message(msg_id) if msg_id is not None else None
+
+    def update_message(self, message: MessageRecord, content: str) -> MessageRecord:
+        self.resident_bytes -= message_size(message.content)
+        message.content = content
+        message.updated_at = now_us()
+        self._notify("update", "message", self._message_owner(message), message)
+        message.content = content_codec.pack(content)
+        self.resident_bytes += message_size(message.content)
+        return message
+
+    def delete_branch(self, message: MessageRecord) -> List[int]:
+        """
+        Удаляет сообщение и все его продолжения (поддерево), возвращает id удаленных
+        Соседние ветки сохраняются; если удалена активная ветка, активной становится
+        самая свежая из оставшихся веток родителя
+        """
+        entry = self._entry(message.session_id)
+        positions = self._subtree(entry, message.id)
+        removed = [entry.ids[i] for i in positions]
+        active_removed = self._leaf(entry) in set(removed)
+
+        forks = self._forks(entry)
+        for msg_id in removed:
+            forks.pop(msg_id, None)
+        siblings = forks.get(message.parent_id)
+        if siblings is not None:
+            siblings.remove(message.id)
+            if len(siblings) < 2:
+                del forks[message.parent_id]
+        entry.remove_at(positions)
+
+        user_id = self._message_owner(message)
+        for msg_id in removed:
+            removed_message = self.messages.pop(msg_id)
+            self.resident_bytes -= message_size(removed_message.content)
+            self._notify("delete", "message", user_id, removed_message)
+
+        if active_removed:
+            entry.path_seqs = entry.path_ids = None
+            if entry.ids:
+                self._set_leaf(entry, self._latest_leaf(entry, message.parent_id))
+                self._notify("update", "branch", user_id, self.messages[self._leaf(entry)])
+        return removed
+
+    def count_messages(self, session_id: str) -> int:
+        """Длина активной ветки (для архивной сессии - число всех ее сообщений)"""
+        entry = self.session_messages.get(session_id)
+        if entry is None:
+            return self.archived_sessions[session_id]
+        return len(self._branch(entry)[1])
+
+    def get_messages(self, session_id: str, limit: int, before: Optional[int] = None,
+                     after: Optional[int] = None) -> Tuple[List[MessageRecord], bool, bool]:
+        """
+        Возвращает страницу сообщений активной ветки в порядке возрастания seq
+        Без курсоров - последние limit сообщений; after - первые limit после курсора;
+        before - последние limit перед курсором. Также возвращает флаги наличия
+        более старых и более новых сообщений за пределами страницы.
+        seq вдоль ветки возрастает, поэтому курсоры работают и на ветке
+        """
+        seqs, ids = self._branch(self._entry(session_id))
+        lo = bisect_right(seqs, after) if after is not None else 0
+        hi = bisect_left(seqs, before) if before is not None else len(seqs)
+
+        if after is not None:
+            start, end = lo, min(hi, lo + limit)
+        else:
+            start, end = max(lo, hi - limit), hi
+
+        page = [self.messages[msg_id] for msg_id in ids[start:end]]
+        return page, start > 0, end < len(ids)
+
+    # Ветвление
+    def _forks(self, entry: _SessionMessages) -> Dict[int, List[int]]:
+        """Развилки сессии; после восстановления или загрузки из архива строятся по колонке родителей"""
+        if entry.forks is None:
+            forks = {parent: [] for parent, count in Counter(entry.parents).items() if count > 1}
+            if forks:
+                for parent, msg_id in zip(entry.parents, entry.ids):
+                    children = forks.get(parent)
+                    if children is not None:
+                        children.append(msg_id)
+            entry.forks = forks
+        return entry.forks
+
+    def _children(self, entry: _SessionMessages, parent_id: int) -> List[int]:
+        """Продолжения сообщения parent_id (0 - первые сообщения веток)"""
+        children = self._forks(entry).get(parent_id)
+        if children is not None:
+            return children
+        # Продолжение не больше одного, и оно создано позже родителя
+        start = entry.index_of(self.messages[parent_id].seq) + 1 if parent_id else 0
+        try:
+            return [entry.ids[entry.parents.index(parent_id, start)]]
+        except ValueError:
+            return []
+
+    def _link(self, entry: _SessionMessages, message: MessageRecord, siblings: List[int]):
+        """Учитывает новое сообщение в развилках и делает его листом активной ветки"""
+        if siblings:
+            forks = entry.forks
+            if message.parent_id not in forks:
+                forks[message.parent_id] = list(siblings)
+            forks[message.parent_id].append(message.id)
+        path_ids = entry.path_ids
+        if path_ids is not None and (path_ids[-1] if path_ids else 0) == message.parent_id:
+            path_ids.append(message.id)
+            entry.path_seqs.append(message.seq)
+        else:
+            entry.path_seqs = entry.path_ids = None
+        entry.leaf = 0 if entry.ids[-1] == message.id else message.id
+
+    @staticmethod
+    def _leaf(entry: _SessionMessages) -> int:
+        """Лист активной ветки (0 - сессия пуста)"""
+        return entry.leaf or (entry.ids[-1] if entry.ids else 0)
+
+    def _set_leaf(self, entry: _SessionMessages, leaf: int):
+        if leaf != self._leaf(entry):
+            entry.path_seqs = entry.path_ids = None
+        entry.leaf = 0 if entry.ids and entry.ids[-1] == leaf else leaf
+
+    def _branch(self, entry: _SessionMessages) -> Tuple[array, array]:
+        """
+        Колонки (seqs, ids) активной ветки
+        Без развилок ветка - вся сессия; иначе путь от листа к корню
+        материализуется за O(длины ветки) и переиспользуется до смены ветки
+        """
+        if not self._forks(entry):
+            return entry.seqs, entry.ids
+        if entry.path_ids is None:
+            path = []
+            msg_id = self._leaf(entry)
+            while msg_id:
+                path.append(self.messages[msg_id])
+                msg_id = path[-1].parent_id
+            path.reverse()
+            entry.path_seqs = array("Q", [message.seq for message in path])
+            entry.path_ids = array("Q", [message.id for message in path])
+        return entry.path_seqs, entry.path_ids
+
+    def _subtree(self, entry: _SessionMessages, msg_id: int) -> List[int]:
+        """
+        Позиции сообщения и всех его продолжений по возрастанию seq
+        Потомки создаются позже предка, поэтому достаточно одного прохода вправо
+        """
+        start = entry.index_of(self.messages[msg_id].seq)
+        members = {msg_id}
+        positions = [start]
+        ids = entry.ids
+        parents = entry.parents
+        for i in range(start + 1, len(ids)):
+            if parents[i] in members:
+                members.add(ids[i])
+                positions.append(i)
+        return positions
+
+    def _latest_leaf(self, entry: _SessionMessages, msg_id: int) -> int:
+        """Самое свежее сообщение поддерева - всегда лист (у его продолжений seq был бы больше)"""
+        if not msg_id:
+            return entry.ids[-1] if entry.ids else 0
+        return entry.ids[self._subtree(entry, msg_id)[-1]]
+
+    def get_siblings(self, message: MessageRecord) -> List[MessageRecord]:
+        """Альтернативы сообщения (включая его само) в порядке создания"""
+        entry = self._entry(message.session_id)
+        return [self.messages[msg_id] for msg_id in self._children(entry, message.parent_id)]
+
+    def active_leaf(self, session_id: str) -> Optional[MessageRecord]:
+        """Последнее сообщение активной ветки"""
+        leaf = self._leaf(self._entry(session_id))
+        return self.messages[leaf] if leaf else None
+
+    def branch_leaf(self, session_id: str) -> int:
+        """
+        Явно выбранный лист активной ветки или 0, если активна самая свежая ветка
+        Архивная сессия не загружается в память
+        """
+        entry = self.session_messages.get(session_id)
+        if entry is None:
+            return self._read_archive(session_id)[2]
+        return entry.leaf
+
+    def switch_branch(self, message: MessageRecord) -> MessageRecord:
+        """Делает активной ветку через message (ее самое свежее продолжение), возвращает новый лист"""
+        entry = self._entry(message.session_id)
+        self._set_leaf(entry, self._latest_leaf(entry, message.id))
+        leaf = self.messages[self._leaf(entry)]
+        self._notify("update", "branch", self._message_owner(message), leaf)
+        return leaf
+
+    # Экспорт и импорт
+    def iter_message_chunks(self, session_id: str, size: int) -> Iterator[List[MessageRecord]]:
+        """
+        Сообщения сессии порциями по size в порядке seq
+        Архивная сессия читается с диска без загрузки в память. Между порциями
+        хранилище может меняться (генератор используется в потоковом ответе):
+        продолжение ищется по курсору seq
+        """
+        cursor = 0
+        while session_id in self.sessions:
+            entry = self.session_messages.get(session_id)
+            if entry is None:
+                _, fields, _ = self._read_archive(session_id)
+                records = [
+                    MessageRecord(msg_id, session_id, seq, ROLES_BY_VALUE[role], content,
+                                  created_at, updated_at, parent_id)
+                    for msg_id, _, seq, role, content, created_at, updated_at, parent_id in fields
+                    if seq > cursor
+                ]
+                for i in range(0, len(records), size):
+                    yield records[i:i + size]
+                return
+            start = bisect_right(entry.seqs, cursor)
+            chunk = [self.messages[msg_id] for msg_id in entry.ids[start:start + size]]
+            if not chunk:
+                return
+            yield chunk
+            cursor = chunk[-1].seq
+
+    def import_session(self, user_id: str, foreign_id: str, title: str,
+                       created_at: str, updated_at: str) -> Tuple[dict, bool]:
+        """
+        Создает сессию из импорта, возвращает (сессия, создана ли она)
+        Id сохраняется, если свободен; если он занят сессией другого пользователя,
+        используется детерминированный id от пары (пользователь, id) - повторный импорт
+        того же файла попадает в те же сессии
+        """
+        session_id = foreign_id
+        existing = self.sessions.get(session_id)
+        if existing is not None and existing["user_id"] != user_id:
+            session_id = str(uuid5(UUID(user_id), foreign_id))
+            existing = self.sessions.get(session_id)
+        if existing is not None:
+            if existing["user_id"] != user_id:
+                raise ValueError(f"Session id {foreign_id} is not available")
+            return existing, False
+
+        session = {
+            "id": session_id,
+            "user_id": user_id,
+            "title": title,
+            "created_at": created_at,
+            "updated_at": updated_at
+        }
+        self.sessions[session_id] = session
+        self.user_sessions.setdefault(user_id, {})[session_id] = None
+        self.session_messages[session_id] = _SessionMessages(self._access_time(session))
+        self._notify("create", "session", user_id, session)
+        return session, True
+
+    def import_message(self, session_id: str, seq: int, role: MessageRole, content: str, created_at: int,
+                       updated_at: Optional[int] = None,
+                       parent_id: Optional[int] = None) -> Tuple[MessageRecord, bool]:
+        """
+        Добавляет сообщение из импорта с исходным seq, возвращает (сообщение, создано ли оно)
+        Если такой seq в сессии уже есть, возвращается существующее сообщение.
+        parent_id - уже импортированное сообщение той же сессии с меньшим seq;
+        без него родителем считается предыдущее по seq сообщение (линейная история)
+        """
+        entry = self._entry(session_id)
+        i = entry.index_of(seq)
+        if i != -1:
+            return self.messages[entry.ids[i]], False
+        if parent_id is None:
+            i = bisect_left(entry.seqs, seq)
+            parent_id = entry.ids[i - 1] if i else 0
+        elif parent_id:
+            parent = self.messages.get(parent_id)
+            if parent is None or parent.session_id != session_id or parent.seq >= seq:
+                raise ValueError(f"invalid parent for seq {seq}")
+        siblings = self._children(entry, parent_id)
+        message = MessageRecord(self.next_message_id, self.sessions[session_id]["id"], seq, role,
+                                content, created_at, updated_at, parent_id)
+        self.next_message_id += 1
+        entry.insert(seq, message.id, parent_id)
+        self._link(entry, message, siblings)
+        entry.next_seq = max(entry.next_seq, seq + 1)
+        self.messages[message.id] = message
+        self._notify("create", "message", self._message_owner(message), message)
+        message.content = content_codec.pack(content)
+        self.resident_bytes += message_size(message.content)
+        return message, True
+
+    # Холодные сессии
+    def attach_archive(self, archive):
+        """Подключает архив холодных сессий (SessionArchive)"""
+        self.archive = archive
+
+    def _entry(self, session_id: str) -> _SessionMessages:
+        """Сообщения сессии с отметкой обращения; архивная сессия загружается с диска"""
+        entry = self.session_messages.get(session_id)
+        if entry is None:
+            if session_id not in self.archived_sessions:
+                raise KeyError(session_id)
+            return self._reload(session_id)
+        self.session_messages.move_to_end(session_id)
+        entry.last_access = time.time()
+        return entry
+
+    def _read_archive(self, session_id: str) -> Tuple[int, List[tuple], int]:
+        """Архив сессии: (next_seq, кортежи полей сообщений, лист активной ветки)"""
+        return self.archive.read(session_id)
+
+    # Загрузка из архива в два шага: read_archived (чтение, распаковка, сжатие содержимого)
+    # можно выполнять в потоке, install_archived - в цикле событий
+    def read_archived(self, session_id: str) -> Tuple[int, List[MessageRecord], int]:
+        """Архив сессии в виде готовых записей: (next_seq, записи, лист активной ветки)"""
+        next_seq, fields, leaf = self._read_archive(session_id)
+        session_id = self.sessions[session_id]["id"]
+        pack = content_codec.pack
+        records = [
+            MessageRecord(msg_id, session_id, seq, ROLES_BY_VALUE[role], pack(content),
+                          created_at, updated_at, parent_id)
+            for msg_id, _, seq, role, content, created_at, updated_at, parent_id in fields
+        ]
+        return next_seq, records, leaf
+
+    def install_archived(self, session_id: str, archived: Tuple[int, List[MessageRecord], int],
+                         elapsed: float = 0.0) -> _SessionMessages:
+        """Помещает прочитанный архив в память; если сессию уже загрузили параллельно, архив не нужен"""
+        entry = self.session_messages.get(session_id)
+        if entry is not None:
+            return entry
+        if session_id not in self.archived_sessions:
+            raise KeyError(session_id)
+        start = time.perf_counter()
+        next_seq, records, leaf = archived
+        session_id = self.sessions[session_id]["id"]
+
+        entry = _SessionMessages()
+        entry.next_seq = next_seq
+        entry.leaf = leaf
+        messages = self.messages
+        for message in records:
+            messages[message.id] = message
+            entry.seqs.append(message.seq)
+            entry.ids.append(message.id)
+            entry.parents.append(message.parent_id)
+            self.resident_bytes += message_size(message.content)
+        self.archived_messages.remove(session_id, entry.ids)
+        # Файл архива остается на диске: на него может ссылаться последний снимок журнала
+        del self.archived_sessions[session_id]
+        self.session_messages[session_id] = entry
+
+        elapsed += time.perf_counter() - start
+        self.archive_stats["reloads"] += 1
+        self.archive_stats["reload_seconds_total"] += elapsed
+        self.archive_stats["reload_seconds_max"] = max(self.archive_stats["reload_seconds_max"], elapsed)
+        if self.on_reload is not None:
+            self.on_reload(self.sessions[session_id]["user_id"], records)
+        self._check_budget()
+        return entry
+
+    def _reload(self, session_id: str) -> _SessionMessages:
+        start = time.perf_counter()
+        archived = self.read_archived(session_id)
+        return self.install_archived(session_id, archived, time.perf_counter() - start)
+
+    def _check_budget(self):
+        if (self.archive is not None and self.on_over_budget is not None
+                and self.resident_bytes > self.archive.memory_budget):
+            self.on_over_budget()
+
+    # Выгрузка в архив в три шага: prepare_archive и commit_archive - в цикле событий,
+    # write_archive (сериализация, сжатие, запись и fsync) - в потоке
+    def prepare_archive(self, session_id: str) -> Optional[_ArchiveJob]:
+        entry = self.session_messages.get(session_id)
+        if entry is None or self.archive is None:
+            return None
+        return _ArchiveJob(session_id, entry, self.session_versions.get(session_id, 0),
+                           [self.messages[msg_id] for msg_id in entry.ids])
+
+    def write_archive(self, job: _ArchiveJob):
+        fields = [message.as_tuple() for message in job.messages]
+        self.archive.write(job.session_id, job.next_seq, fields, job.leaf)
+
+    def commit_archive(self, job: _ArchiveJob) -> bool:
+        """Выгружает сообщения из памяти, если сессия не менялась и не читалась, пока писался архив"""
+        entry = job.entry
+        if (self.session_messages.get(job.session_id) is not entry
+                or self.session_versions.get(job.session_id, 0) != job.version
+                or entry.last_access != job.last_access):
+            return False
+
+        session_id = self.sessions[job.session_id]["id"]
+        del self.session_messages[session_id]
+        for msg_id in entry.ids:
+            message = self.messages.pop(msg_id)
+            self.resident_bytes -= message_size(message.content)
+        self.archived_messages.add(session_id, entry.ids)
+        self.archived_sessions[session_id] = len(entry.ids)
+        self.archive_stats["archived_total"] += 1
+        return True
+
+    def archive_session(self, session_id: str) -> bool:
+        """Выгружает сообщения сессии в архив синхронно; метаданные сессии остаются в памяти"""
+        job = self.prepare_archive(session_id)
+        if job is None:
+            return False
+        self.write_archive(job)
+        return self.commit_archive(job)
+
+    def idle_sessions(self, limit: Optional[int] = None) -> List[str]:
+        """До limit сессий, простаивающих дольше порога, от самых давних"""
+        if self.archive is None:
+            return []
+        cutoff = time.time() - self.archive.idle_seconds
+        idle = []
+        for session_id, entry in self.session_messages.items():
+            if entry.last_access > cutoff or (limit is not None and len(idle) >= limit):
+                break
+            idle.append(session_id)
+        return idle
+
+    def over_budget_sessions(self) -> List[str]:
+        """Самые давние сессии, выгрузка которых возвращает память сообщений в бюджет"""
+        if self.archive is None:
+            return []
+        excess = self.resident_bytes - self.archive.memory_budget
+        victims = []
+        # Последнюю (только что использованную) сессию не выгружаем даже сверх бюджета
+        for session_id in list(self.session_messages)[:-1]:
+            if excess <= 0:
+                break
+            entry = self.session_messages[session_id]
+            excess -= sum(message_size(self.messages[msg_id].content) for msg_id in entry.ids)
+            victims.append(session_id)
+        return victims
+
+    def enforce_budget(self) -> int:
+        """Синхронно выгружает самые давние сессии, пока память сообщений превышает бюджет"""
+        return sum(self.archive_session(session_id) for session_id in self.over_budget_sessions())
+
+    def archive_idle(self, limit: Optional[int] = None) -> int:
+        """Синхронно выгружает до limit простаивающих сессий и соблюдает бюджет памяти"""
+        archived = sum(self.archive_session(session_id) for session_id in self.idle_sessions(limit))
+        return archived + self.enforce_budget()
+
+    def get_archive_stats(self) -> dict:
+        """Статистика резидентных и архивных сессий"""
+        reloads = self.archive_stats["reloads"]
+        return {
+            "enabled": self.archive is not None,
+            "codec": self.archive.codec if self.archive is not None else None,
+            "resident_sessions": len(self.session_messages),
+            "archived_sessions": len(self.archived_sessions),
+            "resident_messages": len(self.messages),
+            "archived_messages": len(self.archived_messages),
+            "archived_id_ranges": len(self.archived_messages.starts),
+            "resident_bytes": self.resident_bytes,
+            "memory_budget_bytes": self.archive.memory_budget if self.archive is not None else None,
+            "archived_total": self.archive_stats["archived_total"],
+            "reloads": reloads,
+            "reload_ms_avg": round(self.archive_stats["reload_seconds_total"] * 1000 / reloads, 2) if reloads else 0.0,
+            "reload_ms_max": round(self.archive_stats["reload_seconds_max"] * 1000, 2),
+        }
+
+    # Восстановление из журнала: методы не уведомляют подписчиков и идемпотентны
+    def restore_meta(self, id_prefix: int, id_key: int):
+        self.id_prefix = id_prefix
+        self.id_key = id_key
+        self._id_hash = self._make_id_hash(id_key)
+
+    def restore_user(self, user: dict):
+        self.users[user["username"]] = user
+
+    @staticmethod
+    def _access_time(session: dict) -> float:
+        """Время последнего обращения к восстановленной сессии - время ее обновления"""
+        try:
+            return datetime.fromisoformat(session["updated_at"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return time.time()
+
+    def restore_session(self, session: dict, next_seq: int = 1):
+        existing = self.sessions.get(session["id"])
+        if existing is not None:
+            existing.update(session)
+            # Журнал идет в хронологическом порядке, так что порядок LRU восстанавливается сам
+            entry = self.session_messages.get(session["id"])
+            if entry is not None:
+                entry.last_access = self._access_time(existing)
+                self.session_messages.move_to_end(session["id"])
+            return
+        self.sessions[session["id"]] = session
+        self.user_sessions.setdefault(session["user_id"], {})[session["id"]] = None
+        entry = self.session_messages[session["id"]] = _SessionMessages(self._access_time(session))
+        entry.next_seq = next_seq
+
+    def drop_session(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+        # Архив удаленной сессии не загружаем: его может уже не быть на диске,
+        # а оставшиеся диапазоны archived_messages вычищаются лениво
+        count = self.archived_sessions.pop(session_id, None)
+        if count is not None:
+            self._forget_archived(count)
+        else:
+            entry = self.session_messages.pop(session_id)
+            for msg_id in entry.ids:
+                message = self.messages.pop(msg_id, None)
+                if message is not None:
+                    self.resident_bytes -= message_size(message.content)
+        if self.archive is not None:
+            self.archive.delete(session_id)
+        self.user_sessions.get(session["user_id"], {}).pop(session_id, None)
+
+    def _forget_archived(self, count: int):
+        """Учитывает диапазоны удаленной архивной сессии; когда их больше половины, карта перестраивается"""
+        ranges = self.archived_messages
+        ranges.stale += count
+        if ranges.stale * 2 > ranges.count:
+            ranges.prune(self.archived_sessions)
+
+    def _restored_entry(self, session_id: str) -> Optional[_SessionMessages]:
+        """_entry для повтора журнала: архива сессии, удаленной дальше по журналу, на диске уже нет"""
+        if session_id not in self.sessions:
+            return None
+        try:
+            return self._entry(session_id)
+        except FileNotFoundError:
+            return None
+
+    def _restored_message(self, msg_id: int) -> Optional[MessageRecord]:
+        message = self.messages.get(msg_id)
+        if message is None:
+            session_id = self.archived_session(msg_id)
+            if session_id is not None and self._restored_entry(session_id) is not None:
+                message = self.messages.get(msg_id)
+        return message
+
+    def restore_message(self, message: MessageRecord):
+        entry = self._restored_entry(message.session_id)
+        if entry is None:
+            return
+        message.session_id = self.sessions[message.session_id]["id"]
+        existing = self.messages.get(message.id)
+        if existing is None:
+            entry.insert(message.seq, message.id, message.parent_id)
+            entry.invalidate()
+            # Как и при создании, новое сообщение становится листом активной ветки
+            entry.leaf = 0 if entry.ids[-1] == message.id else message.id
+        else:
+            self.resident_bytes -= message_size(existing.content)
+        message.content = content_codec.pack(message.content)
+        self.messages[message.id] = message
+        self.resident_bytes += message_size(message.content)
+        entry.next_seq = max(entry.next_seq, message.seq + 1)
+        self.next_message_id = max(self.next_message_id, message.id + 1)
+
+    def restore_message_content(self, msg_id: int, content: str, updated_at: Optional[int]):
+        message = self._restored_message(msg_id)
+        if message is not None:
+            self.resident_bytes -= message_size(message.content)
+            message.content = content_codec.pack(content)
+            message.updated_at = updated_at
+            self.resident_bytes += message_size(message.content)
+
+    def drop_message(self, msg_id: int):
+        if self._restored_message(msg_id) is None:
+            return
+        message = self.messages.pop(msg_id)
+        self.resident_bytes -= message_size(message.content)
+        entry = self.session_messages[message.session_id]
+        i = entry.index_of(message.seq)
+        if i != -1:
+            entry.remove_at([i])
+            entry.invalidate()
+        # Новый лист, если ветка сменилась, восстановит следующая запись branch
+        if entry.leaf == msg_id:
+            entry.leaf = 0
+
+    def restore_branch(self, msg_id: int):
+        message = self._restored_message(msg_id)
+        if message is not None:
+            entry = self.session_messages[message.session_id]
+            self._set_leaf(entry, msg_id)
+
+    def capture_state(self) -> dict:
+        """
+        Быстрый захват состояния для снимка: копируются только контейнеры,
+        записи сообщений сериализуются позже в фоновом потоке
+        """
+        return {
+            "id_prefix": self.id_prefix,
+            "id_key": self.id_key,
+            "next_message_id": self.next_message_id,
+            "users": [dict(user) for user in self.users.values()],
+            "sessions": [
+                (dict(session), entry.next_seq, entry.leaf) if entry is not None else (dict(session), 1, 0)
+                for session_id, session in self.sessions.items()
+                for entry in (self.session_messages.get(session_id),)
+            ],
+            "messages": list(self.messages.values()),
+            # Сообщения архивных сессий уже лежат на диске, в снимок попадают только ссылки на них
+            "archived_sessions": dict(self.archived_sessions),
+            "archived_messages": self.archived_messages.capture(),
+        }
+
+    def load_state(self, state: dict):
+        """Загружает состояние из снимка; сообщения - кортежи полей MessageRecord"""
+        self.restore_meta(state["id_prefix"], state["id_key"])
+        for user in state["users"]:
+            self.restore_user(user)
+        for session, next_seq, *leaf in state["sessions"]:
+            self.restore_session(session, next_seq)
+            entry = self.session_messages.get(session["id"])
+            if leaf and entry is not None:
+                entry.leaf = leaf[0]
+
+        sessions = self.sessions
+        session_messages = self.session_messages
+        messages = self.messages
+        for session_id, count in state["archived_sessions"].items():
+            session = sessions.get(session_id)
+            if session is not None and session_id in session_messages:
+                del session_messages[session_id]
+                self.archived_sessions[session["id"]] = count
+        ranges = self.archived_messages
+        for start, end, session_id in zip(*state["archived_messages"]):
+            if session_id in self.archived_sessions:
+                ranges.starts.append(start)
+                ranges.ends.append(end)
+                ranges.sessions.append(sessions[session_id]["id"])
+                ranges.count += end - start + 1
+
+        pack = content_codec.pack
+        for msg_id, session_id, seq, role, content, created_at, updated_at, parent_id in state["messages"]:
+            session = sessions.get(session_id)
+            if session is None:
+                continue
+            session_id = session["id"]
+            content = pack(content)
+            messages[msg_id] = MessageRecord(msg_id, session_id, seq, ROLES_BY_VALUE[role],
+                                             content, created_at, updated_at, parent_id)
+            self.resident_bytes += message_size(content)
+            # Сообщения в снимке почти всегда идут по возрастанию seq, поэтому обычно это дозапись
+            session_messages[session_id].insert(seq, msg_id, parent_id)
+        self.next_message_id = max(self.next_message_id, state["next_message_id"])
+        # Порядок LRU: от давно не использованных сессий к недавним
+        self.session_messages = OrderedDict(sorted(session_messages.items(), key=lambda item: item[1].last_access))
+
+
+# Глобальный экземпляр хранилища чатов
+chat_store = ChatStore()
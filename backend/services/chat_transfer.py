@@ -0,0 +1,218 @@
+import json
+import time
+import logging
+from array import array
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+from uuid import UUID, uuid5
+
+from backend.services.chat_store import ChatStore, ROLE_NAMES, MessageRole, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMAT_VERSION = 1
+# Сообщений в одной порции потокового экспорта
+EXPORT_CHUNK_SIZE = 500
+# Подробности хранятся только для первых ошибок импорта
+MAX_REPORTED_ERRORS = 20
+
+
+def _line(record: dict) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def export_history(store: ChatStore, user_id: str) -> Iterator[str]:
+    """
+    История пользователя в формате NDJSON: строка-заголовок, затем каждая сессия
+    и ее сообщения всех веток (parent_id - публичный id родителя), а если активна
+    не самая свежая ветка - строка branch с ее листом. Генератор отдает порции текста
+    и держит в памяти не больше одной порции сообщений (архивная сессия читается
+    целиком, но не загружается в хранилище)
+    """
+    started = time.perf_counter()
+    sessions = messages = size = 0
+
+    header = _line({"type": "export", "version": EXPORT_FORMAT_VERSION, "exported_at": datetime.now().isoformat()})
+    size += len(header)
+    yield header
+
+    for session_id in list(store.user_sessions.get(user_id, ())):
+        session = store.sessions.get(session_id)
+        if session is None:
+            # Сессия удалена, пока шел экспорт
+            continue
+        line = _line({"type": "session", **{key: value for key, value in session.items() if key != "user_id"}})
+        sessions += 1
+        size += len(line)
+        yield line
+
+        for chunk in store.iter_message_chunks(session_id, EXPORT_CHUNK_SIZE):
+            block = "".join(_line({"type": "message", **store.serialize_message(message)}) for message in chunk)
+            messages += len(chunk)
+            size += len(block)
+            yield block
+
+        leaf = store.branch_leaf(session_id) if session_id in store.sessions else 0
+        if leaf:
+            line = _line({"type": "branch", "session_id": session_id, "message_id": store.public_id(leaf)})
+            size += len(line)
+            yield line
+
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Exported {sessions} sessions and {messages} messages ({size / 2 ** 20:.1f} MiB) "
+        f"for user {user_id} in {elapsed:.2f}s"
+    )
+
+
+class ChatImporter:
+    """
+    Импорт истории из NDJSON в формате export_history
+    Строки применяются пакетами; импорт идемпотентен: сессии сохраняют исходный id
+    (или получают детерминированный, см. ChatStore.import_session), а сообщения
+    с уже существующим в сессии seq пропускаются.
+    Сообщения сессии идут сразу за ее строкой, поэтому соответствие исходных id
+    сообщений новым (для parent_id) хранится только для текущей сессии.
+    Созданные сессии и сообщения, добавленные в уже существующие, запоминаются
+    для отката прерванного импорта (rollback)
+    """
+
+    def __init__(self, store: ChatStore, user_id: str):
+        self.store = store
+        self.user_id = user_id
+        # Исходный id сессии -> id в хранилище
+        self.session_map: Dict[str, str] = {}
+        # Исходный id сообщения текущей сессии -> внутренний id в хранилище
+        self.message_map: Dict[str, int] = {}
+        # Созданные импортом сессии и сообщения, добавленные в существующие сессии
+        self.created_sessions: Dict[str, None] = {}
+        self.added_messages = array("Q")
+        self.line_number = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.counts = {
+            "sessions_created": 0,
+            "sessions_existing": 0,
+            "messages_imported": 0,
+            "messages_skipped": 0,
+            "errors": 0,
+        }
+        self.errors: List[str] = []
+
+    def apply(self, lines: List[bytes]):
+        """Применяет пакет строк; ошибочные строки учитываются и пропускаются"""
+        for raw in lines:
+            self.line_number += 1
+            self.bytes += len(raw) + 1
+            if not raw.strip():
+                continue
+            try:
+                self._apply_record(json.loads(raw))
+            except (ValueError, KeyError, TypeError) as e:
+                self.counts["errors"] += 1
+                if len(self.errors) < MAX_REPORTED_ERRORS:
+                    self.errors.append(f"line {self.line_number}: {e}")
+
+    def _apply_record(self, record: dict):
+        kind = record["type"]
+        if kind == "session":
+            self._import_session(record)
+        elif kind == "message":
+            self._import_message(record)
+        elif kind == "branch":
+            self._import_branch(record)
+        elif kind == "export":
+            if record.get("version") != EXPORT_FORMAT_VERSION:
+                raise ValueError(f"unsupported export version {record.get('version')}")
+        else:
+            raise ValueError(f"unknown record type {kind!r}")
+
+    def _import_session(self, record: dict):
+        foreign_id = str(record["id"])
+        try:
+            local_id = str(UUID(foreign_id))
+        except ValueError:
+            local_id = str(uuid5(UUID(self.user_id), foreign_id))
+
+        now = datetime.now().isoformat()
+        created_at = record.get("created_at") or now
+        session, created = self.store.import_session(
+            self.user_id, local_id, str(record.get("title") or "Imported chat"),
+            created_at, record.get("updated_at") or created_at
+        )
+        self.session_map[foreign_id] = session["id"]
+        if created:
+            self.created_sessions[session["id"]] = None
+        self.message_map = {}
+        self.counts["sessions_created" if created else "sessions_existing"] += 1
+
+    def _import_message(self, record: dict):
+        session_id = self.session_map.get(str(record["session_id"]))
+        if session_id is None:
+            raise ValueError(f"message for unknown session {record['session_id']}")
+        seq = int(record["seq"])
+        if seq < 1:
+            raise ValueError(f"invalid seq {seq}")
+        role = MessageRole(ROLE_NAMES.index(record["role"]))
+        content = record["content"]
+        if not isinstance(content, str):
+            raise ValueError("content must be a string")
+
+        # Экспорт без parent_id (до ветвления) - линейная история
+        parent_id: Optional[int] = None
+        if "parent_id" in record:
+            parent_id = 0
+            if record["parent_id"] is not None:
+                parent_id = self.message_map.get(str(record["parent_id"]))
+                if parent_id is None:
+                    raise ValueError(f"unknown parent message {record['parent_id']}")
+
+        updated_at: Optional[int] = parse_timestamp(record["updated_at"]) if record.get("updated_at") else None
+        message, created = self.store.import_message(session_id, seq, role, content,
+                                                     parse_timestamp(record["created_at"]), updated_at, parent_id)
+        if "id" in record:
+            self.message_map[str(record["id"])] = message.id
+        if created and session_id not in self.created_sessions:
+            self.added_messages.append(message.id)
+        self.counts["messages_imported" if created else "messages_skipped"] += 1
+
+    def _import_branch(self, record: dict):
+        msg_id = self.message_map.get(str(record["message_id"]))
+        if msg_id is None or self.session_map.get(str(record["session_id"])) is None:
+            raise ValueError(f"unknown branch message {record['message_id']}")
+        self.store.switch_branch(self.store.find_message(msg_id))
+
+    def rollback(self):
+        """
+        Отменяет уже примененную часть прерванного импорта: удаляет созданные сессии
+        и сообщения, добавленные в существующие (смена активной ветки не откатывается)
+        """
+        messages = 0
+        for msg_id in reversed(self.added_messages):
+            # Сообщение могло уйти вместе с поддеревом ранее удаленного
+            message = self.store.find_message(msg_id)
+            if message is not None:
+                messages += len(self.store.delete_branch(message))
+        sessions = 0
+        for session_id in reversed(list(self.created_sessions)):
+            if session_id in self.store.sessions:
+                messages += len(self.store.delete_session(session_id))
+                sessions += 1
+        logger.warning(f"Import for user {self.user_id} rolled back: "
+                       f"{sessions} sessions and {messages} messages removed")
+        self.created_sessions = {}
+        self.added_messages = array("Q")
+
+    def report(self) -> dict:
+        """Итоги импорта с пропускной способностью"""
+        elapsed = time.perf_counter() - self.started
+        records = self.counts["messages_imported"] + self.counts["messages_skipped"]
+        return {
+            **self.counts,
+            "lines": self.line_number,
+            "bytes": self.bytes,
+            "seconds": round(elapsed, 3),
+            "messages_per_second": round(records / elapsed) if elapsed else 0,
+            "mb_per_second": round(self.bytes / 2 ** 20 / elapsed, 2) if elapsed else 0.0,
+            "error_details": self.errors,
+        }
@@ -1,9 +1,14 @@
+import time
 import asyncio
 import json
 from typing import Dict, List, Optional
 from fastapi import WebSocket, WebSocketDisconnect
 from enum import Enum
 
+from backend.services.rate_limiter import rate_limiter, RateLimitExceeded, estimate_tokens
+from backend.services.metrics import metrics
+from backend.services.tracing import tracer
+
 
 class ConnectionMode(str, Enum):
     DIRECT = "direct"
@@ -26,26 +31,42 @@ class ConnectionManager:
         self.reconnect_delay = int(
             self._get_env_var("RECONNECT_DELAY", "5")
         )
+        # Дедлайн запроса к инференсу по умолчанию (клиент может задать меньший полем timeout)
+        self.inference_timeout = float(
+            self._get_env_var("INFERENCE_TIMEOUT", "30")
+        )
+        # Запас сверх дедлайна на доставку частичного ответа, который инференс отдает в дедлайн
+        self.deadline_grace = float(
+            self._get_env_var("INFERENCE_DEADLINE_GRACE", "1")
+        )
+        self.stats = {
+            "expired": 0,
+        }
     
     def _get_env_var(self, key: str, default: str) -> str:
         """Получает переменную окружения или возвращает значение по умолчанию"""
         import os
         return os.getenv(key, default)
     
-    async def connect(self, websocket: WebSocket, client_id: str):
-        """Подключение нового клиента"""
+    async def connect(self, websocket: WebSocket, client_id: str, user_id: Optional[str] = None,
+                      ip: Optional[str] = None):
+        """Подключение нового клиента (user_id - из JWT, если клиент его передал)"""
         await websocket.accept()
+        if client_id not in self.active_connections:
+            metrics.websocket_connections.inc()
         self.active_connections[client_id] = websocket
         self.client_sessions[client_id] = {
             'connected_at': asyncio.get_event_loop().time(),
             'last_message': None,
-            'session_data': {}
+            'session_data': {},
+            'user_id': user_id,
+            'ip': ip
         }
         
         # Определяем режим подключения для этого клиента
         from backend.config.network_config import NetworkConfig
-        mode = NetworkConfig.get_connection_mode()
-        self.connection_modes[client_id] = ConnectionMode(mode)
+        mode = await asyncio.to_thread(NetworkConfig.get_connection_mode)
+        self._set_mode(client_id, ConnectionMode(mode))
         
         print(f"Client {client_id} connected with mode: {mode}")
     
@@ -53,6 +74,7 @@ class ConnectionManager:
         """Отключение клиента"""
         if client_id in self.active_connections:
             del self.active_connections[client_id]
+            metrics.websocket_connections.dec()
         if client_id in self.connection_modes:
             del self.connection_modes[client_id]
         if client_id in self.client_sessions:
@@ -83,6 +105,13 @@ class ConnectionManager:
         for client_id in disconnected_clients:
             self.disconnect(client_id)
     
+    def _set_mode(self, client_id: str, mode: ConnectionMode):
+        """Меняет режим подключения клиента; смены режима учитываются в метриках"""
+        previous = self.connection_modes.get(client_id)
+        if previous != mode:
+            metrics.network_mode_transitions.labels(previous.value if previous else "none", mode.value).inc()
+        self.connection_modes[client_id] = mode
+    
     def get_connection_mode(self, client_id: str) -> Optional[ConnectionMode]:
         """Получить режим подключения для конкретного клиента"""
         return self.connection_modes.get(client_id)
@@ -92,7 +121,22 @@ class ConnectionManager:
         return self.client_sessions.get(client_id)
     
     async def handle_client_message(self, client_id: str, data: str):
-        """Обработка сообщения от клиента с учетом режима подключения"""
+        """
+        Обработка сообщения от клиента с учетом режима подключения
+        Сообщения из выборки трассировки пишут этапы обработки в лог (заголовков у WebSocket нет)
+        """
+        trace = tracer.start("WS message")
+        if trace is None:
+            await self._handle_client_message(client_id, data)
+            return
+        token = tracer.activate(trace)
+        try:
+            await self._handle_client_message(client_id, data)
+        finally:
+            tracer.deactivate(token)
+            tracer.finish(trace, client_id=client_id, mode=getattr(self.get_connection_mode(client_id), "value", None))
+    
+    async def _handle_client_message(self, client_id: str, data: str):
         try:
             message_data = json.loads(data)
             
@@ -102,16 +146,28 @@ class ConnectionManager:
             
             # Определяем, как обрабатывать сообщение в зависимости от режима
             mode = self.get_connection_mode(client_id)
+            client_session = self.client_sessions.get(client_id, {})
+            user_id = client_session.get('user_id')
+            
+            if mode != ConnectionMode.OFFLINE:
+                # Генерация ограничивается по пользователю и IP так же, как REST-запросы чата
+                with tracer.span("rate_limit"):
+                    await rate_limiter.acquire(user_id, client_session.get('ip'), estimate_tokens(
+                        str(message_data.get('prompt', '')),
+                        int(message_data.get('max_length', rate_limiter.response_tokens)) * int(message_data.get('n', 1))
+                    ))
+            
+            deadline = self._request_deadline(message_data)
             
             if mode == ConnectionMode.OFFLINE:
                 # В оффлайн-режиме обрабатываем локально
                 response = await self._handle_offline_request(message_data)
             elif mode in [ConnectionMode.DIRECT, ConnectionMode.RELAY]:
                 # В других режимах отправляем запрос на inference
-                response = await self._forward_to_inference(message_data, mode)
+                response = await self._forward_to_inference(message_data, mode, user_id, deadline)
             else:
                 # По умолчанию используем relay
-                response = await self._forward_to_inference(message_data, ConnectionMode.RELAY)
+                response = await self._forward_to_inference(message_data, ConnectionMode.RELAY, user_id, deadline)
             
             # Отправляем ответ клиенту
             await self.send_personal_message(json.dumps(response), client_id)
@@ -119,10 +175,24 @@ class ConnectionManager:
         except json.JSONDecodeError:
             error_response = {"error": "Invalid JSON", "type": "parse_error"}
             await self.send_personal_message(json.dumps(error_response), client_id)
+        except RateLimitExceeded as e:
+            error_response = {"error": "Rate limit exceeded", "type": "rate_limited", "retry_after": e.retry_after}
+            await self.send_personal_message(json.dumps(error_response), client_id)
         except Exception as e:
             error_response = {"error": str(e), "type": "processing_error"}
             await self.send_personal_message(json.dumps(error_response), client_id)
     
+    def deadline_after(self, timeout: Optional[float] = None) -> float:
+        """Дедлайн запроса (unix time по часам шлюза): INFERENCE_TIMEOUT или меньший timeout клиента в секундах"""
+        if timeout is None:
+            timeout = self.inference_timeout
+        return time.time() + min(self.inference_timeout, timeout)
+    
+    def _request_deadline(self, message_data: dict) -> float:
+        """Дедлайн запроса: INFERENCE_TIMEOUT или меньший timeout из сообщения клиента"""
+        timeout = message_data.pop('timeout', None)
+        return self.deadline_after(float(timeout) if timeout is not None else None)
+    
     async def _handle_offline_request(self, message_data: dict) -> dict:
         """Обработка запроса в оффлайн-режиме"""
         # В оффлайн-режиме возвращаем предопределенное сообщение или кэшированный ответ
@@ -132,25 +202,82 @@ class ConnectionManager:
             "timestamp": asyncio.get_event_loop().time()
         }
     
-    async def _forward_to_inference(self, message_data: dict, mode: ConnectionMode) -> dict:
-        """Пересылка запроса на инференс-сервер"""
+    async def _forward_to_inference(self, message_data: dict, mode: ConnectionMode,
+                                    user_id: Optional[str] = None, deadline: Optional[float] = None) -> dict:
+        """
+        Пересылка запроса на инференс-сервер
+        user_id передается в заголовке X-User-Id: по нему инференс-сервер делит очередь между пользователями.
+        Дедлайн передается в X-Request-Budget-Ms как оставшееся время в миллисекундах (а не момент
+        времени - часы хостов могут расходиться): просроченный запрос снимается с очереди инференса,
+        а начатая генерация обрывается в срок и возвращает уже готовую часть (finish_reason "deadline")
+        """
         import requests
         from backend.config.network_config import NetworkConfig
         
+        if deadline is None:
+            deadline = time.time() + self.inference_timeout
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            # Клиент уже не ждет ответа (например, дедлайн истек во время переподключений)
+            self.stats["expired"] += 1
+            return {
+                "error": "Request deadline exceeded",
+                "status": "expired",
+                "timestamp": asyncio.get_event_loop().time()
+            }
+        
         try:
             # Получаем endpoint для инференса
-            inference_url = f"{NetworkConfig.get_inference_endpoint()}/generate"
+            with tracer.span("network_mode"):
+                inference_url = f"{await asyncio.to_thread(NetworkConfig.get_inference_endpoint)}/generate"
             
-            # Отправляем запрос на инференс-сервер
-            response = requests.post(
-                inference_url,
-                json=message_data,
-                headers={"Content-Type": "application/json"},
-                timeout=30
-            )
+            headers = {
+                "Content-Type": "application/json",
+                "X-Request-Budget-Ms": str(int(remaining * 1000))
+            }
+            if user_id:
+                headers["X-User-Id"] = user_id
+            trace = tracer.current()
+            if trace is not None:
+                # Инференс-сервер продолжит трассировку и вернет свои этапы в Server-Timing
+                headers["traceparent"] = trace.traceparent()
+            
+            # Отправляем запрос на инференс-сервер (в пуле потоков: цикл событий обслуживает другие соединения)
+            started = time.perf_counter()
+            try:
+                with tracer.span("forward"):
+                    response = await asyncio.to_thread(
+                        requests.post,
+                        inference_url,
+                        json=message_data,
+                        headers=headers,
+                        timeout=remaining + self.deadline_grace
+                    )
+            except requests.exceptions.RequestException as e:
+                metrics.inference_duration.labels(type(e).__name__).observe(time.perf_counter() - started)
+                raise
+            metrics.inference_duration.labels(str(response.status_code)).observe(time.perf_counter() - started)
+            if trace is not None:
+                trace.merge_server_timing(response.headers.get("Server-Timing"), "inference_")
             
             if response.status_code == 200:
                 return response.json()
+            elif response.status_code == 503:
+                # Очередь инференса перегружена: клиенту сообщается, когда повторить
+                return {
+                    "error": "Inference server is overloaded",
+                    "status": "overloaded",
+                    "retry_after": response.json().get("retry_after"),
+                    "timestamp": asyncio.get_event_loop().time()
+                }
+            elif response.status_code == 504:
+                # Дедлайн истек в очереди инференса: модель запрос не обрабатывала
+                self.stats["expired"] += 1
+                return {
+                    "error": "Request deadline exceeded",
+                    "status": "expired",
+                    "timestamp": asyncio.get_event_loop().time()
+                }
             else:
                 return {
                     "error": f"Inference server error: {response.status_code}",
@@ -159,7 +286,14 @@ class ConnectionManager:
                 }
         except requests.exceptions.ConnectionError:
             # Если не можем подключиться, пробуем переподключиться
-            return await self._handle_connection_failure(message_data, mode)
+            return await self._handle_connection_failure(message_data, mode, user_id, deadline)
+        except requests.exceptions.Timeout:
+            self.stats["expired"] += 1
+            return {
+                "error": "Request deadline exceeded",
+                "status": "expired",
+                "timestamp": asyncio.get_event_loop().time()
+            }
         except Exception as e:
             return {
                 "error": f"Request to inference failed: {str(e)}",
@@ -167,7 +301,8 @@ class ConnectionManager:
                 "timestamp": asyncio.get_event_loop().time()
             }
     
-    async def _handle_connection_failure(self, message_data: dict, mode: ConnectionMode) -> dict:
+    async def _handle_connection_failure(self, message_data: dict, mode: ConnectionMode,
+                                         user_id: Optional[str] = None, deadline: Optional[float] = None) -> dict:
         """Обработка сбоя подключения к инференс-серверу"""
         # Увеличиваем счетчик попыток переподключения
         client_id = self._find_client_by_mode(mode)
@@ -176,7 +311,7 @@ class ConnectionManager:
             
             if self.reconnect_attempts[client_id] >= self.max_reconnect_attempts:
                 # Если достигли максимального количества попыток, переходим в оффлайн-режим
-                self.connection_modes[client_id] = ConnectionMode.OFFLINE
+                self._set_mode(client_id, ConnectionMode.OFFLINE)
                 return {
                     "response": "Превышено максимальное количество попыток подключения. Переход в оффлайн-режим.",
                     "status": "offline",
@@ -188,12 +323,12 @@ class ConnectionManager:
                 
                 # Обновляем режим подключения
                 from backend.config.network_config import NetworkConfig
-                new_mode = NetworkConfig.get_connection_mode()
+                new_mode = await asyncio.to_thread(NetworkConfig.get_connection_mode)
                 if client_id:
-                    self.connection_modes[client_id] = ConnectionMode(new_mode)
+                    self._set_mode(client_id, ConnectionMode(new_mode))
                 
                 # Повторяем запрос
-                return await self._forward_to_inference(message_data, ConnectionMode(new_mode))
+                return await self._forward_to_inference(message_data, ConnectionMode(new_mode), user_id, deadline)
         
         return {
             "error": "Connection failure and unable to identify client",
@@ -0,0 +1,274 @@
+import os
+import re
+import time
+import zlib
+import random
+import logging
+import threading
+from collections import Counter
+from typing import List, Optional, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Границы фрагментов для подбора словаря zlib: предложения и строки
+FRAGMENT_RE = re.compile(r"[^.!?\n]+[.!?\n]?")
+# Предельный размер словаря zlib (окно deflate)
+ZLIB_DICT_LIMIT = 32 * 1024
+
+
+def _exact(data: bytes) -> bytes:
+    """
+    Копия результата zstd точного размера: zstandard выделяет буфер под худший случай
+    (ZSTD_compressBound), и для долгоживущих данных этот запас остается занятым
+    """
+    return bytes(memoryview(data))
+
+
+class _Dictionary:
+    """Обученный словарь сжатия; на него ссылаются все упакованные им тексты"""
+
+    __slots__ = ("version", "data", "zstd_dict", "compressor", "local")
+
+    def __init__(self, version: int, data: bytes, level: int):
+        self.version = version
+        self.data = data
+        self.zstd_dict = None
+        self.compressor = None
+        # Декомпрессоры zstd не потокобезопасны, а тексты читает и поток снимков журнала
+        self.local = threading.local()
+        if zstandard is not None:
+            self.zstd_dict = zstandard.ZstdCompressionDict(data)
+            self.compressor = zstandard.ZstdCompressor(level=level, dict_data=self.zstd_dict)
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        if self.compressor is not None:
+            return _exact(self.compressor.compress(data))
+        compressor = zlib.compressobj(level, zdict=self.data)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        if self.zstd_dict is not None:
+            decompressor = getattr(self.local, "decompressor", None)
+            if decompressor is None:
+                decompressor = self.local.decompressor = zstandard.ZstdDecompressor(dict_data=self.zstd_dict)
+            return decompressor.decompress(data)
+        decompressor = zlib.decompressobj(zdict=self.data)
+        return decompressor.decompress(data) + decompressor.flush()
+
+
+class PackedText:
+    """
+    Сжатое содержимое сообщения
+    Начало текста хранится как есть и служит превью, остаток сжат общим словарем.
+    Словарь удерживается ссылкой, поэтому устаревшие словари освобождаются вместе с последним текстом
+    """
+
+    __slots__ = ("head", "data", "dictionary", "length")
+
+    def __init__(self, head: str, data: bytes, dictionary: Optional[_Dictionary], length: int):
+        self.head = head
+        self.data = data
+        self.dictionary = dictionary
+        self.length = length
+
+    def unpack(self) -> str:
+        return self.head + content_codec.decompress(self.data, self.dictionary).decode("utf-8")
+
+
+# Содержимое сообщения в хранилище: строка или сжатый текст
+Content = Union[str, PackedText]
+
+
+class ContentCodec:
+    """
+    Прозрачное сжатие длинных сообщений общим словарем
+    Словарь обучается на выборке недавних длинных сообщений и периодически
+    переобучается в фоновом потоке: zstd (train_dictionary), если установлен пакет
+    zstandard, иначе словарь zlib из самых частых фраз выборки
+    """
+
+    def __init__(self):
+        # 0 отключает сжатие
+        self.min_chars = int(os.getenv('CONTENT_COMPRESSION_MIN_CHARS', '1024'))
+        self.preview_chars = int(os.getenv('CONTENT_PREVIEW_CHARS', '200'))
+        self.level = int(os.getenv('CONTENT_COMPRESSION_LEVEL', '3'))
+        self.dict_size = int(os.getenv('CONTENT_DICT_SIZE', str(64 * 1024)))
+        self.retrain_every = int(os.getenv('CONTENT_DICT_RETRAIN_EVERY', '5000'))
+        self.max_samples = int(os.getenv('CONTENT_DICT_SAMPLES', '1000'))
+
+        self.dictionary: Optional[_Dictionary] = None
+        self.samples: List[bytes] = []
+        self.seen = 0
+        self.packed_since_training = 0
+        self.training_thread: Optional[threading.Thread] = None
+        # Упаковка и распаковка идут и из потоков (архивы, импорт, обучение): счетчики и выборка - под блокировкой
+        self._lock = threading.Lock()
+        self.stats = {
+            "packed": 0,
+            "raw_bytes": 0,
+            "packed_bytes": 0,
+            "unpacked": 0,
+            "unpack_seconds": 0.0,
+            "dictionary_version": 0,
+        }
+
+    @property
+    def codec(self) -> str:
+        return "zstd" if zstandard is not None else "zlib"
+
+    def pack(self, text: str) -> Content:
+        """Сжимает текст длиннее порога, короткие тексты возвращает как есть"""
+        if not self.min_chars or len(text) < self.min_chars:
+            return text
+        raw = text[self.preview_chars:].encode("utf-8")
+        self._add_sample(raw)
+
+        dictionary = self.dictionary
+        if dictionary is not None:
+            data = dictionary.compress(raw, self.level)
+        elif zstandard is not None:
+            data = _exact(zstandard.ZstdCompressor(level=self.level).compress(raw))
+        else:
+            data = zlib.compress(raw, self.level)
+        # Несжимаемый текст хранить упакованным невыгодно
+        if len(data) >= len(raw):
+            return text
+
+        with self._lock:
+            self.stats["packed"] += 1
+            self.stats["raw_bytes"] += len(raw)
+            self.stats["packed_bytes"] += len(data)
+        return PackedText(text[:self.preview_chars], data, dictionary, len(text))
+
+    def decompress(self, data: bytes, dictionary: Optional[_Dictionary]) -> bytes:
+        start = time.perf_counter()
+        if dictionary is not None:
+            raw = dictionary.decompress(data)
+        elif zstandard is not None:
+            raw = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            raw = zlib.decompress(data)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stats["unpacked"] += 1
+            self.stats["unpack_seconds"] += elapsed
+        return raw
+
+    @staticmethod
+    def unpack(content: Content) -> str:
+        """Полный текст сообщения"""
+        return content if content.__class__ is str else content.unpack()
+
+    @staticmethod
+    def preview(content: Content, chars: int) -> str:
+        """Первые chars символов; сжатый текст распаковывается, только если превью длиннее сохраненного начала"""
+        if content.__class__ is str:
+            return content[:chars]
+        if chars <= len(content.head):
+            return content.head[:chars]
+        return content.unpack()[:chars]
+
+    @staticmethod
+    def length(content: Content) -> int:
+        return len(content) if content.__class__ is str else content.length
+
+    @staticmethod
+    def size(content: Content) -> int:
+        """Приблизительный объем памяти, занимаемый содержимым"""
+        if content.__class__ is str:
+            return len(content) if content.isascii() else 2 * len(content)
+        head = content.head
+        # Объект PackedText и заголовок bytes
+        return 96 + len(content.data) + (len(head) if head.isascii() else 2 * len(head))
+
+    # Обучение словаря
+    def _add_sample(self, raw: bytes):
+        """Резервуарная выборка длинных сообщений для обучения словаря"""
+        sample = raw[:4096]
+        with self._lock:
+            self.seen += 1
+            if len(self.samples) < self.max_samples:
+                self.samples.append(sample)
+            else:
+                i = random.randrange(self.seen)
+                if i < self.max_samples:
+                    self.samples[i] = sample
+
+            self.packed_since_training += 1
+            if self.packed_since_training < self.retrain_every or len(self.samples) < 100:
+                return
+        self.retrain()
+
+    def retrain(self) -> bool:
+        """Запускает обучение нового словаря в фоне; False, если обучение уже идет"""
+        with self._lock:
+            if self.training_thread is not None and self.training_thread.is_alive():
+                return False
+            self.packed_since_training = 0
+            self.training_thread = threading.Thread(
+                target=self._train, args=(list(self.samples),), name="content-dict-training", daemon=True
+            )
+            self.training_thread.start()
+        return True
+
+    def _train(self, samples: List[bytes]):
+        try:
+            start = time.perf_counter()
+            if zstandard is not None:
+                data = zstandard.train_dictionary(self.dict_size, samples, level=self.level).as_bytes()
+            else:
+                data = self._build_zlib_dictionary(samples)
+            with self._lock:
+                version = self.stats["dictionary_version"] + 1
+                self.dictionary = _Dictionary(version, data, self.level)
+                self.stats["dictionary_version"] = version
+            logger.info(
+                f"Content dictionary v{version} trained on {len(samples)} samples "
+                f"({len(data)} bytes) in {time.perf_counter() - start:.2f}s"
+            )
+        except Exception as e:
+            logger.error(f"Content dictionary training failed: {e}")
+
+    def _build_zlib_dictionary(self, samples: List[bytes]) -> bytes:
+        """Словарь zlib: повторяющиеся фразы выборки, самые частые - в конце (ближе к данным)"""
+        counts = Counter()
+        for sample in samples:
+            counts.update(set(FRAGMENT_RE.findall(sample.decode("utf-8", errors="ignore"))))
+        fragments = []
+        size = 0
+        for fragment, count in counts.most_common():
+            if count < 2 or size >= min(self.dict_size, ZLIB_DICT_LIMIT):
+                break
+            encoded = fragment.encode("utf-8")
+            fragments.append(encoded)
+            size += len(encoded)
+        fragments.reverse()
+        return b"".join(fragments)[-ZLIB_DICT_LIMIT:]
+
+    def get_stats(self) -> dict:
+        """
+        Счетчики упаковки с запуска: raw_bytes/packed_bytes только растут и включают повторную
+        упаковку при загрузке архивов и импорте, поэтому это объем работы, а не занятая память
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        unpacked = stats["unpacked"]
+        return {
+            "codec": self.codec,
+            "min_chars": self.min_chars,
+            "dictionary_version": stats["dictionary_version"],
+            "packed_messages": stats["packed"],
+            "raw_bytes": stats["raw_bytes"],
+            "packed_bytes": stats["packed_bytes"],
+            "unpacked": unpacked,
+            "unpack_us_avg": round(stats["unpack_seconds"] * 1e6 / unpacked, 2) if unpacked else 0.0,
+        }
+
+
+# Глобальный экземпляр кодека содержимого сообщений
+content_codec = ContentCodec()
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyConflict(Exception):
+    """Ключ идемпотентности уже использован для запроса с другими параметрами"""
+
+
+class _Entry:
+    """Запрос с ключом идемпотентности: future с результатом и срок хранения"""
+
+    __slots__ = ("fingerprint", "future", "expires_at")
+
+    def __init__(self, fingerprint: str, future: asyncio.Future):
+        self.fingerprint = fingerprint
+        self.future = future
+        # Выполняющийся запрос не устаревает; срок отсчитывается от завершения
+        self.expires_at = float("inf")
+
+
+class IdempotencyStore:
+    """
+    Таблица ключей идемпотентности (заголовок Idempotency-Key)
+    Ключи действуют в пределах пользователя. Первый запрос с ключом выполняется,
+    повтор во время выполнения ждет тот же future, повтор после завершения получает
+    сохраненный результат. Неудачные запросы не запоминаются: повтор выполнит их заново.
+    Таблица ограничена по числу ключей и времени хранения результата; выполняющиеся
+    запросы хранятся отдельно и не мешают истечению срока завершенных
+    """
+
+    def __init__(self):
+        self.ttl = float(os.getenv('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+        self.max_keys = int(os.getenv('IDEMPOTENCY_MAX_KEYS', '10000'))
+        # Завершенные запросы в порядке завершения (и истечения срока) и выполняющиеся
+        self.entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self.in_flight: Dict[Tuple[str, str], _Entry] = {}
+        self.stats = {
+            "executed": 0,
+            "replayed": 0,
+            "attached": 0,
+            "conflicts": 0,
+            "evicted": 0,
+        }
+
+    @staticmethod
+    def fingerprint(*parts: Any) -> str:
+        """Отпечаток параметров запроса: повтор с тем же ключом должен совпадать с исходным"""
+        data = json.dumps(parts, ensure_ascii=False, default=str, separators=(",", ":"))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    async def run(self, user_id: str, key: str, fingerprint: str,
+                  handler: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Выполняет handler не больше одного раза на ключ; возвращает (результат, повтор ли это)
+        Бросает IdempotencyConflict, если ключ уже использован с другими параметрами
+        """
+        self._expire()
+        table_key = (user_id, key)
+        entry = self.in_flight.get(table_key) or self.entries.get(table_key)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                self.stats["conflicts"] += 1
+                raise IdempotencyConflict(key)
+            self.stats["replayed" if entry.future.done() else "attached"] += 1
+            try:
+                # shield: отключение клиента-повторителя не должно отменять исходный запрос
+                return await asyncio.shield(entry.future), True
+            except asyncio.CancelledError:
+                if not entry.future.cancelled():
+                    raise
+                # Исходный запрос отменен до результата - выполняем заново
+                return await self.run(user_id, key, fingerprint, handler)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = _Entry(fingerprint, future)
+        self.in_flight[table_key] = entry
+        self._evict()
+        self.stats["executed"] += 1
+        try:
+            result = await handler()
+        except asyncio.CancelledError:
+            self._release(table_key, entry)
+            future.cancel()
+            raise
+        except Exception as e:
+            self._release(table_key, entry)
+            future.set_exception(e)
+            # Ошибку получат ожидающие повторы; без них future не должен жаловаться в лог
+            future.exception()
+            raise
+
+        future.set_result(result)
+        if self.in_flight.get(table_key) is entry:
+            del self.in_flight[table_key]
+            entry.expires_at = time.monotonic() + self.ttl
+            self.entries[table_key] = entry
+        return result, False
+
+    def _release(self, table_key: Tuple[str, str], entry: _Entry):
+        if self.in_flight.get(table_key) is entry:
+            del self.in_flight[table_key]
+
+    def _expire(self):
+        """Удаляет результаты с истекшим сроком; они в начале таблицы"""
+        now = time.monotonic()
+        while self.entries:
+            table_key, entry = next(iter(self.entries.items()))
+            if entry.expires_at > now:
+                break
+            del self.entries[table_key]
+
+    def _evict(self):
+        """Соблюдает ограничение числа ключей, вытесняя самые старые результаты"""
+        while self.entries and len(self.entries) + len(self.in_flight) > self.max_keys:
+            self.entries.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "keys": len(self.entries) + len(self.in_flight),
+            "in_flight": len(self.in_flight),
+            **self.stats,
+        }
+
+
+# Глобальный экземпляр таблицы ключей идемпотентности
+idempotency_store = IdempotencyStore()
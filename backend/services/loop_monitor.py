@@ -0,0 +1,198 @@
+import os
+import sys
+import time
+import ctypes
+import asyncio
+import logging
+import sysconfig
+import threading
+import traceback
+from collections import deque
+from typing import Callable, Deque, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних блокировок с их стеками хранится для /health
+MAX_STALL_REPORTS = 20
+
+# Глубина снимаемого стека: внутренние кадры цикла событий и фреймворка неинтересны
+STACK_LIMIT = 12
+
+# Стандартная библиотека и установленные пакеты: их кадры - не код приложения
+LIBRARY_PATHS = tuple({
+    os.path.realpath(sysconfig.get_path(name)) + os.sep for name in ("stdlib", "platstdlib", "purelib", "platlib")
+})
+ASYNCIO_PATH = os.path.dirname(os.path.realpath(asyncio.__file__)) + os.sep
+
+
+def _is_library(filename: str) -> bool:
+    return filename.startswith("<") or os.path.realpath(filename).startswith(LIBRARY_PATHS)
+
+
+def _application_frame(frame):
+    """
+    Ближайший к вершине стека кадр кода приложения и признак, что выше него (между ним
+    и вершиной) нет кадров asyncio; None, если кадр приложения не найден
+    """
+    in_asyncio = False
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not _is_library(filename):
+            return frame, not in_asyncio
+        if os.path.realpath(filename).startswith(ASYNCIO_PATH):
+            in_asyncio = True
+        frame = frame.f_back
+    return None, False
+
+
+class LoopBlocked(Exception):
+    """Цикл событий был заблокирован дольше LOOP_BLOCK_FAIL_MS (отладочный режим)"""
+
+
+class LoopMonitor:
+    """
+    Сторож цикла событий: задержка цикла и синхронные вызовы, которые его блокируют
+    Задача в цикле просыпается каждые LOOP_MONITOR_INTERVAL секунд; опоздание
+    пробуждения - задержка цикла (метрика). Отдельный поток следит за этими
+    пробуждениями: если цикл не отвечает дольше LOOP_LAG_THRESHOLD_MS, поток снимает
+    стек потока цикла - в нем видно блокирующий вызов (requests.post, psutil, генерация
+    модели) - и пишет его в лог. В отладочном режиме (LOOP_BLOCK_FAIL_MS > 0) в
+    заблокировавший цикл код дополнительно бросается LoopBlocked: обработчик завершается
+    ошибкой, и тест, который его вызвал, падает
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv('LOOP_MONITOR_ENABLED', 'true').lower() == 'true'
+        self.interval = float(os.getenv('LOOP_MONITOR_INTERVAL', '0.05'))
+        self.threshold = float(os.getenv('LOOP_LAG_THRESHOLD_MS', '100')) / 1000
+        self.fail_after = float(os.getenv('LOOP_BLOCK_FAIL_MS', '0')) / 1000
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls: Deque[dict] = deque(maxlen=MAX_STALL_REPORTS)
+        self.stats = {
+            "stalls": 0,
+            "failed_handlers": 0,
+        }
+        self.loop_thread_id: Optional[int] = None
+        # Время последнего пробуждения задачи замера (monotonic); читается потоком-сторожем
+        self.heartbeat = 0.0
+        self.observe: Optional[Callable[[float], None]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self, observe: Optional[Callable[[float], None]] = None):
+        """Запуск из цикла событий (в startup); observe получает каждое измерение задержки"""
+        if not self.enabled or self._task is not None:
+            return
+        self.observe = observe
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._measure())
+        self._thread = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        self._stopped.set()
+        self._thread.join(timeout=1)
+        self._thread = None
+
+    async def _measure(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.heartbeat = now
+            self.lag = max(0.0, now - expected)
+            self.max_lag = max(self.max_lag, self.lag)
+            if self.observe is not None:
+                self.observe(self.lag)
+
+    def _watch(self):
+        """Поток-сторож: стек и (в отладочном режиме) исключение для заблокированного цикла"""
+        # Пробуждение, после которого уже снят стек / брошено исключение: одна блокировка - один отчет
+        reported = None
+        failed = None
+        check_every = min(self.threshold, self.fail_after or self.threshold) / 4
+        while not self._stopped.wait(check_every):
+            beat = self.heartbeat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold:
+                continue
+            if reported != beat:
+                reported = beat
+                self._report(blocked)
+            if self.fail_after and blocked >= self.fail_after and failed != beat:
+                failed = beat
+                self._fail(blocked, beat)
+
+    def _report(self, blocked: float):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+        stack = traceback.extract_stack(frame, limit=STACK_LIMIT)
+        # В отчет - вызов из кода приложения, а не кадр внутри библиотеки (socket, ssl, psutil)
+        app_frame, _ = _application_frame(frame)
+        if app_frame is not None:
+            location = f"{app_frame.f_code.co_filename}:{app_frame.f_lineno} in {app_frame.f_code.co_name}"
+        else:
+            location = f"{stack[-1].filename}:{stack[-1].lineno} in {stack[-1].name}"
+        self.stats["stalls"] += 1
+        self.stalls.append({
+            "blocked_ms": round(blocked * 1000, 1),
+            "timestamp": time.time(),
+            "frame": location,
+            "stack": "".join(stack.format()),
+        })
+        logger.warning(f"Event loop blocked for over {blocked * 1000:.0f} ms, loop thread stack:\n"
+                       f"{''.join(stack.format())}")
+
+    def _blocked_in_application(self, beat: float) -> bool:
+        """Цикл все еще стоит на том же пробуждении, и вершина стека - код приложения, а не asyncio"""
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None or self.heartbeat != beat:
+            return False
+        app_frame, outside_asyncio = _application_frame(frame)
+        return app_frame is not None and outside_asyncio
+
+    def _fail(self, blocked: float, beat: float):
+        """
+        Бросает LoopBlocked в поток цикла: исключение возникнет, когда блокирующий вызов вернет управление
+        Асинхронное исключение возникает в том коде, который поток выполнит следующим, поэтому
+        оно бросается, только пока блокирует код приложения (стек до него без кадров asyncio),
+        и снимается, если цикл успел продолжить работу - иначе оно могло бы сломать сам цикл
+        """
+        if not self._blocked_in_application(beat):
+            logger.error(f"Event loop blocked for over {blocked * 1000:.0f} ms outside application code, "
+                         f"LoopBlocked not raised")
+            return
+        thread_id = ctypes.c_ulong(self.loop_thread_id)
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, ctypes.py_object(LoopBlocked))
+        if not self._blocked_in_application(beat):
+            # Цикл продолжил работу между проверкой и выставлением исключения
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(thread_id, None)
+            return
+        self.stats["failed_handlers"] += 1
+        logger.error(f"Event loop blocked for over {blocked * 1000:.0f} ms, "
+                     f"raising LoopBlocked in the blocking handler")
+
+    def get_stats(self) -> dict:
+        last = self.stalls[-1] if self.stalls else None
+        return {
+            "enabled": self.enabled,
+            "lag_seconds": round(self.lag, 4),
+            "max_lag_seconds": round(self.max_lag, 4),
+            "threshold_ms": self.threshold * 1000,
+            "fail_after_ms": self.fail_after * 1000 or None,
+            **self.stats,
+            "last_stall": {key: last[key] for key in ("blocked_ms", "timestamp", "frame")} if last else None,
+        }
+
+
+# Глобальный экземпляр сторожа цикла событий
+loop_monitor = LoopMonitor()
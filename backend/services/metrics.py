@@ -0,0 +1,142 @@
+import os
+import time
+import logging
+from typing import Callable, Dict, Iterator, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм задержки HTTP-запросов (секунды)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Маршрут запросов, не совпавших ни с одним эндпоинтом: путь в метку не попадает
+UNMATCHED_ROUTE = "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware: задержка и число HTTP-запросов по шаблону маршрута
+    Метка route - шаблон пути ("/api/sessions/{session_id}"), а не сам путь, чтобы число
+    рядов не росло с числом сессий. Запись - несколько микросекунд на запрос
+    """
+
+    def __init__(self, app, metrics: "GatewayMetrics"):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", UNMATCHED_ROUTE)
+            method = scope["method"]
+            self.metrics.request_duration.labels(method, path).observe(time.perf_counter() - start)
+            self.metrics.requests.labels(method, path, str(status)).inc()
+
+
+class _StatsCollector:
+    """
+    Счетчики из статистики сервисов (get_stats), считываемые в момент опроса /metrics
+    Горячий путь сервисов при этом не меняется
+    """
+
+    def __init__(self, sources: Dict[str, Tuple[Callable[[], dict], Dict[str, str]]]):
+        # Префикс метрики -> (функция статистики, {ключ статистики: "counter" | "gauge"})
+        self.sources = sources
+
+    def describe(self) -> Iterator:
+        """Имена метрик для регистрации: без describe реестр вызвал бы collect, а с ним и get_stats"""
+        for prefix, (_, fields) in self.sources.items():
+            for field, kind in fields.items():
+                family = CounterMetricFamily if kind == "counter" else GaugeMetricFamily
+                yield family(f"{prefix}_{field}", f"{prefix} {field}")
+
+    def collect(self) -> Iterator:
+        for prefix, (get_stats, fields) in self.sources.items():
+            try:
+                stats = get_stats()
+            except Exception as e:
+                logger.warning(f"Failed to collect {prefix} stats: {e}")
+                continue
+            for field, kind in fields.items():
+                value = stats.get(field)
+                if value is None:
+                    continue
+                name = f"{prefix}_{field}"
+                if kind == "counter":
+                    yield CounterMetricFamily(name, f"{prefix} {field}", value=value)
+                else:
+                    yield GaugeMetricFamily(name, f"{prefix} {field}", value=value)
+
+
+class GatewayMetrics:
+    """
+    Метрики шлюза в формате Prometheus (GET /metrics)
+    Задержка запросов по маршрутам, активные WebSocket-соединения, смены сетевого режима,
+    запросы к инференсу, задержка цикла событий, а также попадания в кэши и лимиты из статистики сервисов.
+    При нескольких воркерах задайте PROMETHEUS_MULTIPROC_DIR: метрики воркеров суммируются
+    """
+
+    def __init__(self):
+        self.registry = REGISTRY
+        self.multiprocess_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+        self.stats_collectors = []
+
+        self.request_duration = Histogram(
+            "gateway_http_request_duration_seconds", "HTTP request latency by route",
+            ["method", "route"], buckets=LATENCY_BUCKETS
+        )
+        self.requests = Counter(
+            "gateway_http_requests", "HTTP requests by route and status", ["method", "route", "status"]
+        )
+        self.websocket_connections = Gauge(
+            "gateway_websocket_connections", "Active WebSocket connections", multiprocess_mode="livesum"
+        )
+        self.network_mode_transitions = Counter(
+            "gateway_network_mode_transitions", "Client connection mode changes", ["from_mode", "to_mode"]
+        )
+        self.inference_duration = Histogram(
+            "gateway_inference_request_duration_seconds", "Requests forwarded to the inference server",
+            ["status"], buckets=LATENCY_BUCKETS
+        )
+        self.event_loop_lag = Histogram(
+            "gateway_event_loop_lag_seconds", "Event loop wake-up delay", buckets=LATENCY_BUCKETS
+        )
+
+    def register_stats(self, sources: Dict[str, Tuple[Callable[[], dict], Dict[str, str]]]):
+        """Подключает статистику сервисов, считываемую при опросе (в режиме нескольких воркеров - отвечающего)"""
+        collector = _StatsCollector(sources)
+        self.stats_collectors.append(collector)
+        self.registry.register(collector)
+
+    def render(self) -> Tuple[bytes, str]:
+        """Текст ответа /metrics и его Content-Type"""
+        if self.multiprocess_dir:
+            from prometheus_client import multiprocess
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            for collector in self.stats_collectors:
+                registry.register(collector)
+            return generate_latest(registry), CONTENT_TYPE_LATEST
+        return generate_latest(self.registry), CONTENT_TYPE_LATEST
+
+
+# Глобальный экземпляр метрик шлюза
+metrics = GatewayMetrics()
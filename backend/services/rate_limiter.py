@@ -0,0 +1,201 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from starlette.requests import HTTPConnection
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+# Средняя длина токена в символах для оценки стоимости запроса
+CHARS_PER_TOKEN = 4
+
+# Проверка и списание всех корзин запроса одной атомарной операцией на стороне Redis
+# KEYS - корзины; ARGV - тройки (скорость в секунду, емкость, списание) для каждой
+_REDIS_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[3 * i - 2])
+  local capacity = tonumber(ARGV[3 * i - 1])
+  local cost = tonumber(ARGV[3 * i])
+  local state = redis.call('HMGET', key, 'level', 'updated')
+  local level = tonumber(state[1]) or capacity
+  local updated = tonumber(state[2]) or now
+  level = math.min(capacity, level + (now - updated) * rate)
+  levels[i] = level
+  if level < cost then
+    wait = math.max(wait, (cost - level) / rate)
+  end
+end
+if wait > 0 then
+  return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[3 * i - 2])
+  local capacity = tonumber(ARGV[3 * i - 1])
+  redis.call('HSET', key, 'level', levels[i] - tonumber(ARGV[3 * i]), 'updated', now)
+  redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000))
+end
+return '0'
+"""
+
+
+class RateLimitExceeded(Exception):
+    """Лимит исчерпан; retry_after - через сколько секунд запрос пройдет"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def estimate_tokens(prompt: str, max_new_tokens: int) -> int:
+    """Оценка стоимости генерации в токенах: промпт и ожидаемый ответ"""
+    return len(prompt) // CHARS_PER_TOKEN + max_new_tokens
+
+
+def client_ip(connection: HTTPConnection) -> str:
+    """IP клиента; за nginx (RATE_LIMIT_TRUST_PROXY=true) - из заголовка X-Real-IP"""
+    if rate_limiter.trust_proxy:
+        real_ip = connection.headers.get("x-real-ip")
+        if real_ip:
+            return real_ip
+    return connection.client.host if connection.client else "unknown"
+
+
+class RateLimiter:
+    """
+    Ограничение частоты генераций на шлюзе: корзины токенов по пользователю и по IP
+    Каждый запрос списывает единицу из корзины запросов и оценку числа токенов из
+    корзины токенов; корзины пополняются непрерывно (лимит в минуту). Запрос проходит,
+    только если хватает во всех его корзинах, иначе ничего не списывается.
+    Состояние хранится в памяти процесса; при нескольких воркерах шлюза - общее в Redis
+    (RATE_LIMIT_REDIS_URL, нужен пакет redis). Простаивающая корзина полна и неотличима
+    от отсутствующей, поэтому удаляется при очередной проверке (в Redis - по PEXPIRE)
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+        self.trust_proxy = os.getenv('RATE_LIMIT_TRUST_PROXY', 'false').lower() == 'true'
+        self.response_tokens = int(os.getenv('RATE_LIMIT_RESPONSE_TOKENS', '256'))
+        # Вид корзины -> (пополнение в секунду, емкость)
+        self.limits: Dict[str, Tuple[float, float]] = {
+            "user_requests": self._limit('RATE_LIMIT_USER_REQUESTS_PER_MINUTE', 20, 'RATE_LIMIT_USER_REQUEST_BURST', 5),
+            "user_tokens": self._limit('RATE_LIMIT_USER_TOKENS_PER_MINUTE', 20000),
+            "ip_requests": self._limit('RATE_LIMIT_IP_REQUESTS_PER_MINUTE', 60, 'RATE_LIMIT_IP_REQUEST_BURST', 15),
+            "ip_tokens": self._limit('RATE_LIMIT_IP_TOKENS_PER_MINUTE', 60000),
+        }
+        # (вид, ключ) -> [уровень, время обновления]; порядок - по времени обновления
+        self.buckets: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+        self.redis = None
+        self.redis_script = None
+        redis_url = os.getenv('RATE_LIMIT_REDIS_URL')
+        if redis_url:
+            if aioredis is None:
+                logger.warning("RATE_LIMIT_REDIS_URL is set but the redis package is not installed, "
+                               "rate limits are per process")
+            else:
+                self.redis = aioredis.from_url(redis_url)
+                self.redis_script = self.redis.register_script(_REDIS_SCRIPT)
+        self.stats = {
+            "allowed": 0,
+            "limited": 0,
+            "redis_errors": 0,
+        }
+
+    @staticmethod
+    def _limit(per_minute_var: str, per_minute: float, burst_var: Optional[str] = None,
+               burst: Optional[float] = None) -> Tuple[float, float]:
+        """Лимит в минуту и емкость корзины (по умолчанию - минутный лимит)"""
+        rate = float(os.getenv(per_minute_var, str(per_minute)))
+        capacity = float(os.getenv(burst_var, str(burst))) if burst_var else rate
+        return rate / 60, capacity
+
+    async def acquire(self, user_id: Optional[str], ip: Optional[str], tokens: int):
+        """Списывает запрос и tokens из корзин пользователя и IP или бросает RateLimitExceeded"""
+        if not self.enabled:
+            return
+        charges: List[Tuple[str, str, float]] = []
+        if user_id:
+            charges += [("user_requests", user_id, 1), ("user_tokens", user_id, tokens)]
+        if ip:
+            charges += [("ip_requests", ip, 1), ("ip_tokens", ip, tokens)]
+
+        wait = None
+        if self.redis is not None:
+            wait = await self._acquire_redis(charges)
+        if wait is None:
+            wait = self._acquire_local(charges)
+
+        if wait > 0:
+            self.stats["limited"] += 1
+            raise RateLimitExceeded(wait)
+        self.stats["allowed"] += 1
+
+    def _acquire_local(self, charges: List[Tuple[str, str, float]]) -> float:
+        now = time.monotonic()
+        self._expire(now)
+        levels = []
+        wait = 0.0
+        for kind, key, cost in charges:
+            rate, capacity = self.limits[kind]
+            # Запрос дороже емкости корзины не прошел бы никогда
+            cost = min(cost, capacity)
+            bucket = self.buckets.get((kind, key))
+            level = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            levels.append((level, cost))
+            if level < cost:
+                wait = max(wait, (cost - level) / rate)
+        if wait > 0:
+            return wait
+
+        for (kind, key, _), (level, cost) in zip(charges, levels):
+            bucket_key = (kind, key)
+            self.buckets[bucket_key] = [level - cost, now]
+            self.buckets.move_to_end(bucket_key)
+        return 0.0
+
+    def _expire(self, now: float):
+        """Удаляет корзины, которые успели наполниться с последнего обновления; они в начале"""
+        while self.buckets:
+            (kind, _), (level, updated) = next(iter(self.buckets.items()))
+            rate, capacity = self.limits[kind]
+            if level + (now - updated) * rate < capacity:
+                break
+            self.buckets.popitem(last=False)
+
+    async def _acquire_redis(self, charges: List[Tuple[str, str, float]]) -> Optional[float]:
+        """Проверка в Redis; None - Redis недоступен, используются корзины процесса"""
+        keys = []
+        args = []
+        for kind, key, cost in charges:
+            rate, capacity = self.limits[kind]
+            keys.append(f"ratelimit:{kind}:{key}")
+            args += [rate, capacity, min(cost, capacity)]
+        try:
+            return float(await self.redis_script(keys=keys, args=args))
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Rate limit check in Redis failed, using local buckets: {e}")
+            return None
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "backend": "redis" if self.redis is not None else "memory",
+            "local_buckets": len(self.buckets),
+            "limits_per_minute": {kind: round(rate * 60, 2) for kind, (rate, _) in self.limits.items()},
+            **self.stats,
+        }
+
+
+# Глобальный экземпляр ограничителя частоты запросов
+rate_limiter = RateLimiter()
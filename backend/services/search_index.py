@@ -0,0 +1,488 @@
+import re
+import math
+import heapq
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from backend.services.chat_store import MessageRecord
+
+
+# Токены: последовательности латинских/кириллических букв и цифр длиной от двух символов
+TOKEN_RE = re.compile(r"[0-9a-zа-яё]{2,}")
+
+# Параметры BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Списки вхождений длиннее порога дополнительно разбиты на группы по частоте термина и
+# классу длины документа: верхняя граница score документов группы почти точна
+GROUP_MIN_POSTINGS = 1024
+# Частоты от этой и выше попадают в одну группу
+MAX_GROUP_FREQUENCY = 4
+# Компактификация нужна, когда удаленных документов больше порога и больше, чем живых
+COMPACT_MIN_DELETED = 1024
+
+
+def tokenize(text: str) -> List[str]:
+    """Разбивает текст на нормализованные токены (латиница и кириллица)"""
+    return TOKEN_RE.findall(text.casefold().replace("ё", "е"))
+
+
+def _length_class(length: int) -> int:
+    """Класс длины документа: границы классов растут в sqrt(2) раз"""
+    bits = length.bit_length()
+    return length if bits <= 1 else (bits << 1) | ((length >> (bits - 2)) & 1)
+
+
+class _Group:
+    """Вхождения термина с близкими частотой и длиной документа; границы - для верхней оценки score"""
+
+    __slots__ = ("docs", "max_freq", "min_length")
+
+    def __init__(self, frequency: int, length: int):
+        self.docs = array("I")
+        self.max_freq = frequency
+        self.min_length = length
+
+
+class _Postings:
+    """
+    Компактный список вхождений термина: id документов (по возрастанию) и частоты в массивах
+    df - число живых документов с термином; groups - те же вхождения, разбитые по частоте
+    и классу длины документа (только для списков от GROUP_MIN_POSTINGS вхождений)
+    """
+
+    __slots__ = ("docs", "freqs", "df", "groups")
+
+    def __init__(self):
+        self.docs = array("I")
+        self.freqs = array("H")
+        self.df = 0
+        self.groups: Optional[Dict[Tuple[int, int], _Group]] = None
+
+    def append(self, doc: int, frequency: int, doc_lengths: array):
+        self.docs.append(doc)
+        self.freqs.append(frequency)
+        self.df += 1
+        if self.groups is not None:
+            self._group(doc, frequency, doc_lengths[doc])
+        elif len(self.docs) == GROUP_MIN_POSTINGS:
+            self.groups = {}
+            for doc, frequency in zip(self.docs, self.freqs):
+                # Длина удаленного документа - 0: в группы он не попадает
+                if doc_lengths[doc]:
+                    self._group(doc, frequency, doc_lengths[doc])
+
+    def _group(self, doc: int, frequency: int, length: int):
+        key = (min(frequency, MAX_GROUP_FREQUENCY), _length_class(length))
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = _Group(frequency, length)
+        group.docs.append(doc)
+        if frequency > group.max_freq:
+            group.max_freq = frequency
+        if length < group.min_length:
+            group.min_length = length
+
+    def limits(self, doc_lengths: array) -> Tuple[int, int]:
+        """Максимальная частота и минимальная длина живого документа по всему списку"""
+        lengths = [length for length in map(doc_lengths.__getitem__, self.docs) if length]
+        return max(self.freqs), min(lengths, default=1)
+
+    def frequency(self, doc: int) -> int:
+        i = bisect_left(self.docs, doc)
+        if i < len(self.docs) and self.docs[i] == doc:
+            return self.freqs[i]
+        return 0
+
+
+class _CompactionJob:
+    """
+    Компактификация индекса пользователя: состояние на момент подготовки и результат перестройки
+    Списки вхождений и терминов документов только дописываются, поэтому поток читает их
+    без копирования, ограничиваясь документами, которые были на момент подготовки
+    """
+
+    __slots__ = ("index", "doc_keys", "doc_lengths", "doc_offsets", "doc_postings", "postings", "result")
+
+    def __init__(self, index: "_UserIndex"):
+        self.index = index
+        self.doc_keys = list(index.doc_keys)
+        self.doc_lengths = array("I", index.doc_lengths)
+        self.doc_offsets = index.doc_offsets
+        self.doc_postings = index.doc_postings
+        self.postings = list(index.postings.items())
+        self.result = None
+
+    def run(self):
+        """Перестраивает индекс без удаленных документов; выполняется в потоке и не меняет сам индекс"""
+        doc_keys = self.doc_keys
+        count = len(doc_keys)
+        remap = array("I", bytes(4 * count))
+        doc_ids: Dict[int, int] = {}
+        live_keys: List[Optional[int]] = []
+        live_lengths = array("I")
+        for doc, key in enumerate(doc_keys):
+            if key is None:
+                continue
+            remap[doc] = doc_ids[key] = len(live_keys)
+            live_keys.append(key)
+            live_lengths.append(self.doc_lengths[doc])
+
+        postings: Dict[str, _Postings] = {}
+        replaced: Dict[int, _Postings] = {}
+        for token, old in self.postings:
+            # Документы, добавленные после подготовки, повторит commit_compaction
+            end = bisect_left(old.docs, count)
+            compacted = _Postings()
+            for doc, frequency in zip(old.docs[:end], old.freqs[:end]):
+                if doc_keys[doc] is not None:
+                    compacted.append(remap[doc], frequency, live_lengths)
+            if compacted.df:
+                postings[token] = compacted
+                replaced[id(old)] = compacted
+
+        doc_offsets = array("I", [0])
+        doc_postings: List[_Postings] = []
+        for doc, key in enumerate(doc_keys):
+            if key is None:
+                continue
+            terms = self.doc_postings[self.doc_offsets[doc]:self.doc_offsets[doc + 1]]
+            doc_postings.extend(replaced[id(term)] for term in terms)
+            doc_offsets.append(len(doc_postings))
+
+        self.result = (doc_ids, live_keys, live_lengths, doc_offsets, doc_postings, postings, sum(live_lengths))
+
+
+class _UserIndex:
+    """
+    Инвертированный индекс сообщений одного пользователя
+    Поиск - top-k с ранней остановкой: группы вхождений перебираются по убыванию верхней
+    границы score, и перебор заканчивается, когда граница следующей группы не выше k-го
+    лучшего результата. Границы считаются при запросе из максимальной частоты и минимальной
+    длины документа группы, поэтому остаются верными при изменении средней длины документа
+    и idf. Удаленные документы помечаются и вычищаются компактификацией
+    """
+
+    def __init__(self):
+        self.doc_ids: Dict[int, int] = {}
+        self.doc_keys: List[Optional[int]] = []
+        self.doc_lengths = array("I")
+        # Термины документа (для df при удалении): doc_postings[doc_offsets[doc]:doc_offsets[doc + 1]]
+        self.doc_offsets = array("I", [0])
+        self.doc_postings: List[_Postings] = []
+        self.postings: Dict[str, _Postings] = {}
+        self.total_length = 0
+        self.removed_docs: Set[int] = set()
+        # Изменения во время фоновой компактификации: повторяются на ее результате (None - ее нет)
+        self.compaction_log: Optional[List[Tuple[int, Optional[Counter]]]] = None
+
+    @property
+    def deleted(self) -> int:
+        return len(self.removed_docs)
+
+    @property
+    def live_docs(self) -> int:
+        return len(self.doc_keys) - self.deleted
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self.deleted > COMPACT_MIN_DELETED and self.deleted > self.live_docs
+
+    def add(self, message_id: int, text: str):
+        """Добавляет документ; id документов растут монотонно, поэтому списки остаются отсортированными"""
+        self._add(message_id, Counter(tokenize(text)))
+
+    def _add(self, message_id: int, frequencies: Counter):
+        # Сообщение уже в индексе: сессию повторно загрузили из архива
+        if message_id in self.doc_ids:
+            return
+        if self.compaction_log is not None:
+            self.compaction_log.append((message_id, frequencies))
+
+        doc = len(self.doc_keys)
+        length = sum(frequencies.values())
+        self.doc_ids[message_id] = doc
+        self.doc_keys.append(message_id)
+        self.doc_lengths.append(length)
+        self.total_length += length
+
+        for token, frequency in frequencies.items():
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = _Postings()
+            postings.append(doc, min(frequency, 0xFFFF), self.doc_lengths)
+            self.doc_postings.append(postings)
+        self.doc_offsets.append(len(self.doc_postings))
+
+    def remove(self, message_id: int) -> bool:
+        """Помечает документ удаленным; вхождения вычищаются при компактификации"""
+        doc = self.doc_ids.pop(message_id, None)
+        if doc is None:
+            return False
+        if self.compaction_log is not None:
+            self.compaction_log.append((message_id, None))
+
+        self.doc_keys[doc] = None
+        self.total_length -= self.doc_lengths[doc]
+        self.doc_lengths[doc] = 0
+        self.removed_docs.add(doc)
+        for postings in self.doc_postings[self.doc_offsets[doc]:self.doc_offsets[doc + 1]]:
+            postings.df -= 1
+        return True
+
+    # Компактификация в три шага: prepare_compaction и commit_compaction - в цикле событий,
+    # перестройка (_CompactionJob.run) - в потоке
+    def prepare_compaction(self) -> Optional[_CompactionJob]:
+        """None, если компактификация уже выполняется"""
+        if self.compaction_log is not None:
+            return None
+        self.compaction_log = []
+        return _CompactionJob(self)
+
+    def commit_compaction(self, job: _CompactionJob):
+        """Подменяет индекс перестроенным и повторяет на нем изменения, сделанные во время перестройки"""
+        (self.doc_ids, self.doc_keys, self.doc_lengths, self.doc_offsets,
+         self.doc_postings, self.postings, self.total_length) = job.result
+        self.removed_docs = set()
+        log, self.compaction_log = self.compaction_log, None
+        for message_id, frequencies in log:
+            if frequencies is None:
+                self.remove(message_id)
+            else:
+                self._add(message_id, frequencies)
+
+    def abort_compaction(self):
+        self.compaction_log = None
+
+    def compact(self):
+        """Перенумеровывает живые документы подряд и перестраивает списки вхождений без удаленных"""
+        job = self.prepare_compaction()
+        if job is not None:
+            job.run()
+            self.commit_compaction(job)
+
+    def search(self, terms: List[str], top: int) -> Tuple[int, List[Tuple[int, float]]]:
+        """Ранжирует документы по BM25, возвращает число совпадений и top лучших"""
+        live = self.live_docs
+        if not live:
+            return 0, []
+
+        query: List[Tuple[_Postings, float]] = []
+        for term in dict.fromkeys(terms):
+            postings = self.postings.get(term)
+            if postings is not None and postings.df:
+                idf = math.log(1 + (live - postings.df + 0.5) / (postings.df + 0.5))
+                query.append((postings, idf))
+        if not query:
+            return 0, []
+
+        avg_length = self.total_length / live or 1.0
+        norm_base = BM25_K1 * (1 - BM25_B)
+        norm_scale = BM25_K1 * BM25_B / avg_length
+        gain = BM25_K1 + 1
+        doc_keys = self.doc_keys
+        doc_lengths = self.doc_lengths
+
+        def upper(idf: float, frequency: int, length: int) -> float:
+            return idf * frequency * gain / (frequency + norm_base + norm_scale * length)
+
+        # Пик частоты термина и число еще не просмотренных групп в каждом классе длины
+        # (класс None - короткий список целиком)
+        peaks: List[Dict[Optional[int], int]] = []
+        pending: List[Counter] = []
+        for postings, _ in query:
+            if postings.groups is None:
+                peaks.append({None: max(postings.freqs)})
+                pending.append(Counter({None: 1}))
+                continue
+            by_class: Dict[Optional[int], int] = {}
+            for (_, length_class), group in postings.groups.items():
+                by_class[length_class] = max(by_class.get(length_class, 0), group.max_freq)
+            peaks.append(by_class)
+            pending.append(Counter(length_class for _, length_class in postings.groups))
+
+        def rest(term: int, length_class: Optional[int], length: int) -> float:
+            """
+            Граница вклада остальных терминов для еще не оцененного документа класса длины
+            length_class: документы с термином из уже просмотренных групп оценены целиком
+            """
+            bound = 0.0
+            for other, (postings, idf) in enumerate(query):
+                if other == term:
+                    continue
+                waiting = pending[other]
+                if postings.groups is None:
+                    frequency = peaks[other][None] if waiting[None] else 0
+                elif length_class is None:
+                    frequency = max((peak for key, peak in peaks[other].items() if waiting[key]), default=0)
+                else:
+                    frequency = peaks[other].get(length_class, 0) if waiting[length_class] else 0
+                if frequency:
+                    bound += upper(idf, frequency, length)
+            return bound
+
+        # Граница группы плюс граница остальных терминов для документов той же длины - граница
+        # score любого документа, впервые встреченного в группе; короткий список - одна группа
+        heap = []
+        for term, (postings, idf) in enumerate(query):
+            if postings.groups is None:
+                frequency, length = postings.limits(doc_lengths)
+                groups = [(None, upper(idf, frequency, length), length, postings.docs)]
+            else:
+                groups = [(length_class, upper(idf, group.max_freq, group.min_length), group.min_length, group.docs)
+                          for (_, length_class), group in postings.groups.items()]
+            for i, (length_class, bound, length, docs) in enumerate(groups):
+                heap.append((-(bound + rest(term, length_class, length)), term, i, length_class, bound, length, docs))
+        heapq.heapify(heap)
+
+        scored: Set[int] = set()
+        best: List[Tuple[float, int]] = []
+        while heap:
+            key, term, i, length_class, bound, length, docs = heapq.heappop(heap)
+            if len(best) >= top and -key <= best[0][0]:
+                break
+            # Граница могла уменьшиться, пока просматривались другие группы
+            current = bound + rest(term, length_class, length)
+            if current < -key:
+                heapq.heappush(heap, (-current, term, i, length_class, bound, length, docs))
+                continue
+            pending[term][length_class] -= 1
+            for doc in docs:
+                if doc in scored or doc_keys[doc] is None:
+                    continue
+                scored.add(doc)
+                norm = norm_base + norm_scale * doc_lengths[doc]
+                score = 0.0
+                for postings, idf in query:
+                    frequency = postings.frequency(doc)
+                    if frequency:
+                        score += idf * frequency * gain / (frequency + norm)
+                if len(best) < top:
+                    heapq.heappush(best, (score, doc))
+                elif score > best[0][0]:
+                    heapq.heapreplace(best, (score, doc))
+
+        if len(query) == 1:
+            total = query[0][0].df
+        else:
+            matched = set(query[0][0].docs).union(*(postings.docs for postings, _ in query[1:]))
+            total = len(matched) - len(matched.intersection(self.removed_docs))
+        best.sort(reverse=True)
+        return total, [(doc_keys[doc], score) for score, doc in best]
+
+
+class SearchIndex:
+    """
+    Полнотекстовый поиск по истории чатов с инкрементальным обновлением индекса
+    Компактификацию индекса выполняет фоновая задача (on_compaction_needed будит ее);
+    без нее компактификация выполняется сразу при удалении
+    """
+
+    def __init__(self):
+        self.user_indexes: Dict[str, _UserIndex] = {}
+        # Пользователи, чьи индексы ждут компактификации
+        self.compaction_due: Dict[str, None] = {}
+        self.on_compaction_needed: Optional[Callable[[], None]] = None
+        self.stats = {
+            "compactions": 0,
+        }
+
+    def _get_index(self, user_id: str) -> _UserIndex:
+        index = self.user_indexes.get(user_id)
+        if index is None:
+            index = self.user_indexes[user_id] = _UserIndex()
+        return index
+
+    def add_message(self, user_id: str, message_id: int, content: str):
+        """Индексирует новое сообщение (уже проиндексированное не дублируется)"""
+        self._get_index(user_id).add(message_id, content)
+
+    def add_messages(self, user_id: str, messages: List[MessageRecord]):
+        """Индексирует сообщения сессии, загруженной из архива"""
+        index = self._get_index(user_id)
+        for message in messages:
+            index.add(message.id, message.text)
+
+    def update_message(self, user_id: str, message_id: int, content: str):
+        """Переиндексирует отредактированное сообщение"""
+        index = self._get_index(user_id)
+        self._remove(user_id, index, message_id)
+        index.add(message_id, content)
+
+    def remove_message(self, user_id: str, message_id: int):
+        """Удаляет сообщение из индекса"""
+        index = self.user_indexes.get(user_id)
+        if index is not None:
+            self._remove(user_id, index, message_id)
+
+    def _remove(self, user_id: str, index: _UserIndex, message_id: int):
+        if not index.remove(message_id) or not index.needs_compaction:
+            return
+        if self.on_compaction_needed is None:
+            self.compact(user_id)
+            return
+        self.compaction_due[user_id] = None
+        self.on_compaction_needed()
+
+    def on_store_change(self, op: str, entity: str, user_id: str, obj):
+        """Поддерживает индекс в актуальном состоянии при изменениях в хранилище чатов"""
+        if entity != "message":
+            return
+        if op == "create":
+            self.add_message(user_id, obj.id, obj.text)
+        elif op == "update":
+            self.update_message(user_id, obj.id, obj.text)
+        elif op == "delete":
+            self.remove_message(user_id, obj.id)
+
+    def take_compaction_due(self) -> List[str]:
+        """Пользователи, чьи индексы ждут компактификации; список очищается"""
+        due, self.compaction_due = list(self.compaction_due), {}
+        return due
+
+    def prepare_compaction(self, user_id: str) -> Optional[_CompactionJob]:
+        index = self.user_indexes.get(user_id)
+        if index is None or not index.needs_compaction:
+            return None
+        return index.prepare_compaction()
+
+    def commit_compaction(self, job: _CompactionJob):
+        job.index.commit_compaction(job)
+        self.stats["compactions"] += 1
+
+    def compact(self, user_id: str):
+        """Синхронная компактификация индекса пользователя"""
+        job = self.prepare_compaction(user_id)
+        if job is not None:
+            job.run()
+            self.commit_compaction(job)
+
+    def search(self, user_id: str, query: str, limit: int = 20, offset: int = 0) -> Tuple[int, List[Tuple[int, float]]]:
+        """
+        Ищет сообщения пользователя по запросу
+        Возвращает общее число найденных сообщений и страницу пар (внутренний id сообщения, score)
+        """
+        index = self.user_indexes.get(user_id)
+        terms = tokenize(query)
+        if index is None or not terms:
+            return 0, []
+
+        total, ranked = index.search(terms, offset + limit)
+        return total, ranked[offset:offset + limit]
+
+    def get_stats(self) -> Dict[str, int]:
+        """Статистика размера индекса"""
+        return {
+            "users": len(self.user_indexes),
+            "documents": sum(index.live_docs for index in self.user_indexes.values()),
+            "terms": sum(len(index.postings) for index in self.user_indexes.values()),
+            "deleted_documents": sum(index.deleted for index in self.user_indexes.values()),
+            **self.stats,
+        }
+
+
+# Глобальный экземпляр поискового индекса
+search_index = SearchIndex()
@@ -0,0 +1,112 @@
+import os
+import zlib
+import pickle
+import logging
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Расширение файла определяет кодек, поэтому архивы читаются и после смены кодека
+ZSTD_SUFFIX = ".zst"
+ZLIB_SUFFIX = ".zlib"
+
+
+class SessionArchive:
+    """
+    Сжатые архивы сообщений холодных сессий на диске
+    Один файл на сессию: pickle кортежей полей сообщений и листа активной ветки, сжатый zstd
+    (если установлен пакет zstandard) или zlib. Запись атомарна: tmp + fsync + replace
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = Path(directory or os.getenv('CHAT_ARCHIVE_DIR', 'data/chat_archive'))
+        # Сессии, к которым не обращались дольше порога, выгружаются на диск
+        self.idle_seconds = float(os.getenv('CHAT_ARCHIVE_IDLE_SECONDS', str(3 * 24 * 3600)))
+        # Бюджет памяти на сообщения резидентных сессий; при превышении выгружаются самые давние
+        self.memory_budget = int(os.getenv('CHAT_MEMORY_BUDGET_MB', '512')) * 1024 * 1024
+        self.sweep_interval = float(os.getenv('CHAT_ARCHIVE_SWEEP_SECONDS', '60'))
+        self.level = int(os.getenv('CHAT_ARCHIVE_LEVEL', '3'))
+        self.suffix = ZSTD_SUFFIX if zstandard is not None else ZLIB_SUFFIX
+
+    @property
+    def codec(self) -> str:
+        return "zstd" if self.suffix == ZSTD_SUFFIX else "zlib"
+
+    def _compress(self, data: bytes) -> bytes:
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        return zlib.compress(data, min(self.level, 9))
+
+    def _find(self, session_id: str) -> Optional[Path]:
+        for suffix in (ZSTD_SUFFIX, ZLIB_SUFFIX):
+            path = self.directory / f"{session_id}{suffix}"
+            if path.exists():
+                return path
+        return None
+
+    def write(self, session_id: str, next_seq: int, messages: List[tuple], leaf: int = 0) -> int:
+        """Сохраняет сообщения сессии, возвращает размер архива в байтах"""
+        data = self._compress(pickle.dumps((next_seq, messages, leaf), protocol=pickle.HIGHEST_PROTOCOL))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{session_id}{self.suffix}"
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        # Архив, записанный прежним кодеком, больше не нужен
+        stale = self.directory / f"{session_id}{ZLIB_SUFFIX if self.suffix == ZSTD_SUFFIX else ZSTD_SUFFIX}"
+        if stale.exists():
+            stale.unlink()
+        return len(data)
+
+    def read(self, session_id: str) -> Tuple[int, List[tuple], int]:
+        """Читает архив сессии: (next_seq, кортежи полей сообщений, лист активной ветки)"""
+        path = self._find(session_id)
+        if path is None:
+            raise FileNotFoundError(f"No archive for session {session_id}")
+        with open(path, "rb") as f:
+            data = f.read()
+        if path.suffix == ZSTD_SUFFIX:
+            if zstandard is None:
+                raise RuntimeError(f"Archive {path.name} requires the zstandard package")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            data = zlib.decompress(data)
+        return pickle.loads(data)
+
+    def delete(self, session_id: str):
+        path = self._find(session_id)
+        if path is not None:
+            path.unlink()
+
+    def prune(self, keep: Iterable[str]) -> int:
+        """Удаляет архивы сессий, которых нет в keep; возвращает число удаленных файлов"""
+        if not self.directory.exists():
+            return 0
+        keep = set(keep)
+        removed = 0
+        for path in list(self.directory.iterdir()):
+            if path.suffix == ".tmp" or (path.suffix in (ZSTD_SUFFIX, ZLIB_SUFFIX) and path.stem not in keep):
+                path.unlink()
+                removed += 1
+        if removed:
+            logger.info(f"Removed {removed} orphaned session archives")
+        return removed
+
+    def disk_usage(self) -> int:
+        if not self.directory.exists():
+            return 0
+        return sum(path.stat().st_size for path in self.directory.iterdir() if path.is_file())
+
+
+# Глобальный экземпляр архива холодных сессий
+session_archive = SessionArchive()
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import random
+import logging
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Трассировка текущего запроса; None - запрос не попал в выборку
+_current: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+
+
+class Trace:
+    """Трассировка одного запроса: идентификаторы W3C Trace Context и отрезки этапов"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "started", "spans")
+
+    def __init__(self, name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None):
+        self.trace_id = trace_id or "%032x" % random.getrandbits(128)
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.started = time.perf_counter()
+        # (этап, длительность в секундах)
+        self.spans: List[Tuple[str, float]] = []
+
+    def add(self, name: str, seconds: float):
+        self.spans.append((name, seconds))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def traceparent(self) -> str:
+        """Заголовок traceparent для исходящих запросов (всегда с флагом sampled)"""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def server_timing(self) -> str:
+        """Значение заголовка Server-Timing: этапы и общее время в миллисекундах"""
+        parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.spans]
+        parts.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(parts)
+
+    def merge_server_timing(self, header: Optional[str], prefix: str):
+        """Добавляет этапы из Server-Timing ответа другого сервиса (с префиксом в имени)"""
+        if not header:
+            return
+        for metric in header.split(","):
+            name, _, params = metric.strip().partition(";")
+            for param in params.split(";"):
+                key, _, value = param.strip().partition("=")
+                if key == "dur":
+                    try:
+                        self.add(f"{prefix}{name}", float(value) / 1000)
+                    except ValueError:
+                        pass
+
+
+class _Span:
+    """Замер этапа; по выходе отрезок добавляется в трассировку"""
+
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoopSpan:
+    """Этап запроса вне выборки: ничего не измеряется"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """(trace_id, parent_id, sampled) из заголовка traceparent или None, если он некорректен"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3][:2], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+class Tracer:
+    """
+    Трассировка этапов запроса (авторизация, хранилище, сетевой режим, пересылка, модель)
+    В выборку попадает доля TRACE_SAMPLE_RATE запросов и все запросы с флагом sampled
+    во входящем traceparent; для остальных span() возвращает пустой объект, и
+    трассировка почти ничего не стоит. Результат - заголовок Server-Timing и
+    строка лога в JSON; в запросы к инференсу передается traceparent
+    """
+
+    def __init__(self):
+        self.sample_rate = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+        self.log_enabled = os.getenv('TRACE_LOG', 'true').lower() == 'true'
+
+    def start(self, name: str, traceparent: Optional[str] = None) -> Optional[Trace]:
+        """Новая трассировка, если запрос попал в выборку"""
+        parent = parse_traceparent(traceparent)
+        if parent is not None and parent[2]:
+            return Trace(name, parent[0], parent[1])
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return Trace(name, parent[0] if parent else None)
+        return None
+
+    @staticmethod
+    def activate(trace: Trace):
+        """Делает трассировку текущей; возвращает токен для deactivate"""
+        return _current.set(trace)
+
+    @staticmethod
+    def deactivate(token):
+        _current.reset(token)
+
+    @staticmethod
+    def current() -> Optional[Trace]:
+        return _current.get()
+
+    @staticmethod
+    def span(name: str):
+        """Контекст замера этапа текущего запроса"""
+        trace = _current.get()
+        return _NOOP_SPAN if trace is None else _Span(trace, name)
+
+    @staticmethod
+    def record(name: str, seconds: float):
+        """Добавляет уже измеренный этап к текущей трассировке"""
+        trace = _current.get()
+        if trace is not None:
+            trace.add(name, seconds)
+
+    def finish(self, trace: Trace, **fields):
+        """Структурированная строка лога с этапами запроса"""
+        if not self.log_enabled:
+            return
+        logger.info(json.dumps({
+            "trace_id": trace.trace_id,
+            "parent_id": trace.parent_id,
+            "name": trace.name,
+            **fields,
+            "total_ms": round(trace.elapsed() * 1000, 2),
+            "spans": [[name, round(seconds * 1000, 2)] for name, seconds in trace.spans],
+        }, ensure_ascii=False))
+
+
+class TracingMiddleware:
+    """ASGI-middleware: трассировка HTTP-запросов в выборке и заголовок Server-Timing в ответе"""
+
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+        trace = self.tracer.start(f"{scope['method']} {scope['path']}", traceparent)
+        if trace is None:
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", trace.server_timing().encode("latin-1")),
+                    (b"traceresponse", trace.traceparent().encode("latin-1")),
+                ]
+            await send(message)
+
+        token = self.tracer.activate(trace)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            self.tracer.deactivate(token)
+            route = scope.get("route")
+            self.tracer.finish(trace, route=getattr(route, "path", None), status=status)
+
+
+# Глобальный экземпляр трассировщика
+tracer = Tracer()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк опроса списка сессий с условными запросами (If-None-Match) и без них
+
+Запуск из корня репозитория:
+    JWT_SECRET=bench python benchmarks/bench_conditional_get.py --sessions 500 --polls 2000
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('JWT_SECRET', 'benchmark-secret')
+
+from fastapi.testclient import TestClient
+
+from backend.main import app
+
+# Логи каждого запроса искажают замер
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def poll(client: TestClient, url: str, headers: dict, polls: int) -> float:
+    """Возвращает среднее время одного запроса в микросекундах"""
+    start = time.perf_counter()
+    for _ in range(polls):
+        client.get(url, headers=headers)
+    return (time.perf_counter() - start) / polls * 1e6
+
+
+def run_benchmark(sessions: int, polls: int):
+    client = TestClient(app)
+    token = client.post("/auth/register", json={"username": "bench", "password": "bench"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    for i in range(sessions):
+        client.post("/api/sessions", json={"title": f"Сессия {i}"}, headers=headers)
+
+    response = client.get("/api/sessions", headers=headers)
+    etag = response.headers["ETag"]
+    conditional_headers = {**headers, "If-None-Match": etag}
+    assert client.get("/api/sessions", headers=conditional_headers).status_code == 304
+
+    plain = poll(client, "/api/sessions", headers, polls)
+    conditional = poll(client, "/api/sessions", conditional_headers, polls)
+
+    print(f"Сессий: {sessions}, опросов: {polls}, размер ответа: {len(response.content)} байт")
+    print(f"Без If-None-Match: {plain:.1f} мкс/запрос")
+    print(f"С If-None-Match (304): {conditional:.1f} мкс/запрос")
+    print(f"Ускорение: {plain / conditional:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=500)
+    parser.add_argument("--polls", type=int, default=2000)
+    args = parser.parse_args()
+    run_benchmark(args.sessions, args.polls)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Замер экономии памяти и стоимости чтения при сжатии содержимого сообщений
+
+Строит хранилище с синтетическими ответами ассистента (общие шаблонные фразы,
+списки, фрагменты кода) без сжатия и со сжатием обученным словарем, затем
+измеряет память (tracemalloc) и время чтения полного текста и превью.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_content_compression.py --messages 20000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from backend.services.chat_store import ChatStore, MessageRole
+from backend.services.content_codec import content_codec
+
+OPENINGS = [
+    "Конечно! Вот подробный ответ на ваш вопрос.",
+    "Отличный вопрос. Давайте разберем его по шагам.",
+    "Хорошо, я подготовил решение с пояснениями.",
+]
+CLOSINGS = [
+    "Если у вас остались вопросы, напишите, и я помогу разобраться.",
+    "Надеюсь, это поможет! Дайте знать, если нужно что-то уточнить.",
+]
+TOPICS = ["кэширование", "индексы базы данных", "асинхронный ввод-вывод", "сжатие данных",
+          "пул соединений", "очередь задач", "логирование", "обработка ошибок"]
+WORDS = ("запрос ответ сервер клиент память время данные модель функция параметр значение "
+         "список словарь поток процесс результат ошибка настройка файл строка").split()
+CODE = [
+    "```python\ndef handle(request):\n    data = parse(request)\n    return process(data)\n```",
+    "```python\nasync def main():\n    async with session.get(url) as response:\n        return await response.json()\n```",
+]
+
+
+def make_reply(rng: random.Random) -> str:
+    """Синтетический ответ ассистента длиной в несколько килобайт"""
+    parts = [rng.choice(OPENINGS)]
+    for step in range(rng.randint(4, 10)):
+        topic = rng.choice(TOPICS)
+        sentence = " ".join(rng.choices(WORDS, k=rng.randint(12, 30)))
+        parts.append(f"{step + 1}. **{topic.capitalize()}**: {sentence}.")
+        if rng.random() < 0.3:
+            parts.append(rng.choice(CODE))
+    parts.append(rng.choice(CLOSINGS))
+    return "\n\n".join(parts)
+
+
+def build(count: int, seed: int) -> ChatStore:
+    """Тексты создаются внутри замера, чтобы в него попала память содержимого"""
+    rng = random.Random(seed)
+    store = ChatStore()
+    session_id = None
+    for i in range(count):
+        if i % 100 == 0:
+            session_id = store.create_session("bench-user", "bench")["id"]
+        store.add_message(session_id, MessageRole.ASSISTANT, make_reply(rng))
+    return store
+
+
+def measure(count: int, seed: int):
+    tracemalloc.start()
+    store = build(count, seed)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return store, size
+
+
+def read_time(store: ChatStore, preview: bool) -> float:
+    """Среднее время сериализации одного сообщения в микросекундах"""
+    messages = list(store.messages.values())
+    start = time.perf_counter()
+    for message in messages:
+        store.serialize_message(message, 100 if preview else None)
+    return (time.perf_counter() - start) * 1e6 / len(messages)
+
+
+def run_benchmark(count: int):
+    threshold = content_codec.min_chars
+    content_codec.min_chars = 0
+    plain_store, plain_bytes = measure(count, seed=1)
+    raw_chars = sum(len(message.content) for message in plain_store.messages.values())
+
+    # Обучаем словарь на выборке других ответов, как это происходит в работающем сервере
+    content_codec.min_chars = threshold
+    content_codec.retrain_every = 10 ** 9
+    rng = random.Random(2)
+    for _ in range(2000):
+        content_codec.pack(make_reply(rng))
+    content_codec.retrain()
+    content_codec.training_thread.join()
+
+    packed_store, packed_bytes = measure(count, seed=1)
+    packed = sum(1 for message in packed_store.messages.values() if message.content.__class__ is not str)
+
+    print(f"Сообщений: {count}, средняя длина {raw_chars / count:.0f} символов, кодек {content_codec.codec}")
+    print(f"Сжато сообщений: {packed} (порог {threshold} символов)")
+    print(f"Память без сжатия: {plain_bytes / 2 ** 20:.1f} MiB, со сжатием: {packed_bytes / 2 ** 20:.1f} MiB "
+          f"(экономия {1 - packed_bytes / plain_bytes:.0%})")
+    print(f"Чтение полного текста: {read_time(plain_store, False):.1f} мкс без сжатия, "
+          f"{read_time(packed_store, False):.1f} мкс со сжатием")
+    print(f"Чтение превью (100 символов): {read_time(packed_store, True):.1f} мкс")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+    run_benchmark(args.messages)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Пропускная способность потокового импорта и экспорта истории чатов
+
+Генерирует файл истории в формате /api/export, запускает шлюз отдельным
+процессом (uvicorn), загружает файл потоком через POST /api/import и выгружает
+историю обратно через GET /api/export. Печатает МБ/с, сообщений/с и прирост
+RSS процесса шлюза во время экспорта: он не должен зависеть от объема истории.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_export_import.py --messages 1000000 --size 1000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from uuid import uuid4
+
+import httpx
+import psutil
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+WORDS = "запрос ответ сервер клиент память время данные модель функция параметр история экспорт".split()
+
+
+def write_history(path: str, count: int, size: int, per_session: int = 200):
+    """Синтетическая история в формате NDJSON-экспорта"""
+    rng = random.Random(1)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"type": "export", "version": 1}) + "\n")
+        session_id = None
+        for i in range(count):
+            if i % per_session == 0:
+                session_id = str(uuid4())
+                f.write(json.dumps({"type": "session", "id": session_id, "title": f"bench {i // per_session}",
+                                    "created_at": "2026-01-01T00:00:00", "updated_at": "2026-01-01T00:00:00"}) + "\n")
+            content = " ".join(rng.choices(WORDS, k=size // 8))[:size]
+            f.write(json.dumps({"type": "message", "session_id": session_id, "seq": i % per_session + 1,
+                                "role": "user" if i % 2 == 0 else "assistant", "content": content,
+                                "created_at": "2026-01-01T00:00:00.000001"}, ensure_ascii=False) + "\n")
+
+
+def start_gateway(port: int, workdir: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        JWT_SECRET="bench-secret-bench-secret-bench-secret",
+        CHAT_JOURNAL_DIR=os.path.join(workdir, "journal"),
+        CHAT_ARCHIVE_DIR=os.path.join(workdir, "archive"),
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Gateway did not start")
+
+
+def run_benchmark(count: int, size: int, port: int):
+    workdir = tempfile.mkdtemp(prefix="bench-transfer-")
+    source = os.path.join(workdir, "history.ndjson")
+    write_history(source, count, size)
+    source_bytes = os.path.getsize(source)
+
+    gateway = start_gateway(port, workdir)
+    try:
+        base = f"http://127.0.0.1:{port}"
+        with httpx.Client(base_url=base, timeout=None) as client:
+            token = client.post("/auth/register", json={"username": f"bench-{uuid4().hex[:8]}", "password": "bench"})
+            headers = {"Authorization": f"Bearer {token.json()['access_token']}"}
+
+            def upload():
+                with open(source, "rb") as f:
+                    while True:
+                        block = f.read(256 * 1024)
+                        if not block:
+                            return
+                        yield block
+
+            report = client.post("/api/import", content=upload(), headers=headers).json()
+
+            server = psutil.Process(gateway.pid)
+            rss_before = server.memory_info().rss
+            rss_peak = rss_before
+            exported = 0
+            start = time.perf_counter()
+            with client.stream("GET", "/api/export", headers=headers) as response:
+                for block in response.iter_bytes():
+                    exported += len(block)
+                    rss_peak = max(rss_peak, server.memory_info().rss)
+            export_seconds = time.perf_counter() - start
+    finally:
+        gateway.terminate()
+        gateway.wait()
+
+    print(f"Сообщений: {count}, размер сообщения: {size} символов, файл: {source_bytes / 2 ** 20:.1f} MiB")
+    print(f"Импорт: {report['seconds']:.2f}s, {report['mb_per_second']} MiB/s, "
+          f"{report['messages_per_second']} сообщений/s, ошибок {report['errors']}")
+    print(f"Экспорт: {export_seconds:.2f}s, {exported / 2 ** 20 / export_seconds:.1f} MiB/s, "
+          f"{count / export_seconds:.0f} сообщений/s, прирост RSS шлюза {(rss_peak - rss_before) / 2 ** 20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    run_benchmark(args.messages, args.size, args.port)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Замер времени восстановления хранилища чатов из журнала мутаций
+
+Сравнивает полный повтор журнала с загрузкой снимка и повтором только хвоста.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_journal_recovery.py --records 10000000 --tail 100000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('CHAT_JOURNAL_FSYNC', 'never')
+os.environ.setdefault('CHAT_JOURNAL_SNAPSHOT_EVERY', str(10 ** 12))
+
+from backend.auth.passwords import hash_password
+from backend.services.chat_store import ChatStore, MessageRole
+from backend.services.chat_journal import ChatJournal
+
+MESSAGES_PER_SESSION = 100
+
+
+def write_records(store: ChatStore, count: int):
+    """Дописывает около count записей: сессии по MESSAGES_PER_SESSION сообщений"""
+    user = next(iter(store.users.values()), None) or store.create_user("bench", hash_password("bench"))
+    written = 0
+    while written < count:
+        session_id = store.create_session(user["id"], "Сессия")["id"]
+        written += 1
+        for i in range(min(MESSAGES_PER_SESSION, count - written)):
+            role = MessageRole.USER if i % 2 == 0 else MessageRole.ASSISTANT
+            store.add_message(session_id, role, f"Сообщение номер {written} в истории чата")
+            written += 1
+
+
+def recover(directory: str) -> tuple:
+    """Возвращает (время восстановления, хранилище, журнал)"""
+    store = ChatStore()
+    journal = ChatJournal(directory)
+    start = time.perf_counter()
+    journal.open(store)
+    return time.perf_counter() - start, store, journal
+
+
+def run_benchmark(records: int, tail: int):
+    directory = tempfile.mkdtemp(prefix="chat-journal-bench-")
+    try:
+        store = ChatStore()
+        journal = ChatJournal(directory)
+        journal.open(store)
+        store.subscribe(journal.on_store_change)
+
+        start = time.perf_counter()
+        write_records(store, records)
+        elapsed = time.perf_counter() - start
+        journal.close()
+        print(f"Записей: {journal.lsn}, запись: {elapsed:.1f}s ({journal.lsn / elapsed:.0f} записей/s)")
+        del store, journal
+
+        elapsed, store, journal = recover(directory)
+        print(f"Полный повтор журнала: {elapsed:.1f}s, сообщений: {len(store.messages)}")
+
+        start = time.perf_counter()
+        journal.snapshot()
+        journal.snapshot_thread.join()
+        print(f"Снимок: {time.perf_counter() - start:.1f}s")
+
+        store.subscribe(journal.on_store_change)
+        write_records(store, tail)
+        journal.close()
+        del store, journal
+
+        elapsed, store, journal = recover(directory)
+        print(f"Снимок + хвост из {tail} записей: {elapsed:.1f}s, сообщений: {len(store.messages)}")
+        journal.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=10_000_000)
+    parser.add_argument("--tail", type=int, default=100_000)
+    args = parser.parse_args()
+    run_benchmark(args.records, args.tail)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Замер памяти на одно сообщение в хранилище чатов с помощью tracemalloc
+
+Сравнивает прежнее представление (словарь со строковыми UUID и ISO-временем)
+с компактными записями ChatStore. Содержимое у всех сообщений общее,
+поэтому в замер попадают только накладные расходы.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_message_memory.py --messages 200000 --per-session 100
+"""
+import os
+import sys
+import argparse
+import tracemalloc
+from datetime import datetime
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from backend.services.chat_store import ChatStore, MessageRole
+
+CONTENT = "Общий текст сообщения, не входящий в замер"
+
+
+def measure(build) -> int:
+    """Возвращает число байт, выделенных build() и оставшихся в живых"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    keep = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del keep
+    return size
+
+
+def build_dicts(count: int, session_ids: list):
+    """Прежнее представление: словарь на сообщение в общем словаре по UUID"""
+    messages_db = {}
+    per_session = count // len(session_ids)
+    for i in range(count):
+        msg_id = str(uuid4())
+        messages_db[msg_id] = {
+            "id": msg_id,
+            "session_id": session_ids[i // per_session],
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": CONTENT,
+            "created_at": datetime.now().isoformat()
+        }
+    return messages_db
+
+
+def build_records(count: int, store: ChatStore, session_ids: list):
+    per_session = count // len(session_ids)
+    for i in range(count):
+        role = MessageRole.USER if i % 2 == 0 else MessageRole.ASSISTANT
+        store.add_message(session_ids[i // per_session], role, CONTENT)
+    return store
+
+
+def run_benchmark(count: int, per_session: int):
+    store = ChatStore()
+    count -= count % per_session
+    session_ids = [store.create_session("bench-user", "bench")["id"] for _ in range(count // per_session)]
+
+    dict_bytes = measure(lambda: build_dicts(count, session_ids))
+    record_bytes = measure(lambda: build_records(count, store, session_ids))
+
+    print(f"Сообщений: {count}, сообщений в сессии: {per_session}")
+    print(f"Словари: {dict_bytes / count:.1f} байт/сообщение")
+    print(f"Компактные записи: {record_bytes / count:.1f} байт/сообщение")
+    print(f"Экономия: {1 - record_bytes / dict_bytes:.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--per-session", type=int, default=100)
+    args = parser.parse_args()
+    run_benchmark(args.messages, args.per_session)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест шлюза и инференс-сервера: смесь REST-запросов, WebSocket-клиенты и генерации
+
+Виртуальные пользователи шлюза в течение --duration секунд выполняют запросы, выбирая
+их по весам из --mix (login, sessions - список сессий, send - сообщение в чат, list -
+страница сообщений); WebSocket-клиенты отправляют промпты через /ws/{client_id};
+пользователи инференс-сервера вызывают /generate/stream (или /generate). По каждой
+операции печатаются пропускная способность, p50/p95/p99 задержки, время до первого
+фрагмента (TTFT: первая строка потока, для WebSocket - первый кадр) и доля ошибок;
+с --output результат сохраняется в JSON, а --compare сравнивает два сохраненных прогона.
+
+Лимиты частоты шлюза (RATE_LIMIT_*) рассчитаны на людей: для нагрузки их нужно поднять
+или отключить (RATE_LIMIT_ENABLED=false), иначе большая часть запросов получит 429.
+--spawn запускает шлюз отдельным процессом с отключенными лимитами.
+
+Запуск из корня репозитория:
+    python benchmarks/load_test.py --spawn --users 50 --duration 30 --output before.json
+    python benchmarks/load_test.py --gateway http://localhost:8050 --ws-clients 10 \\
+        --inference http://localhost:8001 --inference-users 4 --output after.json
+    python benchmarks/load_test.py --compare before.json after.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import httpx
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_MIX = "login=1,sessions=2,send=4,list=3"
+PROMPTS = [
+    "Расскажи коротко о Python",
+    "Что такое асинхронность?",
+    "Как работает кэширование HTTP?",
+    "Объясни, что такое очередь задач",
+]
+
+
+class Recorder:
+    """Замеры операций: задержки, время до первого фрагмента и ошибки по причинам"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.ttft: Dict[str, List[float]] = {}
+        self.errors: Dict[str, Dict[str, int]] = {}
+
+    def record(self, operation: str, seconds: float, error: Optional[str] = None,
+               ttft: Optional[float] = None):
+        self.latencies.setdefault(operation, []).append(seconds)
+        if ttft is not None:
+            self.ttft.setdefault(operation, []).append(ttft)
+        if error is not None:
+            reasons = self.errors.setdefault(operation, {})
+            reasons[error] = reasons.get(error, 0) + 1
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Перцентиль методом ближайшего ранга, в миллисекундах"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return round(ordered[index] * 1000, 2)
+
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    operations = {}
+    for operation, latencies in sorted(recorder.latencies.items()):
+        errors = sum(recorder.errors.get(operation, {}).values())
+        ttft = recorder.ttft.get(operation, [])
+        operations[operation] = {
+            "count": len(latencies),
+            "throughput_rps": round(len(latencies) / elapsed, 2),
+            "error_rate": round(errors / len(latencies), 4),
+            "errors": recorder.errors.get(operation, {}),
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies) * 1000, 2),
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+            },
+            "ttft_ms": {
+                "p50": percentile(ttft, 50),
+                "p95": percentile(ttft, 95),
+                "p99": percentile(ttft, 99),
+            } if ttft else None,
+        }
+    count = sum(len(latencies) for latencies in recorder.latencies.values())
+    errors = sum(sum(reasons.values()) for reasons in recorder.errors.values())
+    return {
+        "operations": operations,
+        "total": {
+            "count": count,
+            "throughput_rps": round(count / elapsed, 2),
+            "error_rate": round(errors / count, 4) if count else 0.0,
+        },
+    }
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ("login", "sessions", "send", "list"):
+            raise argparse.ArgumentTypeError(f"Unknown operation in mix: {name}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+async def timed(recorder: Recorder, operation: str, request) -> Optional[httpx.Response]:
+    """Выполняет запрос и записывает задержку; ошибка - статус не 2xx/304 или исключение"""
+    start = time.perf_counter()
+    try:
+        response = await request
+    except httpx.HTTPError as e:
+        recorder.record(operation, time.perf_counter() - start, type(e).__name__)
+        return None
+    ok = response.status_code < 300 or response.status_code == 304
+    recorder.record(operation, time.perf_counter() - start, None if ok else str(response.status_code))
+    return response if ok else None
+
+
+async def rest_user(client: httpx.AsyncClient, index: int, run_id: str, weights: Dict[str, float],
+                    deadline: float, think: float, recorder: Recorder):
+    """Пользователь шлюза: регистрация, своя сессия, затем операции по весам до конца прогона"""
+    username, password = f"load-{run_id}-{index}", "load"
+    response = await timed(recorder, "register", client.post(
+        "/auth/register", json={"username": username, "password": password}
+    ))
+    if response is None:
+        return
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    session = await timed(recorder, "create_session", client.post(
+        "/api/sessions", json={"title": f"load {index}"}, headers=headers
+    ))
+    if session is None:
+        return
+    session_id = session.json()["id"]
+
+    operations, operation_weights = list(weights), list(weights.values())
+    rng = random.Random(index)
+    while time.perf_counter() < deadline:
+        operation = rng.choices(operations, operation_weights)[0]
+        if operation == "login":
+            await timed(recorder, "login", client.post(
+                "/auth/login", json={"username": username, "password": password}
+            ))
+        elif operation == "sessions":
+            await timed(recorder, "sessions", client.get("/api/sessions", headers=headers))
+        elif operation == "send":
+            await timed(recorder, "send", client.post(
+                "/api/chat/send", json={"session_id": session_id, "message": rng.choice(PROMPTS)}, headers=headers
+            ))
+        else:
+            await timed(recorder, "list", client.get(f"/api/sessions/{session_id}/messages", headers=headers))
+        if think:
+            await asyncio.sleep(rng.expovariate(1 / think))
+
+
+async def ws_client(client: httpx.AsyncClient, ws_url: str, index: int, run_id: str, max_length: int,
+                    deadline: float, think: float, recorder: Recorder):
+    """WebSocket-клиент: промпт - ответный кадр; ответ с полем error считается ошибкой"""
+    response = await timed(recorder, "register", client.post(
+        "/auth/register", json={"username": f"load-ws-{run_id}-{index}", "password": "load"}
+    ))
+    if response is None:
+        return
+    token = response.json()["access_token"]
+    rng = random.Random(-index - 1)
+    async with websockets.connect(f"{ws_url}/ws/load-{run_id}-{index}?token={token}") as websocket:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                await websocket.send(json.dumps({"prompt": rng.choice(PROMPTS), "max_length": max_length}))
+                frame = json.loads(await websocket.recv())
+            except websockets.ConnectionClosed as e:
+                recorder.record("websocket", time.perf_counter() - start, type(e).__name__)
+                return
+            elapsed = time.perf_counter() - start
+            error = (frame.get("type") or frame.get("status") or "error") if "error" in frame else None
+            recorder.record("websocket", elapsed, error, ttft=elapsed)
+            if think:
+                await asyncio.sleep(rng.expovariate(1 / think))
+
+
+async def inference_user(client: httpx.AsyncClient, index: int, stream: bool, max_length: int,
+                         deadline: float, think: float, recorder: Recorder):
+    """Пользователь инференс-сервера; для потока TTFT - время до первой строки с текстом"""
+    rng = random.Random(1000 + index)
+    headers = {"X-User-Id": f"load-{index}"}
+    while time.perf_counter() < deadline:
+        body = {"prompt": rng.choice(PROMPTS), "max_length": max_length}
+        if not stream:
+            await timed(recorder, "generate", client.post("/generate", json=body, headers=headers))
+        else:
+            start = time.perf_counter()
+            first = None
+            error = None
+            try:
+                async with client.stream("POST", "/generate/stream", json=body, headers=headers) as response:
+                    if response.status_code != 200:
+                        error = str(response.status_code)
+                    else:
+                        async for line in response.aiter_lines():
+                            if not line:
+                                continue
+                            event = json.loads(line)
+                            if "error" in event:
+                                error = "generation_error"
+                            elif "text" in event and first is None:
+                                first = time.perf_counter() - start
+            except httpx.HTTPError as e:
+                error = type(e).__name__
+            recorder.record("generate_stream", time.perf_counter() - start, error, ttft=first)
+        if think:
+            await asyncio.sleep(rng.expovariate(1 / think))
+
+
+async def run_load(args) -> dict:
+    recorder = Recorder()
+    run_id = uuid4().hex[:8]
+    weights = parse_mix(args.mix)
+    limits = httpx.Limits(max_connections=args.users + args.ws_clients + args.inference_users)
+    timeout = httpx.Timeout(args.timeout)
+
+    async with httpx.AsyncClient(base_url=args.gateway, limits=limits, timeout=timeout) as gateway, \
+            httpx.AsyncClient(base_url=args.inference or args.gateway, limits=limits, timeout=timeout) as inference:
+        deadline = time.perf_counter() + args.duration
+        tasks = [rest_user(gateway, i, run_id, weights, deadline, args.think, recorder) for i in range(args.users)]
+        if args.ws_clients:
+            if websockets is None:
+                raise SystemExit("WebSocket clients need the websockets package")
+            ws_url = args.gateway.replace("http", "ws", 1)
+            tasks += [ws_client(gateway, ws_url, i, run_id, args.max_length, deadline, args.think, recorder)
+                      for i in range(args.ws_clients)]
+        if args.inference and args.inference_users:
+            tasks += [inference_user(inference, i, not args.no_stream, args.max_length, deadline, args.think, recorder)
+                      for i in range(args.inference_users)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.perf_counter() - started
+
+    for result in results:
+        if isinstance(result, Exception):
+            recorder.record("client", 0.0, type(result).__name__)
+    return {
+        "started_at": datetime.now().isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "elapsed_seconds": round(elapsed, 2),
+        **summarize(recorder, elapsed),
+    }
+
+
+def print_report(result: dict):
+    print(f"{'операция':<16}{'запросов':>9}{'rps':>9}{'ошибки':>8}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}"
+          f"{'TTFT p50':>10}{'TTFT p95':>10}")
+    for operation, stats in result["operations"].items():
+        latency, ttft = stats["latency_ms"], stats["ttft_ms"] or {}
+        print(f"{operation:<16}{stats['count']:>9}{stats['throughput_rps']:>9}{stats['error_rate']:>8.1%}"
+              f"{latency['p50']:>9}{latency['p95']:>9}{latency['p99']:>9}"
+              f"{str(ttft.get('p50', '-')):>10}{str(ttft.get('p95', '-')):>10}")
+        if stats["errors"]:
+            print(f"{'':<16}ошибки: {stats['errors']}")
+    total = result["total"]
+    print(f"Всего: {total['count']} запросов за {result['elapsed_seconds']}s, "
+          f"{total['throughput_rps']} rps, ошибок {total['error_rate']:.1%}")
+
+
+def compare(before_path: str, after_path: str):
+    """Изменение пропускной способности и задержек между двумя прогонами"""
+    with open(before_path, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(after_path, encoding="utf-8") as f:
+        after = json.load(f)
+
+    def delta(old, new):
+        if old is None or new is None:
+            return "-"
+        return f"{old} -> {new} ({(new - old) / old:+.1%})" if old else f"{old} -> {new}"
+
+    for operation in sorted(set(before["operations"]) | set(after["operations"])):
+        old, new = before["operations"].get(operation), after["operations"].get(operation)
+        if old is None or new is None:
+            print(f"{operation}: только в {'втором' if old is None else 'первом'} прогоне")
+            continue
+        print(f"{operation}:")
+        print(f"  rps     {delta(old['throughput_rps'], new['throughput_rps'])}")
+        for p in ("p50", "p95", "p99"):
+            print(f"  {p} мс  {delta(old['latency_ms'][p], new['latency_ms'][p])}")
+        if old["ttft_ms"] and new["ttft_ms"]:
+            print(f"  TTFT p50 мс  {delta(old['ttft_ms']['p50'], new['ttft_ms']['p50'])}")
+        print(f"  ошибки  {old['error_rate']:.1%} -> {new['error_rate']:.1%}")
+
+
+def start_gateway(port: int, workdir: str) -> subprocess.Popen:
+    """Шлюз отдельным процессом: журнал и архив в workdir, лимиты частоты отключены"""
+    env = dict(
+        os.environ,
+        JWT_SECRET="load-secret-load-secret-load-secret",
+        CHAT_JOURNAL_DIR=os.path.join(workdir, "journal"),
+        CHAT_ARCHIVE_DIR=os.path.join(workdir, "archive"),
+        RATE_LIMIT_ENABLED="false",
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health", timeout=5)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Gateway did not start")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--gateway", default="http://127.0.0.1:8050")
+    parser.add_argument("--inference", default=None, help="URL инференс-сервера для генераций напрямую")
+    parser.add_argument("--spawn", action="store_true", help="запустить шлюз на --port с отключенными лимитами")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--users", type=int, default=20, help="пользователи REST API шлюза")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"веса операций (по умолчанию {DEFAULT_MIX})")
+    parser.add_argument("--ws-clients", type=int, default=0)
+    parser.add_argument("--inference-users", type=int, default=0)
+    parser.add_argument("--no-stream", action="store_true", help="генерации через /generate вместо /generate/stream")
+    parser.add_argument("--max-length", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--think", type=float, default=0, help="средняя пауза пользователя между запросами, s")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="файл для результатов в JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="сравнить два сохраненных прогона")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    gateway = workdir = None
+    try:
+        if args.spawn:
+            workdir = tempfile.mkdtemp(prefix="load-test-")
+            gateway = start_gateway(args.port, workdir)
+            args.gateway = f"http://127.0.0.1:{args.port}"
+        result = asyncio.run(run_load(args))
+    finally:
+        if gateway is not None:
+            gateway.terminate()
+            gateway.wait()
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
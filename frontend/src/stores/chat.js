@@ -1,9 +1,60 @@
 import { defineStore } from 'pinia'
 import { ref } from 'vue'
 
+const MESSAGES_PAGE_SIZE = 50
+// Повторы запроса на генерацию при сетевой ошибке (с тем же Idempotency-Key)
+const GENERATION_RETRIES = 2
+const GENERATION_RETRY_DELAY_MS = 1000
+// Сколько клиент готов ждать ответа, включая повторы; остаток передается в X-Request-Budget-Ms
+const GENERATION_BUDGET_MS = 30000
+
+// Ключ идемпотентности (UUID v4). crypto.randomUUID есть только в безопасном контексте
+// (https или localhost), а сайт в локальной сети открывается по http
+const newIdempotencyKey = () => {
+  if (typeof crypto.randomUUID === 'function') {
+    return crypto.randomUUID()
+  }
+  const bytes = crypto.getRandomValues(new Uint8Array(16))
+  bytes[6] = (bytes[6] & 0x0f) | 0x40
+  bytes[8] = (bytes[8] & 0x3f) | 0x80
+  const hex = Array.from(bytes, byte => byte.toString(16).padStart(2, '0')).join('')
+  return `${hex.slice(0, 8)}-${hex.slice(8, 12)}-${hex.slice(12, 16)}-${hex.slice(16, 20)}-${hex.slice(20)}`
+}
+
+// POST запроса на генерацию: при обрыве соединения запрос повторяется с тем же ключом,
+// и сервер вернет уже сгенерированный ответ вместо повторной генерации
+const postIdempotent = async (url, body) => {
+  const idempotencyKey = newIdempotencyKey()
+  const startedAt = Date.now()
+  for (let attempt = 0; ; attempt++) {
+    try {
+      return await fetch(url, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Authorization': `Bearer ${localStorage.getItem('chatbot_token')}`,
+          'Idempotency-Key': idempotencyKey,
+          // Остаток, а не момент времени: часы клиента и сервера могут расходиться
+          'X-Request-Budget-Ms': String(Math.max(0, GENERATION_BUDGET_MS - (Date.now() - startedAt)))
+        },
+        body: JSON.stringify(body)
+      })
+    } catch (error) {
+      // fetch отклоняется только при сетевой ошибке
+      if (attempt >= GENERATION_RETRIES) {
+        throw error
+      }
+      await new Promise(resolve => setTimeout(resolve, GENERATION_RETRY_DELAY_MS * (attempt + 1)))
+    }
+  }
+}
+
 export const useChatStore = defineStore('chat', () => {
   const sessions = ref([])
   const messages = ref([])
+  const olderCursors = ref({})
+  // null - точка отсчета синхронизации еще не получена
+  const syncCursor = ref(null)
   const loading = ref(false)
   
   const loadSessions = async () => {
@@ -57,10 +108,15 @@ export const useChatStore = defineStore('chat', () => {
     }
   }
   
-  const loadMessages = async (sessionId) => {
+  const loadMessages = async (sessionId, { before = null, limit = MESSAGES_PAGE_SIZE } = {}) => {
     try {
       loading.value = true
-      const response = await fetch(`/api/sessions/${sessionId}/messages`, {
+      const params = new URLSearchParams({ limit })
+      if (before !== null) {
+        params.set('before', before)
+      }
+      
+      const response = await fetch(`/api/sessions/${sessionId}/messages?${params}`, {
         headers: {
           'Authorization': `Bearer ${localStorage.getItem('chatbot_token')}`
         }
@@ -71,7 +127,11 @@ export const useChatStore = defineStore('chat', () => {
       }
       
       const data = await response.json()
-      messages.value = [...messages.value, ...data.filter(m => !messages.value.some(existing => existing.id === m.id))]
+      const beforeCursor = response.headers.get('X-Before-Cursor')
+      olderCursors.value[sessionId] = beforeCursor ? Number(beforeCursor) : null
+      
+      const fresh = data.filter(m => !messages.value.some(existing => existing.id === m.id))
+      messages.value = before !== null ? [...fresh, ...messages.value] : [...messages.value, ...fresh]
       return data
     } catch (error) {
       console.error('Error loading messages:', error)
@@ -81,30 +141,118 @@ export const useChatStore = defineStore('chat', () => {
     }
   }
   
-  const sendMessage = async (sessionId, message) => {
+  const hasOlderMessages = (sessionId) => olderCursors.value[sessionId] != null
+  
+  // Последняя страница сессии уже загружена (в том числе предзагрузкой)
+  const hasLoadedMessages = (sessionId) => sessionId in olderCursors.value
+  
+  const loadOlderMessages = async (sessionId) => {
+    if (!hasOlderMessages(sessionId)) {
+      return []
+    }
+    return loadMessages(sessionId, { before: olderCursors.value[sessionId] })
+  }
+  
+  // Загруженные сообщения сессии заменяются последней страницей активной ветки
+  const reloadMessages = async (sessionId) => {
+    messages.value = messages.value.filter(m => m.session_id !== sessionId)
+    return loadMessages(sessionId)
+  }
+  
+  const applyChange = (change) => {
+    if (change.entity === 'branch') {
+      // Активная ветка сменилась на другом устройстве
+      if (messages.value.some(m => m.session_id === change.id)) {
+        reloadMessages(change.id)
+      }
+      return
+    }
+    
+    if (change.entity === 'session') {
+      if (change.op === 'delete') {
+        sessions.value = sessions.value.filter(s => s.id !== change.id)
+        messages.value = messages.value.filter(m => m.session_id !== change.id)
+      } else if (sessions.value.some(s => s.id === change.id)) {
+        sessions.value = sessions.value.map(s => s.id === change.id ? change.data : s)
+      } else {
+        sessions.value = [change.data, ...sessions.value]
+      }
+      return
+    }
+    
+    if (change.op === 'delete') {
+      messages.value = messages.value.filter(m => m.id !== change.id)
+    } else if (!change.data) {
+      // Сообщение удалено позже - удаление придет следующим изменением
+      return
+    } else if (messages.value.some(m => m.id === change.id)) {
+      messages.value = messages.value.map(m => m.id === change.id ? change.data : m)
+    } else {
+      // Добавляем только продолжение загруженной ветки; другие ветки остаются на сервере
+      const loaded = messages.value.filter(m => m.session_id === change.data.session_id)
+      if (loaded.length && loaded[loaded.length - 1].id === change.data.parent_id) {
+        messages.value = [...messages.value, change.data]
+      }
+    }
+  }
+  
+  const syncChanges = async () => {
     try {
-      loading.value = true
-      const response = await fetch('/api/chat/send', {
-        method: 'POST',
+      // Первый запрос - без курсора: сервер ответит full_resync с текущим
+      // курсором, и он станет точкой отсчета для уже загруженных данных
+      const query = syncCursor.value === null ? '' : `?since=${encodeURIComponent(syncCursor.value)}`
+      const response = await fetch(`/api/sync${query}`, {
         headers: {
-          'Content-Type': 'application/json',
           'Authorization': `Bearer ${localStorage.getItem('chatbot_token')}`
-        },
-        body: JSON.stringify({ session_id: sessionId, message })
+        }
       })
       
+      if (!response.ok) {
+        throw new Error('Не удалось синхронизировать изменения')
+      }
+      
+      const data = await response.json()
+      
+      if (syncCursor.value === null) {
+        syncCursor.value = data.cursor
+        return data
+      }
+      
+      if (data.full_resync) {
+        // Часть истории изменений недоступна - загружаем данные заново
+        const loadedSessions = [...new Set(messages.value.map(m => m.session_id))]
+        messages.value = []
+        olderCursors.value = {}
+        await loadSessions()
+        for (const id of loadedSessions.filter(id => sessions.value.some(s => s.id === id))) {
+          await loadMessages(id)
+        }
+      } else {
+        data.changes.forEach(applyChange)
+      }
+      
+      syncCursor.value = data.cursor
+      return data.has_more ? syncChanges() : data
+    } catch (error) {
+      console.error('Error syncing changes:', error)
+      throw error
+    }
+  }
+  
+  const sendMessage = async (sessionId, message) => {
+    try {
+      loading.value = true
+      const response = await postIdempotent('/api/chat/send', { session_id: sessionId, message })
+      
       if (!response.ok) {
         throw new Error('Не удалось отправить сообщение')
       }
       
       const data = await response.json()
       
-      // Добавляем сообщения в локальное состояние
-      messages.value = [
-        ...messages.value,
-        { id: Date.now(), session_id: sessionId, role: 'user', content: message, created_at: new Date().toISOString() },
-        { id: Date.now() + 1, session_id: sessionId, role: 'assistant', content: data.response, created_at: new Date().toISOString() }
-      ]
+      // Добавляем сообщения в локальное состояние (синхронизация могла добавить их раньше)
+      const sent = [data.user_message, data.message].filter(m => !messages.value.some(existing => existing.id === m.id))
+      messages.value = [...messages.value, ...sent]
       
       // Обновляем заголовок сессии, если он стандартный
       const session = sessions.value.find(s => s.id === sessionId)
@@ -174,7 +322,64 @@ export const useChatStore = defineStore('chat', () => {
     }
   }
   
-  const regenerateLastResponse = async (sessionId) => {
+  // Пакет операций одним запросом: результаты приходят в том же порядке
+  const runBatch = async (operations) => {
+    const response = await fetch('/api/batch', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${localStorage.getItem('chatbot_token')}`
+      },
+      body: JSON.stringify({ operations })
+    })
+    
+    if (!response.ok) {
+      throw new Error('Не удалось выполнить пакет операций')
+    }
+    
+    const data = await response.json()
+    return data.results
+  }
+  
+  const deleteSessions = async (sessionIds) => {
+    try {
+      loading.value = true
+      const results = await runBatch(sessionIds.map(id => ({ op: 'delete_session', session_id: id })))
+      const deleted = sessionIds.filter((id, i) => results[i].status === 200)
+      
+      sessions.value = sessions.value.filter(s => !deleted.includes(s.id))
+      messages.value = messages.value.filter(m => !deleted.includes(m.session_id))
+      return deleted
+    } catch (error) {
+      console.error('Error deleting sessions:', error)
+      throw error
+    } finally {
+      loading.value = false
+    }
+  }
+  
+  // Предзагрузка последних сообщений нескольких сессий одним запросом
+  const prefetchMessages = async (sessionIds, limit = MESSAGES_PAGE_SIZE) => {
+    try {
+      const results = await runBatch(sessionIds.map(id => ({ op: 'list_messages', session_id: id, limit })))
+      results.forEach((result, i) => {
+        if (result.status !== 200) {
+          return
+        }
+        const page = result.result
+        const fresh = page.messages.filter(m => !messages.value.some(existing => existing.id === m.id))
+        messages.value = [...messages.value, ...fresh]
+        olderCursors.value[sessionIds[i]] = page.has_before && page.messages.length ? page.messages[0].seq : null
+      })
+      return results
+    } catch (error) {
+      console.error('Error prefetching messages:', error)
+      throw error
+    }
+  }
+  
+  // n > 1 - несколько вариантов за один запрос; все они доступны как соседние ветки
+  const regenerateLastResponse = async (sessionId, n = 1) => {
     try {
       loading.value = true
       
@@ -188,26 +393,11 @@ export const useChatStore = defineStore('chat', () => {
         throw new Error('Нет сообщений для перегенерации')
       }
       
-      // Удаляем последний ответ ассистента
-      const lastAssistantMessage = sessionMessages
-        .filter(m => m.role === 'assistant')
-        .slice(-1)[0]
-      
-      if (lastAssistantMessage) {
-        messages.value = messages.value.filter(m => m.id !== lastAssistantMessage.id)
-      }
-      
       // Отправляем то же сообщение заново
-      const response = await fetch('/api/chat/regenerate', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-          'Authorization': `Bearer ${localStorage.getItem('chatbot_token')}`
-        },
-        body: JSON.stringify({ 
-          session_id: sessionId, 
-          message_id: lastUserMessage.id 
-        })
+      const response = await postIdempotent('/api/chat/regenerate', {
+        session_id: sessionId,
+        message_id: lastUserMessage.id,
+        n
       })
       
       if (!response.ok) {
@@ -216,11 +406,8 @@ export const useChatStore = defineStore('chat', () => {
       
       const data = await response.json()
       
-      // Добавляем новый ответ
-      messages.value = [
-        ...messages.value,
-        { id: Date.now(), session_id: sessionId, role: 'assistant', content: data.response, created_at: new Date().toISOString() }
-      ]
+      // Активной стала ветка нового ответа; прежний доступен через переключатель вариантов
+      await reloadMessages(sessionId)
       
       return data.response
     } catch (error) {
@@ -284,10 +471,10 @@ export const useChatStore = defineStore('chat', () => {
         throw new Error('Не удалось удалить сообщение')
       }
       
-      // Удаляем сообщение и все последующие из локального состояния
-      const messageIndex = messages.value.findIndex(m => m.id === messageId)
-      if (messageIndex !== -1) {
-        messages.value = messages.value.slice(0, messageIndex)
+      // Вместе с сообщением удалена его ветка; активной может стать соседняя
+      const message = messages.value.find(m => m.id === messageId)
+      if (message) {
+        await reloadMessages(message.session_id)
       }
       
       return true
@@ -299,6 +486,87 @@ export const useChatStore = defineStore('chat', () => {
     }
   }
   
+  // Правка сообщения новой веткой: исходная переписка остается доступной
+  const forkMessage = async (messageId, newContent) => {
+    try {
+      loading.value = true
+      
+      const message = messages.value.find(m => m.id === messageId)
+      if (!message || message.role !== 'user') {
+        throw new Error('Нельзя редактировать это сообщение')
+      }
+      
+      const response = await fetch(`/api/messages/${messageId}/fork`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Authorization': `Bearer ${localStorage.getItem('chatbot_token')}`
+        },
+        body: JSON.stringify({ content: newContent })
+      })
+      
+      if (!response.ok) {
+        throw new Error('Не удалось отредактировать сообщение')
+      }
+      
+      const data = await response.json()
+      await reloadMessages(message.session_id)
+      return data.response
+    } catch (error) {
+      console.error('Error forking message:', error)
+      throw error
+    } finally {
+      loading.value = false
+    }
+  }
+  
+  // Альтернативы сообщения (включая его само) в порядке создания и позиция сообщения среди них
+  const loadSiblings = async (messageId) => {
+    try {
+      const response = await fetch(`/api/messages/${messageId}/siblings`, {
+        headers: {
+          'Authorization': `Bearer ${localStorage.getItem('chatbot_token')}`
+        }
+      })
+      
+      if (!response.ok) {
+        throw new Error('Не удалось загрузить варианты сообщения')
+      }
+      
+      return await response.json()
+    } catch (error) {
+      console.error('Error loading siblings:', error)
+      throw error
+    }
+  }
+  
+  // Переключение на ветку через messageId (например, на соседний вариант ответа)
+  const switchBranch = async (sessionId, messageId) => {
+    try {
+      loading.value = true
+      const response = await fetch(`/api/sessions/${sessionId}/branch`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Authorization': `Bearer ${localStorage.getItem('chatbot_token')}`
+        },
+        body: JSON.stringify({ message_id: messageId })
+      })
+      
+      if (!response.ok) {
+        throw new Error('Не удалось переключить ветку')
+      }
+      
+      await reloadMessages(sessionId)
+      return response.json()
+    } catch (error) {
+      console.error('Error switching branch:', error)
+      throw error
+    } finally {
+      loading.value = false
+    }
+  }
+  
   return {
     sessions,
     messages,
@@ -306,11 +574,20 @@ export const useChatStore = defineStore('chat', () => {
     loadSessions,
     createSession,
     loadMessages,
+    loadOlderMessages,
+    hasOlderMessages,
+    hasLoadedMessages,
+    syncChanges,
     sendMessage,
     updateSessionTitle,
     deleteSession,
+    deleteSessions,
+    prefetchMessages,
     regenerateLastResponse,
     editMessage,
+    forkMessage,
+    loadSiblings,
+    switchBranch,
     deleteMessage
   }
 })
@@ -1,21 +1,39 @@
 import os
+import time
+import shutil
 import subprocess
 import platform
+import threading
 import json
 from typing import Dict, Any, Optional
 import logging
 
+from local_inference.health_check import DiagnosticsRateLimited
+
 logger = logging.getLogger(__name__)
 
+# Версия формата профиля на диске: профиль другой версии определяется заново
+PROFILE_VERSION = 1
+
 
 class AutoConfig:
     """Класс для автоматической настройки локального инференса"""
     
-    def __init__(self):
+    def __init__(self, profile: Optional[Dict[str, Any]] = None):
+        """profile - ранее определенные system/gpu/cuda (из кэша); без него оборудование опрашивается"""
+        if profile is not None:
+            self.system_info = profile["system"]
+            self.gpu_info = profile["gpu"]
+            self.cuda_info = profile["cuda"]
+            return
         self.system_info = self._detect_system_info()
         self.gpu_info = self._detect_gpu_info()
         self.cuda_info = self._detect_cuda_info()
     
+    def get_profile(self) -> Dict[str, Any]:
+        """Определенное оборудование в виде для кэша"""
+        return {"system": self.system_info, "gpu": self.gpu_info, "cuda": self.cuda_info}
+    
     def _detect_system_info(self) -> Dict[str, Any]:
         """Определяет информацию о системе"""
         return {
@@ -54,7 +72,9 @@ class AutoConfig:
         }
         
         try:
-            # Проверяем NVIDIA GPU
+            # Проверяем NVIDIA GPU; без nvidia-smi в PATH - сразу проверка через PyTorch
+            if shutil.which('nvidia-smi') is None:
+                raise FileNotFoundError('nvidia-smi')
             result = subprocess.run(['nvidia-smi', '--query-gpu=name,memory.total,cores', '--format=csv,noheader,nounits'], 
                                   capture_output=True, text=True, timeout=10)
             
@@ -91,7 +111,9 @@ class AutoConfig:
         }
         
         try:
-            # Проверяем версию CUDA
+            # Проверяем версию CUDA; без nvcc в PATH - сразу проверка через PyTorch
+            if shutil.which('nvcc') is None:
+                raise FileNotFoundError('nvcc')
             result = subprocess.run(['nvcc', '--version'], capture_output=True, text=True, timeout=10)
             if result.returncode == 0:
                 for line in result.stdout.split('\n'):
@@ -156,7 +178,7 @@ class AutoConfig:
     
     def _calculate_batch_size(self) -> int:
         """Рассчитывает оптимальный размер батча на основе VRAM"""
-        vram_gb = self.gpu_info.get("vram_gb", 0)
+        vram_gb = self.gpu_info.get("vram_gb") or 0
         
         if vram_gb >= 12:
             return 8
@@ -181,11 +203,149 @@ class AutoConfig:
         logger.info(f"TensorRT enabled: {config['inference_settings']['use_tensorrt']}")
 
 
+def host_identity() -> Dict[str, Optional[str]]:
+    """
+    Идентичность машины и загрузки: профиль оборудования действителен, пока она не изменилась
+    После перезагрузки (новый boot_id) оборудование могло смениться - профиль определяется заново
+    """
+    def read(path: str) -> Optional[str]:
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+    
+    boot_id = read('/proc/sys/kernel/random/boot_id')
+    if boot_id is None:
+        try:
+            import psutil
+            boot_id = str(int(psutil.boot_time()))
+        except Exception:
+            boot_id = None
+    return {
+        "node": platform.node(),
+        "machine_id": read('/etc/machine-id'),
+        "boot_id": boot_id,
+    }
+
+
+class HardwareProfileCache:
+    """
+    Кэш профиля оборудования в памяти и на диске (HARDWARE_PROFILE_CACHE)
+    Опрос оборудования (nvidia-smi, nvcc, PyTorch) выполняется один раз на загрузку
+    машины: профиль на диске действителен при совпадении имени хоста, machine-id и
+    boot_id. Конфигурация строится и переменные окружения выставляются один раз на
+    процесс; повторное определение - refresh() (POST /config/refresh): одновременные
+    вызовы получают результат одного опроса, повторный раньше HARDWARE_REFRESH_MIN_INTERVAL
+    секунд - DiagnosticsRateLimited
+    """
+    
+    def __init__(self):
+        self.path = os.getenv('HARDWARE_PROFILE_CACHE', './cache/hardware_profile.json')
+        self.config: Optional[Dict[str, Any]] = None
+        # Откуда взят профиль: "disk" или "detected"; время определения (unix time)
+        self.source: Optional[str] = None
+        self.detected_at: Optional[float] = None
+        self.refresh_min_interval = float(os.getenv('HARDWARE_REFRESH_MIN_INTERVAL', '60'))
+        # Время последнего refresh() (monotonic)
+        self.refreshed_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.stats = {
+            "disk_loads": 0,
+            "detections": 0,
+        }
+    
+    def get(self) -> Dict[str, Any]:
+        """Конфигурация для текущего оборудования; опрос только при промахе кэша"""
+        if self.config is not None:
+            return self.config
+        with self._lock:
+            if self.config is None:
+                identity = host_identity()
+                profile = self._load(identity)
+                if profile is None:
+                    profile = self._detect(identity)
+                self.config = AutoConfig(profile).get_optimal_config()
+            return self.config
+    
+    def refresh(self) -> Dict[str, Any]:
+        """Определяет оборудование заново и перезаписывает кэш (опрос запускает подпроцессы)"""
+        requested_at = time.monotonic()
+        with self._lock:
+            if self.refreshed_at is not None and self.refreshed_at >= requested_at:
+                return self.config
+            if self.refreshed_at is not None and requested_at - self.refreshed_at < self.refresh_min_interval:
+                raise DiagnosticsRateLimited(
+                    self.refresh_min_interval - (requested_at - self.refreshed_at), "Hardware refresh"
+                )
+            profile = self._detect(host_identity())
+            self.config = AutoConfig(profile).get_optimal_config()
+            self.refreshed_at = time.monotonic()
+            return self.config
+    
+    def _detect(self, identity: Dict[str, Optional[str]]) -> Dict[str, Any]:
+        start_time = time.time()
+        profile = AutoConfig().get_profile()
+        self.stats["detections"] += 1
+        self.source = "detected"
+        self.detected_at = time.time()
+        logger.info(f"Hardware profile detected in {self.detected_at - start_time:.2f}s")
+        self._save(identity, profile)
+        return profile
+    
+    def _load(self, identity: Dict[str, Optional[str]]) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read hardware profile cache {self.path}: {e}")
+            return None
+        if data.get("version") != PROFILE_VERSION or data.get("identity") != identity:
+            logger.info("Hardware profile cache is for another host or boot, detecting again")
+            return None
+        self.stats["disk_loads"] += 1
+        self.source = "disk"
+        self.detected_at = data.get("detected_at")
+        return data["profile"]
+    
+    def _save(self, identity: Dict[str, Optional[str]], profile: Dict[str, Any]):
+        """Запись через временный файл: прерванная запись не оставляет испорченный кэш"""
+        data = {
+            "version": PROFILE_VERSION,
+            "identity": identity,
+            "detected_at": self.detected_at,
+            "profile": profile,
+        }
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2, default=str)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to write hardware profile cache {self.path}: {e}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "source": self.source,
+            "detected_at": self.detected_at,
+            **self.stats,
+        }
+
+
+# Глобальный экземпляр кэша профиля оборудования
+hardware_profile = HardwareProfileCache()
+
+
 # Функция для получения конфигурации
 def get_auto_config() -> Dict[str, Any]:
-    """Возвращает автоматически сгенерированную конфигурацию"""
-    auto_config = AutoConfig()
-    return auto_config.get_optimal_config()
+    """Возвращает автоматически сгенерированную конфигурацию (из кэша профиля оборудования)"""
+    return hardware_profile.get()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 import os
 import time
-from typing import Optional
+import random
+from typing import Iterator, List, Optional
 import logging
 
 logger = logging.getLogger(__name__)
@@ -55,6 +56,42 @@ class PythonInferenceEngine:
         
         return result
     
+    def generate_stream(self, input_text: str, max_length: int = 100) -> Iterator[str]:
+        """Генерация по частям (по словам с пробелом); склеенные части совпадают с результатом generate"""
+        result = self.generate(input_text, max_length)
+        start = 0
+        while start < len(result):
+            end = result.find(" ", start)
+            end = len(result) if end == -1 else end + 1
+            yield result[start:end]
+            start = end
+    
+    def prefill(self, input_text: str) -> str:
+        """
+        Обработка промпта, общая для всех вариантов ответа
+        В реальной модели здесь заполняется KV-кэш; пока - нормализация текста
+        """
+        return " ".join(input_text.split())
+    
+    def decode(self, state: str, max_length: int, seed: int) -> str:
+        """Декодирование одного варианта по результату prefill со своим seed сэмплирования"""
+        rng = random.Random(seed)
+        variant = rng.randrange(1000)
+        return (f"Python fallback inference result for: '{state}' "
+                f"(max_length: {max_length}, device: {self.device}, variant: {variant})")
+    
+    def generate_candidates(self, input_text: str, max_length: int, seeds: List[int]) -> List[str]:
+        """Несколько вариантов ответа: prefill выполняется один раз, декодирование - для каждого seed"""
+        if not self.model_loaded:
+            raise RuntimeError("Model not loaded")
+        
+        start_time = time.time()
+        state = self.prefill(input_text)
+        candidates = [self.decode(state, max_length, seed) for seed in seeds]
+        
+        logger.info(f"Python inference of {len(seeds)} candidates completed in {time.time() - start_time:.2f}s")
+        return candidates
+    
     def is_cuda_available(self) -> bool:
         """Проверяет, доступна ли CUDA"""
         return self.device == "cuda"
\ No newline at end of file
@@ -1,29 +1,72 @@
+import os
 import asyncio
 import time
 import logging
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
 
+class DiagnosticsRateLimited(Exception):
+    """
+    Дорогая диагностика запрошена раньше минимального интервала после предыдущей:
+    глубокая проверка (HEALTH_DEEP_MIN_INTERVAL) или повторное определение оборудования
+    (HARDWARE_REFRESH_MIN_INTERVAL)
+    """
+    
+    def __init__(self, retry_after: float, operation: str = "Deep health check"):
+        super().__init__(f"{operation} is rate limited, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
 class HealthChecker:
-    """Класс для проверки работоспособности локального инференса"""
+    """
+    Класс для проверки работоспособности локального инференса
+    Проверки не выполняются в обработчиках запросов: фоновая задача раз в
+    HEALTH_REFRESH_INTERVAL секунд обновляет снимок (без генерации), а /readyz и /health
+    отдают его с возрастом; снимок старше HEALTH_STALE_AFTER считается устаревшим.
+    Глубокая проверка с тестовыми генерациями выполняется только по явному запросу
+    и не чаще раза в HEALTH_DEEP_MIN_INTERVAL секунд
+    """
     
     def __init__(self):
         self.start_time = time.time()
         self.check_results = {}
+        self.refresh_interval = float(os.getenv('HEALTH_REFRESH_INTERVAL', '15'))
+        self.stale_after = float(os.getenv('HEALTH_STALE_AFTER', str(self.refresh_interval * 3)))
+        self.deep_min_interval = float(os.getenv('HEALTH_DEEP_MIN_INTERVAL', '60'))
+        self.snapshot: Optional[Dict[str, Any]] = None
+        # Время снимка и последней глубокой проверки (monotonic)
+        self.snapshot_at: Optional[float] = None
+        self.deep_at: Optional[float] = None
+        self.deep_report: Optional[Dict[str, Any]] = None
+        self._deep_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
     
-    async def check_model_health(self) -> Dict[str, Any]:
-        """Проверяет работоспособность модели"""
+    async def check_model_health(self, deep: bool = False) -> Dict[str, Any]:
+        """Проверяет работоспособность модели; тестовая генерация - только при глубокой проверке"""
         from local_inference.model_loader import get_model_loader
         
         start_time = time.time()
         model_loader = get_model_loader()
         
+        if not model_loader.is_ready():
+            # Модель еще загружается в фоне или не загрузилась
+            loading = model_loader.get_status()
+            return {
+                "status": "unhealthy" if loading["state"] == "failed" else "warning",
+                "model_loaded": False,
+                "loading": loading,
+                "last_check": datetime.now().isoformat()
+            }
+        
         try:
-            # Выполняем короткую генерацию для проверки
-            test_result = model_loader.generate("health check", max_length=5)
+            if deep:
+                # Выполняем короткую генерацию для проверки (в пуле потоков: генерация блокирует)
+                await asyncio.to_thread(model_loader.generate, "health check", max_length=5)
+            elif model_loader.rust_engine is None and model_loader.fallback_engine is None:
+                raise RuntimeError("No available inference engine")
             
             response_time = time.time() - start_time
             
@@ -31,6 +74,7 @@ class HealthChecker:
                 "status": "healthy",
                 "response_time": response_time,
                 "model_loaded": True,
+                "generation_tested": deep,
                 "cuda_available": model_loader.is_cuda_available(),
                 "using_rust": model_loader.use_rust,
                 "last_check": datetime.now().isoformat()
@@ -46,13 +90,17 @@ class HealthChecker:
             }
     
     async def check_system_health(self) -> Dict[str, Any]:
-        """Проверяет системные ресурсы"""
+        """Проверяет системные ресурсы (psutil читает /proc и датчики - в потоке, не в цикле событий)"""
+        return await asyncio.to_thread(self._system_health)
+    
+    def _system_health(self) -> Dict[str, Any]:
         import psutil
         import os
         
         try:
             # Получаем информацию о системе
-            cpu_percent = psutil.cpu_percent(interval=1)
+            # Загрузка CPU с предыдущего обновления снимка: без секундного замера
+            cpu_percent = psutil.cpu_percent(interval=None)
             memory = psutil.virtual_memory()
             disk = psutil.disk_usage('/')
             
@@ -86,7 +134,10 @@ class HealthChecker:
             }
     
     async def check_gpu_health(self) -> Dict[str, Any]:
-        """Проверяет работоспособность GPU"""
+        """Проверяет работоспособность GPU (импорт torch и запросы к CUDA - в потоке, не в цикле событий)"""
+        return await asyncio.to_thread(self._gpu_health)
+    
+    def _gpu_health(self) -> Dict[str, Any]:
         try:
             import torch
             
@@ -131,19 +182,18 @@ class HealthChecker:
             }
     
     async def check_rust_health(self) -> Dict[str, Any]:
-        """Проверяет работоспособность Rust-модуля"""
+        """Проверяет работоспособность Rust-модуля по уже загруженному движку (новый не создается)"""
         try:
             import chatbot_inference
+            from local_inference.model_loader import get_model_loader
             
-            # Создаем тестовый движок
-            test_engine = chatbot_inference.RustInferenceEngine("./test_model", False)
-            
-            # Проверяем статистику
-            stats = test_engine.get_performance_stats()
+            rust_engine = get_model_loader().rust_engine
+            stats = rust_engine.get_performance_stats() if rust_engine is not None else {}
             
             return {
                 "status": "healthy",
                 "available": True,
+                "engine_loaded": rust_engine is not None,
                 "performance_stats": dict(stats),
                 "last_check": datetime.now().isoformat()
             }
@@ -163,11 +213,11 @@ class HealthChecker:
                 "last_check": datetime.now().isoformat()
             }
     
-    async def check_health(self) -> Dict[str, Any]:
+    async def check_health(self, deep: bool = False) -> Dict[str, Any]:
         """Полная проверка работоспособности"""
         # Запускаем все проверки параллельно
         results = await asyncio.gather(
-            self.check_model_health(),
+            self.check_model_health(deep),
             self.check_system_health(),
             self.check_gpu_health(),
             self.check_rust_health(),
@@ -198,15 +248,91 @@ class HealthChecker:
         
         return health_report
     
+    async def refresh(self):
+        """Обновляет снимок состояния"""
+        self.snapshot = await self.check_health()
+        self.snapshot_at = time.monotonic()
+    
+    async def _refresh_periodically(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Health snapshot refresh failed: {e}")
+            await asyncio.sleep(self.refresh_interval)
+    
+    def start(self):
+        """Запускает фоновое обновление снимка (из цикла событий)"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_periodically())
+    
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def liveness(self) -> Dict[str, Any]:
+        """Процесс жив и обслуживает запросы; никаких проверок не выполняется"""
+        return {"status": "alive", "uptime_seconds": round(time.time() - self.start_time, 1)}
+    
+    def readiness(self) -> Dict[str, Any]:
+        """
+        Последний снимок с возрастом; ready - модель загружена, снимок свежий и модель работоспособна
+        Проблемы GPU и Rust-модуля готовность не снимают: генерация идет через fallback
+        """
+        from local_inference.model_loader import get_model_loader
+        model = get_model_loader().get_status()
+        if self.snapshot is None:
+            return {"ready": False, "overall_status": "starting", "age_seconds": None, "stale": True, "model": model}
+        age = time.monotonic() - self.snapshot_at
+        stale = age > self.stale_after
+        return {
+            **self.snapshot,
+            "ready": (model["state"] == "ready" and not stale
+                      and self.snapshot["checks"]["model"].get("status") == "healthy"),
+            "age_seconds": round(age, 1),
+            "stale": stale,
+            "model": model,
+        }
+    
+    async def deep_check(self) -> Dict[str, Any]:
+        """
+        Глубокая проверка: тестовые генерации и диагностика производительности
+        Одновременные запросы получают результат одной проверки; повторная раньше
+        HEALTH_DEEP_MIN_INTERVAL - DiagnosticsRateLimited
+        """
+        requested_at = time.monotonic()
+        async with self._deep_lock:
+            if self.deep_at is not None and self.deep_at >= requested_at:
+                return self.deep_report
+            if self.deep_at is not None and requested_at - self.deep_at < self.deep_min_interval:
+                raise DiagnosticsRateLimited(self.deep_min_interval - (requested_at - self.deep_at))
+            report = await self.check_health(deep=True)
+            report.update(await self.perform_detailed_diagnostics())
+            self.deep_report = report
+            self.deep_at = time.monotonic()
+            return report
+    
     async def perform_detailed_diagnostics(self) -> Dict[str, Any]:
         """Выполняет детальную диагностику системы"""
         from local_inference.auto_config import get_auto_config
         
-        config = get_auto_config()
+        # При промахе кэша определение оборудования запускает nvidia-smi и nvcc: вне цикла событий
+        config = await asyncio.to_thread(get_auto_config)
         
         # Выполняем тестовую генерацию с разными параметрами
         from local_inference.model_loader import get_model_loader
         model_loader = get_model_loader()
+        if not model_loader.is_ready():
+            # Тестовые генерации обратились бы к движку, который еще загружается или не загрузился
+            return {
+                "diagnostics": {
+                    "system_config": config,
+                    "performance_tests": [],
+                    "skipped": f"Model is not ready ({model_loader.state})",
+                    "timestamp": datetime.now().isoformat()
+                }
+            }
         
         performance_tests = []
         
@@ -214,7 +340,7 @@ class HealthChecker:
         for max_length in [10, 50, 100]:
             start_time = time.time()
             try:
-                result = model_loader.generate("Test prompt for performance", max_length=max_length)
+                result = await asyncio.to_thread(model_loader.generate, "Test prompt for performance", max_length=max_length)
                 processing_time = time.time() - start_time
                 
                 performance_tests.append({
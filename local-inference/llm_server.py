@@ -1,16 +1,26 @@
 import os
 import json
+import time
+import random
 import asyncio
 import logging
 from datetime import datetime
-from typing import Dict, Any, Optional
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Iterator, List, Literal, Optional, Tuple
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Header, Depends
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 
 from local_inference.model_loader import get_model_loader
-from local_inference.health_check import HealthChecker
+from local_inference.health_check import HealthChecker, DiagnosticsRateLimited
+from local_inference.single_flight import single_flight
+from local_inference.scheduler import scheduler, AdmissionRejected, DeadlineExceeded
+from local_inference.metrics import metrics, MetricsMiddleware
+from local_inference.tracing import tracer, TracingMiddleware
+from local_inference.loop_monitor import loop_monitor
+from local_inference.auto_config import hardware_profile
 
 # Настройка логирования
 logging.basicConfig(
@@ -24,6 +34,8 @@ app = FastAPI(
     description="High-performance local LLM inference server with Rust optimization",
     version="1.0.0"
 )
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+app.add_middleware(TracingMiddleware, tracer=tracer)
 
 # Загружаем модель
 model_loader = get_model_loader()
@@ -31,6 +43,45 @@ model_loader = get_model_loader()
 # Создаем health checker
 health_checker = HealthChecker()
 
+# Очередь планировщика и объединение запросов в /metrics
+metrics.gauge("inference_queue_depth", "Requests waiting for a model slot", lambda: scheduler.queued)
+metrics.gauge("inference_running_generations", "Generations holding a model slot", lambda: len(scheduler.running))
+metrics.register_stats({
+    "inference_scheduler": (scheduler.get_stats, {
+        "admitted": "counter", "rejected_deadline": "counter", "rejected_queue_full": "counter",
+        "expired": "counter", "completed": "counter", "predicted_wait": "gauge",
+    }),
+    "inference_single_flight": (single_flight.get_stats, {
+        "started": "counter", "coalesced": "counter", "cancelled": "counter", "deadline_exceeded": "counter",
+    }),
+    "inference_event_loop": (loop_monitor.get_stats, {
+        "max_lag_seconds": "gauge", "stalls": "counter", "failed_handlers": "counter",
+    }),
+    "inference_startup": (lambda: startup_timing, {"time_to_startup_complete": "gauge", "time_to_ready": "gauge"}),
+})
+
+# Максимальное число вариантов ответа в одном запросе /generate
+MAX_CANDIDATES = int(os.getenv('MAX_GENERATE_CANDIDATES', '8'))
+# seed передается движку как u64; seed варианта i - (seed + i) по модулю 2^64
+MAX_SEED = 2 ** 64 - 1
+# Интервал проверки отключения клиента, пока /generate ждет генерацию
+DISCONNECT_POLL_INTERVAL = float(os.getenv('DISCONNECT_POLL_INTERVAL', '0.5'))
+# Стоимость токена промпта (prefill) относительно генерируемого токена для планировщика
+PREFILL_TOKEN_COST = float(os.getenv('PREFILL_TOKEN_COST', '0.1'))
+# Сколько запрос, пришедший во время загрузки модели, ждет ее готовности до ответа 503
+MODEL_READY_WAIT = float(os.getenv('MODEL_READY_WAIT', '10'))
+# Retry-After для запросов, не дождавшихся загрузки модели
+MODEL_LOADING_RETRY_AFTER = 5
+
+# Модель загружается в фоне после запуска сервера; событие - загрузка завершена (успешно или нет)
+model_ready = asyncio.Event()
+model_loading_task: Optional[asyncio.Task] = None
+# Секунды от запуска процесса до конца startup-обработчиков (после них uvicorn открывает сокет)
+# и до готовности модели
+startup_timing: Dict[str, Optional[float]] = {"time_to_startup_complete": None, "time_to_ready": None}
+# Запасная точка отсчета, если время запуска процесса недоступно
+SERVER_IMPORTED_AT = time.time()
+
 
 class GenerateRequest(BaseModel):
     prompt: str
@@ -38,13 +89,26 @@ class GenerateRequest(BaseModel):
     temperature: float = 0.7
     top_p: float = 0.9
     top_k: int = 50
+    # Число вариантов ответа с общим prefill; seed первого варианта, у i-го - seed + i
+    n: int = Field(1, ge=1, le=MAX_CANDIDATES)
+    seed: Optional[int] = Field(None, ge=0, le=MAX_SEED)
+    # Класс приоритета в очереди: ответы в чате или фоновые задачи (суммаризация и т.п.)
+    priority: Literal["interactive", "background"] = "interactive"
+
+
+class GenerationCandidate(BaseModel):
+    text: str
+    seed: Optional[int] = None
 
 
 class GenerateResponse(BaseModel):
     generated_text: str
+    candidates: List[GenerationCandidate]
     model_info: Dict[str, Any]
     processing_time: float
     timestamp: str
+    # "deadline" - генерация прервана по дедлайну запроса, текст неполный
+    finish_reason: str = "stop"
 
 
 @app.get("/")
@@ -57,24 +121,242 @@ async def root():
     }
 
 
+@app.get("/livez")
+async def liveness():
+    """Проверка, что процесс жив: ничего не проверяет и ничего не стоит"""
+    return health_checker.liveness()
+
+
+@app.get("/readyz")
+async def readiness():
+    """Готовность по снимку фоновой проверки; 503 - снимка нет, он устарел или модель неработоспособна"""
+    status = health_checker.readiness()
+    status["startup"] = startup_timing
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+
 @app.get("/health")
 async def health_check():
-    """Проверка работоспособности сервера"""
-    health_status = await health_checker.check_health()
+    """Проверка работоспособности сервера: снимок фоновой проверки и статистика компонентов"""
+    health_status = health_checker.readiness()
+    health_status["startup"] = startup_timing
+    health_status["single_flight"] = single_flight.get_stats()
+    health_status["scheduler"] = scheduler.get_stats()
+    health_status["event_loop"] = loop_monitor.get_stats()
     return health_status
 
 
+def rate_limited_response(error: DiagnosticsRateLimited) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(error), "retry_after": round(error.retry_after, 1)},
+        headers={"Retry-After": str(max(1, round(error.retry_after)))}
+    )
+
+
+@app.get("/health/deep")
+async def deep_health_check():
+    """Глубокая проверка с тестовыми генерациями; не чаще HEALTH_DEEP_MIN_INTERVAL, иначе 429"""
+    try:
+        return await health_checker.deep_check()
+    except DiagnosticsRateLimited as e:
+        return rate_limited_response(e)
+
+
+def generation_key(request: GenerateRequest) -> Optional[Tuple]:
+    """
+    Ключ объединения одинаковых запросов: промпт и все параметры сэмплирования
+    Объединяется только детерминированная генерация (явный seed или temperature 0)
+    """
+    if request.seed is None and request.temperature > 0:
+        return None
+    return (request.prompt, request.max_length, request.temperature, request.top_p,
+            request.top_k, request.n, request.seed)
+
+
+def produce_candidates(request: GenerateRequest) -> Iterator[Tuple[int, Optional[int], str]]:
+    """
+    События генерации (номер варианта, seed, фрагмент текста); выполняется в потоке пула
+    Один вариант без seed генерируется потоково, несколько - с общим prefill.
+    Сборка движка без поддержки seed генерирует один вариант без него (seed в ответе - None)
+    """
+    if request.n == 1 and (request.seed is None or not model_loader.supports_seeds()):
+        for chunk in model_loader.generate_stream(request.prompt, request.max_length):
+            yield 0, None, chunk
+        return
+    
+    base_seed = request.seed if request.seed is not None else random.getrandbits(32)
+    seeds = [(base_seed + i) & MAX_SEED for i in range(request.n)]
+    texts = model_loader.generate_candidates(request.prompt, request.max_length, seeds)
+    for index, (text, seed) in enumerate(zip(texts, seeds)):
+        yield index, seed, text
+
+
+def check_engine_support(request: GenerateRequest):
+    """Отклоняет n > 1, если загруженная сборка движка не принимает seed (варианты были бы одинаковыми)"""
+    if request.n > 1 and not model_loader.supports_seeds():
+        raise HTTPException(status_code=422, detail="n > 1 is not supported by the loaded inference engine")
+
+
+def estimate_cost(request: GenerateRequest) -> float:
+    """Стоимость запроса для планировщика в генерируемых токенах (~4 символа промпта на токен)"""
+    return request.max_length * request.n + len(request.prompt) / 4 * PREFILL_TOKEN_COST
+
+
+def admit(request: GenerateRequest, key: Optional[Tuple], user_id: Optional[str], deadline: Optional[float]):
+    """
+    Постановка генерации в очередь планировщика; возвращает контекст слота модели
+    Запрос, присоединяющийся к уже идущей генерации, очереди не занимает
+    """
+    if single_flight.is_running(key):
+        return None
+    cost = estimate_cost(request)
+    scheduler.check_admission(request.priority, cost, deadline)
+    return lambda: model_slot(user_id or "anonymous", request.priority, cost, deadline)
+
+
+@asynccontextmanager
+async def model_slot(user_id: str, priority: str, cost: float, deadline: Optional[float]):
+    """Слот планировщика с замером этапов: ожидание в очереди (queue) и работа модели (model)"""
+    queued_at = time.perf_counter()
+    async with scheduler.slot(user_id, priority, cost, deadline):
+        tracer.record("queue", time.perf_counter() - queued_at)
+        with tracer.span("model"):
+            yield
+
+
+def request_deadline(x_request_budget_ms: Optional[float] = Header(None, ge=0)) -> Optional[float]:
+    """
+    Дедлайн запроса по часам этого сервера (unix time)
+    Клиент передает оставшееся время в миллисекундах, а не момент времени: часы хостов могут расходиться
+    """
+    if x_request_budget_ms is None:
+        return None
+    return time.time() + x_request_budget_ms / 1000
+
+
+def finish_reason(deadline: Optional[float]) -> str:
+    """Причина окончания генерации: дедлайн запроса прошел - текст мог быть оборван"""
+    return "deadline" if deadline is not None and time.time() >= deadline else "stop"
+
+
+async def wait_for_model(deadline: Optional[float]) -> Optional[JSONResponse]:
+    """
+    Ждет загрузки модели не дольше MODEL_READY_WAIT и дедлайна запроса
+    None - модель готова; иначе ответ 503 с ходом загрузки
+    """
+    if model_loader.is_ready():
+        return None
+    if model_loader.state != "failed":
+        timeout = MODEL_READY_WAIT if deadline is None else min(MODEL_READY_WAIT, deadline - time.time())
+        try:
+            await asyncio.wait_for(model_ready.wait(), timeout=max(0.0, timeout))
+        except asyncio.TimeoutError:
+            pass
+        if model_loader.is_ready():
+            return None
+    
+    status = model_loader.get_status()
+    if status["state"] == "failed":
+        return JSONResponse(status_code=503, content={"detail": "Model failed to load", "model": status})
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Model is loading", "model": status},
+        headers={"Retry-After": str(MODEL_LOADING_RETRY_AFTER)}
+    )
+
+
+def expired_response() -> JSONResponse:
+    """Дедлайн истек до начала генерации: модель запрос не обрабатывала, ответа нет"""
+    return JSONResponse(status_code=504, content={"detail": "Request deadline exceeded before generation started"})
+
+
+def rejected_response(error: AdmissionRejected) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"detail": error.reason, "retry_after": round(error.retry_after, 3)},
+        headers={"Retry-After": str(max(1, round(error.retry_after)))}
+    )
+
+
+async def until_disconnected(http_request: Request, awaitable):
+    """
+    Ждет результат, периодически проверяя, не отключился ли клиент
+    При отключении ожидание отменяется: общая генерация прерывается, если клиент был последним
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        task.cancel()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в формате Prometheus"""
+    data, content_type = metrics.render()
+    return Response(content=data, media_type=content_type)
+
+
+def instrumented(request: GenerateRequest, received_at: float):
+    """Генерация для single_flight с записью метрик (время до первого фрагмента, скорость)"""
+    return lambda: metrics.instrument(produce_candidates(request), received_at, request.n)
+
+
 @app.post("/generate", response_model=GenerateResponse)
-async def generate_text(request: GenerateRequest, background_tasks: BackgroundTasks):
-    """Генерация текста с использованием локальной модели"""
+async def generate_text(
+    request: GenerateRequest,
+    http_request: Request,
+    background_tasks: BackgroundTasks,
+    x_user_id: Optional[str] = Header(None),
+    deadline: Optional[float] = Depends(request_deadline)
+):
+    """
+    Генерация текста с использованием локальной модели
+    С n > 1 возвращает n вариантов: промпт обрабатывается один раз, а варианты
+    отличаются seed сэмплирования (seed запроса + номер варианта или случайные).
+    Одинаковые одновременные детерминированные запросы разделяют одну генерацию.
+    Очередь к модели справедливо делится между пользователями (X-User-Id); запрос,
+    который не успеет к дедлайну (X-Request-Budget-Ms), сразу получает 503, а запрос,
+    дедлайн которого истек до начала генерации, - 504. Если дедлайн наступает во время
+    генерации, возвращается уже сгенерированная часть текста (варианты при n > 1
+    появляются только целиком) с finish_reason "deadline"
+    """
     start_time = asyncio.get_event_loop().time()
+    received_at = time.perf_counter()
+    unavailable = await wait_for_model(deadline)
+    if unavailable is not None:
+        return unavailable
+    check_engine_support(request)
+    key = generation_key(request)
+    try:
+        gate = admit(request, key, x_user_id, deadline)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except DeadlineExceeded:
+        return expired_response()
     
     try:
-        # Выполняем генерацию текста
-        generated_text = model_loader.generate(
-            request.prompt, 
-            request.max_length
-        )
+        try:
+            events = await until_disconnected(
+                http_request, single_flight.collect(key, instrumented(request, received_at), gate, deadline)
+            )
+        except DeadlineExceeded:
+            # Дедлайн истек в очереди: пустой текст - не ответ модели
+            return expired_response()
+        
+        texts: List[str] = [""] * request.n
+        seeds: List[Optional[int]] = [None] * request.n
+        for index, seed, chunk in events:
+            texts[index] += chunk
+            seeds[index] = seed
+        candidates = [GenerationCandidate(text=text, seed=seed) for text, seed in zip(texts, seeds)]
+        generated_text = candidates[0].text
         
         processing_time = asyncio.get_event_loop().time() - start_time
         
@@ -86,59 +368,169 @@ async def generate_text(request: GenerateRequest, background_tasks: BackgroundTa
         
         response = GenerateResponse(
             generated_text=generated_text,
+            candidates=candidates,
             model_info=model_info,
             processing_time=processing_time,
-            timestamp=datetime.now().isoformat()
+            timestamp=datetime.now().isoformat(),
+            finish_reason=finish_reason(deadline)
         )
         
-        logger.info(f"Generated text in {processing_time:.2f}s")
+        logger.info(f"Generated {len(candidates)} candidate(s) in {processing_time:.2f}s "
+                    f"(finish reason: {response.finish_reason})")
         
         return response
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error during text generation: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Generation error: {str(e)}")
 
 
-@app.get("/config")
-async def get_config():
-    """Возвращает текущую конфигурацию сервера"""
-    from local_inference.auto_config import get_auto_config
-    config = get_auto_config()
+@app.post("/generate/stream")
+async def generate_text_stream(
+    request: GenerateRequest,
+    x_user_id: Optional[str] = Header(None),
+    deadline: Optional[float] = Depends(request_deadline)
+):
+    """
+    Потоковая генерация в формате NDJSON: строки {"candidate", "seed", "text"} с фрагментами
+    текста, затем {"done": true, "finish_reason", ...} или {"error": ...}. Отключение клиента
+    отменяет генерацию, если ее не ждут другие клиенты с таким же запросом; в дедлайн
+    (X-Request-Budget-Ms) поток завершается с finish_reason "deadline", а если генерация
+    так и не началась - 504 до начала потока или {"error", "status": "expired"} в нем
+    """
+    start_time = asyncio.get_event_loop().time()
+    received_at = time.perf_counter()
+    unavailable = await wait_for_model(deadline)
+    if unavailable is not None:
+        return unavailable
+    check_engine_support(request)
+    key = generation_key(request)
+    try:
+        gate = admit(request, key, x_user_id, deadline)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except DeadlineExceeded:
+        return expired_response()
     
+    async def stream():
+        try:
+            async for index, seed, chunk in single_flight.stream(key, instrumented(request, received_at),
+                                                                 gate, deadline):
+                yield json.dumps({"candidate": index, "seed": seed, "text": chunk}, ensure_ascii=False) + "\n"
+        except DeadlineExceeded:
+            yield json.dumps({"error": "Request deadline exceeded before generation started",
+                              "status": "expired"}) + "\n"
+            return
+        except Exception as e:
+            logger.error(f"Error during streaming generation: {str(e)}")
+            yield json.dumps({"error": f"Generation error: {str(e)}"}) + "\n"
+            return
+        
+        processing_time = asyncio.get_event_loop().time() - start_time
+        yield json.dumps({
+            "done": True,
+            "finish_reason": finish_reason(deadline),
+            "processing_time": processing_time,
+            "timestamp": datetime.now().isoformat()
+        }) + "\n"
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+def server_config(config: Dict[str, Any]) -> Dict[str, Any]:
     return {
         "config": config,
         "environment": {
             "cuda_arch": os.getenv("CUDA_ARCH", "not set"),
             "rust_cuda_arch": os.getenv("RUST_CUDA_ARCH", "not set"),
             "rust_acceleration": os.getenv("RUST_ACCELERATION", "true"),
+            "inference_engine": model_loader.engine,
         },
         "model_loader_status": {
             "using_rust": model_loader.use_rust,
             "cuda_available": model_loader.is_cuda_available()
-        }
+        },
+        "hardware_profile": hardware_profile.get_stats()
     }
 
 
+@app.get("/config")
+async def get_config():
+    """Возвращает текущую конфигурацию сервера; профиль оборудования берется из кэша"""
+    config = hardware_profile.config or await asyncio.to_thread(hardware_profile.get)
+    return server_config(config)
+
+
+@app.post("/config/refresh")
+async def refresh_config():
+    """
+    Определяет оборудование заново (например, после замены GPU без перезагрузки)
+    Не чаще HARDWARE_REFRESH_MIN_INTERVAL, иначе 429: опрос запускает nvidia-smi и nvcc
+    """
+    try:
+        config = await asyncio.to_thread(hardware_profile.refresh)
+    except DiagnosticsRateLimited as e:
+        return rate_limited_response(e)
+    return server_config(config)
+
+
+def process_uptime() -> float:
+    """Секунды с запуска процесса (включая импорт модулей до старта сервера)"""
+    try:
+        import psutil
+        return time.time() - psutil.Process().create_time()
+    except Exception:
+        return time.time() - SERVER_IMPORTED_AT
+
+
+async def load_model():
+    """Фоновая загрузка и прогрев модели; по завершении снимок готовности обновляется сразу"""
+    try:
+        await asyncio.to_thread(model_loader.load)
+        startup_timing["time_to_ready"] = round(process_uptime(), 3)
+        logger.info(f"CUDA available: {model_loader.is_cuda_available()}")
+        logger.info(f"Using Rust optimization: {model_loader.use_rust}")
+        logger.info(f"Model ready {startup_timing['time_to_ready']}s after process start "
+                    f"({model_loader.get_status()})")
+    except Exception as e:
+        logger.error(f"Model loading failed: {e}")
+    finally:
+        model_ready.set()
+    await health_checker.refresh()
+
+
 @app.on_event('startup')
 async def startup_event():
     """Действия при запуске сервера"""
+    global model_loading_task
     logger.info("Starting Local LLM Inference Server...")
-    logger.info(f"CUDA available: {model_loader.is_cuda_available()}")
-    logger.info(f"Using Rust optimization: {model_loader.use_rust}")
+    # Профиль оборудования из кэша на диске; опрос nvidia-smi/nvcc - только на новой загрузке машины
+    await asyncio.to_thread(hardware_profile.get)
     
-    # Выполняем тестовую генерацию для проверки работоспособности
-    try:
-        test_result = model_loader.generate("Hello, world!", max_length=10)
-        logger.info(f"Model test successful: {test_result[:50]}...")
-    except Exception as e:
-        logger.error(f"Model test failed: {e}")
+    # Модель загружается и прогревается в фоне: сервер принимает запросы сразу,
+    # /readyz показывает ход загрузки, а генерации ждут ее не дольше MODEL_READY_WAIT
+    model_loading_task = asyncio.create_task(load_model())
+    loop_monitor.start(metrics.event_loop_lag.observe)
+    health_checker.start()
+    startup_timing["time_to_startup_complete"] = round(process_uptime(), 3)
+    logger.info(f"Startup complete {startup_timing['time_to_startup_complete']}s after process start, "
+                f"model is loading in the background")
 
 
 @app.on_event('shutdown')
 async def shutdown_event():
     """Действия при выключении сервера"""
     logger.info("Shutting down Local LLM Inference Server...")
+    if model_loading_task is not None:
+        # Отмена задачи не останавливает поток загрузки (asyncio.to_thread): model_loader.cancel()
+        # прерывает его на ближайшей проверке, а начатый этап (инициализация движка, прогон
+        # прогрева) доработает - выход процесса дождется его
+        model_loader.cancel()
+        model_loading_task.cancel()
+    loop_monitor.stop()
+    health_checker.stop()
 
 
 if __name__ == "__main__":
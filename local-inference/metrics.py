@@ -0,0 +1,205 @@
+import os
+import time
+import logging
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм задержки (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320, 640, 1280)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32)
+# Маршрут запросов, не совпавших ни с одним эндпоинтом: путь в метку не попадает
+UNMATCHED_ROUTE = "unmatched"
+# Средняя длина токена в символах: движки отдают текст, а не токены
+CHARS_PER_TOKEN = 4
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: задержка и число HTTP-запросов по шаблону маршрута"""
+
+    def __init__(self, app, metrics: "InferenceMetrics"):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", UNMATCHED_ROUTE)
+            method = scope["method"]
+            self.metrics.request_duration.labels(method, path).observe(time.perf_counter() - start)
+            self.metrics.requests.labels(method, path, str(status)).inc()
+
+
+class _StatsCollector:
+    """Счетчики из статистики компонентов (get_stats), считываемые в момент опроса /metrics"""
+
+    def __init__(self, sources: Dict[str, Tuple[Callable[[], dict], Dict[str, str]]]):
+        self.sources = sources
+
+    def describe(self) -> Iterator:
+        """Имена метрик для регистрации: без describe реестр вызвал бы collect, а с ним и get_stats"""
+        for prefix, (_, fields) in self.sources.items():
+            for field, kind in fields.items():
+                family = CounterMetricFamily if kind == "counter" else GaugeMetricFamily
+                yield family(f"{prefix}_{field}", f"{prefix} {field}")
+
+    def collect(self) -> Iterator:
+        for prefix, (get_stats, fields) in self.sources.items():
+            try:
+                stats = get_stats()
+            except Exception as e:
+                logger.warning(f"Failed to collect {prefix} stats: {e}")
+                continue
+            for field, kind in fields.items():
+                value = stats.get(field)
+                if value is None:
+                    continue
+                name = f"{prefix}_{field}"
+                if kind == "counter":
+                    yield CounterMetricFamily(name, f"{prefix} {field}", value=value)
+                else:
+                    yield GaugeMetricFamily(name, f"{prefix} {field}", value=value)
+
+
+class _FunctionGauge:
+    """Метрика, значение которой считывается функцией в момент опроса /metrics"""
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def describe(self) -> Iterator:
+        yield GaugeMetricFamily(self.name, self.documentation)
+
+    def collect(self) -> Iterator:
+        try:
+            value = self.function()
+        except Exception as e:
+            logger.warning(f"Failed to collect {self.name}: {e}")
+            return
+        yield GaugeMetricFamily(self.name, self.documentation, value=value)
+
+
+class InferenceMetrics:
+    """
+    Метрики инференс-сервера в формате Prometheus (GET /metrics)
+    Задержка запросов, время генерации, время до первого фрагмента (с учетом очереди),
+    скорость генерации, размер пакета вариантов, очередь планировщика и объединение
+    одинаковых запросов
+    """
+
+    def __init__(self):
+        self.registry = REGISTRY
+        self.multiprocess_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+        self.stats_collectors = []
+
+        self.request_duration = Histogram(
+            "inference_http_request_duration_seconds", "HTTP request latency by route",
+            ["method", "route"], buckets=LATENCY_BUCKETS
+        )
+        self.requests = Counter(
+            "inference_http_requests", "HTTP requests by route and status", ["method", "route", "status"]
+        )
+        self.generation_duration = Histogram(
+            "inference_generation_seconds", "Model time per generation", buckets=LATENCY_BUCKETS
+        )
+        self.time_to_first_token = Histogram(
+            "inference_time_to_first_token_seconds", "Time from request arrival to the first generated chunk",
+            buckets=LATENCY_BUCKETS
+        )
+        self.tokens_per_second = Histogram(
+            "inference_tokens_per_second", "Generation speed (estimated tokens)", buckets=TOKENS_PER_SECOND_BUCKETS
+        )
+        self.generated_tokens = Counter(
+            "inference_generated_tokens", "Generated tokens (estimated from text length)"
+        )
+        self.batch_size = Histogram(
+            "inference_batch_size", "Candidates decoded together per generation", buckets=BATCH_SIZE_BUCKETS
+        )
+        self.generation_errors = Counter(
+            "inference_generation_errors", "Generations that failed in the engine"
+        )
+        self.event_loop_lag = Histogram(
+            "inference_event_loop_lag_seconds", "Event loop wake-up delay", buckets=LATENCY_BUCKETS
+        )
+
+    def gauge(self, name: str, documentation: str, function: Callable[[], float]):
+        """
+        Метрика, значение которой считывается функцией при опросе
+        Gauge.set_function в режиме PROMETHEUS_MULTIPROC_DIR не экспортируется, поэтому значение
+        отдает коллектор, как и статистику компонентов: это значение отвечающего процесса
+        """
+        self._register(_FunctionGauge(name, documentation, function))
+
+    def register_stats(self, sources: Dict[str, Tuple[Callable[[], dict], Dict[str, str]]]):
+        """Подключает статистику компонентов, считываемую при опросе (при нескольких процессах - отвечающего)"""
+        self._register(_StatsCollector(sources))
+
+    def _register(self, collector):
+        self.stats_collectors.append(collector)
+        self.registry.register(collector)
+
+    def instrument(self, events: Iterable[Tuple[Any, Any, str]], received_at: float,
+                   batch_size: int) -> Iterator[Tuple[Any, Any, str]]:
+        """
+        Пропускает события генерации (вариант, seed, фрагмент), измеряя их
+        Выполняется в потоке генерации; received_at - время прихода запроса (perf_counter)
+        """
+        started = time.perf_counter()
+        first = True
+        chars = 0
+        try:
+            for event in events:
+                if first:
+                    self.time_to_first_token.observe(time.perf_counter() - received_at)
+                    first = False
+                chars += len(event[2])
+                yield event
+        except Exception:
+            self.generation_errors.inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            tokens = chars // CHARS_PER_TOKEN
+            self.generation_duration.observe(elapsed)
+            self.generated_tokens.inc(tokens)
+            self.batch_size.observe(batch_size)
+            if elapsed > 0 and tokens:
+                self.tokens_per_second.observe(tokens / elapsed)
+
+    def render(self) -> Tuple[bytes, str]:
+        """Текст ответа /metrics и его Content-Type"""
+        if self.multiprocess_dir:
+            from prometheus_client import multiprocess
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            for collector in self.stats_collectors:
+                registry.register(collector)
+            return generate_latest(registry), CONTENT_TYPE_LATEST
+        return generate_latest(self.registry), CONTENT_TYPE_LATEST
+
+
+# Глобальный экземпляр метрик инференс-сервера
+metrics = InferenceMetrics()
@@ -1,20 +1,100 @@
 import os
 import sys
-from typing import Optional, Dict, Any
+import time
+import threading
+from typing import Optional, Dict, Any, Iterator, List
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+class ModelLoadCancelled(Exception):
+    """Загрузка прервана через cancel() (выключение сервера)"""
+
+
 class RustModelLoader:
     """
     Загрузчик модели с поддержкой Rust-оптимизации и fallback на Python
+    INFERENCE_ENGINE=simulated вместо модели подключает симулятор с настраиваемой
+    скоростью (simulated_engine) для нагрузочных тестов без GPU.
+    Создание загрузчика ничего не загружает: модель загружается и прогревается в load()
+    (сервер вызывает ее в фоне после запуска), ход загрузки - в get_status()
     """
     
     def __init__(self):
         self.rust_engine = None
         self.fallback_engine = None
-        self.use_rust = self._should_use_rust()
-        self._initialize_engines()
+        self.engine = os.getenv('INFERENCE_ENGINE', 'auto').lower()
+        self.use_rust = False
+        # Прогрев: MODEL_WARMUP_RUNS генераций по MODEL_WARMUP_TOKENS токенов (0 - без прогрева)
+        self.warmup_runs = int(os.getenv('MODEL_WARMUP_RUNS', '1'))
+        self.warmup_tokens = int(os.getenv('MODEL_WARMUP_TOKENS', '10'))
+        self.warmup_prompt = os.getenv('MODEL_WARMUP_PROMPT', 'Hello, world!')
+        # not_loaded -> loading -> warming_up -> ready | failed
+        self.state = "not_loaded"
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self.warmup_done = 0
+        self._cancelled = threading.Event()
+    
+    def load(self):
+        """
+        Загружает движок и прогревает его; выполняется в потоке
+        Ошибка загрузки пробрасывается (state "failed"). Ошибка прогрева пишется в лог, если
+        хотя бы один прогон прошел; если не прошел ни один - модель тоже считается не загруженной
+        """
+        started = time.perf_counter()
+        self.state = "loading"
+        try:
+            self.use_rust = self.engine != 'simulated' and self._should_use_rust()
+            self._initialize_engines()
+            self.timings["load_seconds"] = round(time.perf_counter() - started, 3)
+            
+            self.state = "warming_up"
+            warmup_started = time.perf_counter()
+            try:
+                for _ in range(self.warmup_runs):
+                    self._check_cancelled()
+                    result = self.generate(self.warmup_prompt, max_length=self.warmup_tokens)
+                    self.warmup_done += 1
+                    logger.info(f"Model warmup successful: {result[:50]}...")
+            except ModelLoadCancelled:
+                raise
+            except Exception as e:
+                if self.warmup_done == 0:
+                    raise RuntimeError(f"Model warmup failed: {e}") from e
+                logger.error(f"Model warmup failed: {e}")
+            self.timings["warmup_seconds"] = round(time.perf_counter() - warmup_started, 3)
+            self._check_cancelled()
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            raise
+        self.state = "ready"
+    
+    def cancel(self):
+        """
+        Просит прервать load(): проверка - перед каждым прогоном прогрева и перед переходом в ready
+        Начатую инициализацию движка или генерацию прервать нельзя: поток завершится после нее
+        """
+        self._cancelled.set()
+    
+    def _check_cancelled(self):
+        if self._cancelled.is_set():
+            raise ModelLoadCancelled("Model loading cancelled")
+    
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Ход загрузки для проверки готовности"""
+        return {
+            "state": self.state,
+            "engine": "rust" if self.use_rust else ("simulated" if self.engine == "simulated" else "python"),
+            "warmup_runs": f"{self.warmup_done}/{self.warmup_runs}",
+            "error": self.error,
+            **self.timings,
+        }
     
     def _should_use_rust(self) -> bool:
         """Определяет, использовать ли Rust-оптимизацию"""
@@ -37,7 +117,11 @@ class RustModelLoader:
     
     def _initialize_engines(self):
         """Инициализирует Rust и Python движки"""
-        if self.use_rust:
+        if self.engine == 'simulated':
+            # Симулятор занимает место Python-движка: все пути генерации работают через него
+            from local_inference.simulated_engine import SimulatedInferenceEngine
+            self.fallback_engine = SimulatedInferenceEngine()
+        elif self.use_rust:
             try:
                 import chatbot_inference
                 # Определяем архитектуру CUDA
@@ -88,6 +172,63 @@ class RustModelLoader:
         else:
             return self._generate_with_fallback(input_text, max_length)
     
+    def generate_stream(self, input_text: str, max_length: int = 100) -> Iterator[str]:
+        """
+        Генерация текста по частям; склеенные части совпадают с результатом generate
+        Сборка Rust-модуля без потоковой генерации отдает результат одной частью
+        """
+        if self.use_rust and self.rust_engine:
+            if hasattr(self.rust_engine, 'generate_stream'):
+                produced = False
+                try:
+                    for chunk in self.rust_engine.generate_stream(input_text, max_length):
+                        produced = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    logger.error(f"Rust engine failed: {e}")
+                    # Переключаемся на fallback; начатый поток не повторяется другим движком
+                    self.use_rust = False
+                    if produced:
+                        raise
+            else:
+                yield self.generate(input_text, max_length)
+                return
+        
+        if self.fallback_engine:
+            yield from self.fallback_engine.generate_stream(input_text, max_length)
+        else:
+            raise RuntimeError("No available inference engine")
+    
+    def generate_candidates(self, input_text: str, max_length: int, seeds: List[int]) -> List[str]:
+        """
+        Несколько вариантов ответа на один промпт, по одному на seed
+        Промпт обрабатывается (prefill) один раз для всех вариантов
+        """
+        if self.use_rust and self.rust_engine:
+            if not self.supports_seeds() and len(seeds) > 1:
+                raise ValueError("Rust engine build without generate_candidates cannot sample several candidates")
+            try:
+                if hasattr(self.rust_engine, 'generate_candidates'):
+                    return list(self.rust_engine.generate_candidates(input_text, max_length, seeds))
+                # Сборка Rust-модуля без generate_candidates не принимает seed: один вариант без него
+                return [self.rust_engine.generate(input_text, max_length)]
+            except Exception as e:
+                logger.error(f"Rust engine failed: {e}")
+                # Переключаемся на fallback
+                self.use_rust = False
+        
+        if self.fallback_engine:
+            return self.fallback_engine.generate_candidates(input_text, max_length, seeds)
+        else:
+            raise RuntimeError("No available inference engine")
+    
+    def supports_seeds(self) -> bool:
+        """Движок умеет генерировать варианты с заданными seed (нужно для n > 1)"""
+        if self.use_rust and self.rust_engine:
+            return hasattr(self.rust_engine, 'generate_candidates')
+        return True
+    
     def _generate_with_fallback(self, input_text: str, max_length: int) -> str:
         """Генерация с использованием fallback-движка"""
         if self.fallback_engine:
@@ -106,7 +247,7 @@ class RustModelLoader:
             return self.fallback_engine.is_cuda_available() if self.fallback_engine else False
 
 
-# Глобальный экземпляр для использования в других модулях
+# Глобальный экземпляр для использования в других модулях (модель загружается в load())
 model_loader = RustModelLoader()
 
 
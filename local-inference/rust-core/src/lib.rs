@@ -51,6 +51,24 @@ impl RustInferenceEngine {
         Ok(result)
     }
 
+    /// Несколько вариантов продолжения одного запроса: предобработка (prefill)
+    /// выполняется один раз, декодирование - для каждого seed отдельно
+    fn generate_candidates(&mut self, input_text: &str, max_length: usize, seeds: Vec<u64>) -> PyResult<Vec<String>> {
+        let processed_input = self.preprocessor.process(input_text)?;
+
+        let mut candidates = Vec::with_capacity(seeds.len());
+        for seed in seeds {
+            let candidate = if let Some(ref mut engine) = self.tensorrt_engine {
+                engine.sample(&processed_input, max_length, seed)?
+            } else {
+                self.network.sample(&processed_input, max_length, seed)?
+            };
+            candidates.push(candidate);
+        }
+
+        Ok(candidates)
+    }
+
     /// Проверить, поддерживается ли CUDA
     fn is_cuda_available(&self) -> PyResult<bool> {
         Ok(self.network.is_cuda_available()?)
@@ -26,6 +26,13 @@ impl NeuralNetwork {
         Ok(result)
     }
 
+    pub fn sample(&mut self, input: &str, max_length: usize, seed: u64) -> Result<String> {
+        // Декодирование по уже обработанному входу со своим seed сэмплирования
+        let result = format!("Rust Neural Network inference result for: {} (max_length: {}, device: {}, seed: {})", 
+                           input, max_length, self.device, seed);
+        Ok(result)
+    }
+
     pub fn is_cuda_available(&self) -> Result<bool> {
         Ok(self.device == "cuda")
     }
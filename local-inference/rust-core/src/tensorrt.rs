@@ -42,6 +42,16 @@ impl TensorRTInference {
         Ok(result)
     }
 
+    pub fn sample(&mut self, input: &str, max_length: usize, seed: u64) -> Result<String> {
+        // Декодирование по уже обработанному входу со своим seed сэмплирования
+        if !self.is_initialized {
+            return Err(anyhow::anyhow!("TensorRT engine not initialized"));
+        }
+
+        let result = format!("Rust TensorRT inference result for: {} (max_length: {}, seed: {})", input, max_length, seed);
+        Ok(result)
+    }
+
     fn check_cuda_availability() -> Result<bool> {
         // В реальной реализации проверяем доступность CUDA
         // через вызовы CUDA API
@@ -0,0 +1,202 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class AdmissionRejected(Exception):
+    """Запрос отклонен при постановке в очередь; retry_after - оценка, когда стоит повторить"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Дедлайн запроса истек до того, как он дошел до модели (при постановке в очередь или в ней)"""
+
+
+class _Ticket:
+    """Запрос в очереди планировщика"""
+
+    __slots__ = ("flow", "finish", "cost", "deadline", "future", "enqueued_at", "started_at", "cancelled")
+
+    def __init__(self, flow: Tuple[str, str], finish: float, cost: float, deadline: Optional[float]):
+        self.flow = flow
+        self.finish = finish
+        self.cost = cost
+        self.deadline = deadline
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.started_at = 0.0
+        self.cancelled = False
+
+
+def _parse_weights(value: str) -> Dict[str, float]:
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition(":")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+class FairScheduler:
+    """
+    Очередь запросов к модели со справедливым разделением между пользователями
+    Взвешенная справедливая очередь (self-clocked fair queuing): поток - пара
+    (пользователь, класс приоритета), тег завершения запроса = max(виртуальное время,
+    тег предыдущего запроса потока) + стоимость / вес класса; первым обслуживается
+    запрос с наименьшим тегом. Пачка длинных генераций одного пользователя не задерживает
+    остальных дольше их справедливой доли, а интерактивные запросы получают большую долю,
+    чем фоновые, не вытесняя их полностью.
+    При постановке в очередь оценивается ожидание (стоимость запросов впереди и
+    выполняющихся, умноженная на измеренное время единицы стоимости): если запрос
+    не успеет к своему дедлайну или очередь переполнена, он отклоняется сразу.
+    Запрос, дедлайн которого истек в очереди, снимается с нее и не доходит до модели
+    """
+
+    def __init__(self):
+        self.concurrency = int(os.getenv('INFERENCE_CONCURRENCY', '1'))
+        self.max_queue = int(os.getenv('SCHEDULER_MAX_QUEUE', '256'))
+        self.weights = _parse_weights(os.getenv('SCHEDULER_PRIORITY_WEIGHTS', 'interactive:8,background:1'))
+        # Начальная оценка времени единицы стоимости (токена); уточняется по выполненным запросам
+        self.seconds_per_unit = float(os.getenv('SCHEDULER_SECONDS_PER_TOKEN', '0.02'))
+
+        self.virtual_time = 0.0
+        self.last_finish: Dict[Tuple[str, str], float] = {}
+        self.queue: List[Tuple[float, int, _Ticket]] = []
+        self.queued = 0
+        self.sequence = 0
+        self.running: List[_Ticket] = []
+        self.stats = {
+            "admitted": 0,
+            "rejected_deadline": 0,
+            "rejected_queue_full": 0,
+            "expired": 0,
+            "completed": 0,
+            "queue_seconds": 0.0,
+        }
+
+    def predict_wait(self, finish: float = float("inf")) -> float:
+        """Оценка ожидания в очереди для запроса с тегом завершения finish"""
+        now = time.monotonic()
+        ahead = sum(ticket.cost for _, _, ticket in self.queue if not ticket.cancelled and ticket.finish <= finish)
+        remaining = sum(
+            max(0.0, ticket.cost * self.seconds_per_unit - (now - ticket.started_at)) for ticket in self.running
+        )
+        if len(self.running) < self.concurrency and not ahead:
+            return 0.0
+        return (ahead * self.seconds_per_unit + remaining) / self.concurrency
+
+    def check_admission(self, priority: str, cost: float, deadline: Optional[float]):
+        """
+        Отклоняет запрос (AdmissionRejected), если очередь полна или он не успеет к дедлайну;
+        запрос с уже истекшим дедлайном - DeadlineExceeded
+        """
+        if self.queued >= self.max_queue:
+            self.stats["rejected_queue_full"] += 1
+            raise AdmissionRejected("Inference queue is full", self.predict_wait())
+        if deadline is None:
+            return
+        if deadline <= time.time():
+            self.stats["expired"] += 1
+            raise DeadlineExceeded()
+        weight = self.weights.get(priority, 1.0)
+        # Запрос встанет не позже всех запросов с тегом меньше его собственного
+        wait = self.predict_wait(self.virtual_time + cost / weight)
+        if time.time() + wait + cost * self.seconds_per_unit > deadline:
+            self.stats["rejected_deadline"] += 1
+            raise AdmissionRejected("Predicted wait exceeds the request deadline", wait)
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, priority: str, cost: float,
+                   deadline: Optional[float] = None) -> AsyncIterator[None]:
+        """Ожидает своей очереди и занимает слот модели на время выполнения"""
+        ticket = self._enqueue(user_id, priority, cost, deadline)
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.cancelled() or not ticket.future.done():
+                ticket.cancelled = True
+                self.queued -= 1
+                if deadline is not None and time.time() >= deadline:
+                    # Клиент перестал ждать по дедлайну - работа снята с очереди как просроченная
+                    self.stats["expired"] += 1
+                raise
+            # Слот выдан одновременно с отменой - возвращаем его
+            self._release(ticket)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    def _enqueue(self, user_id: str, priority: str, cost: float, deadline: Optional[float]) -> _Ticket:
+        flow = (user_id, priority)
+        start = max(self.virtual_time, self.last_finish.get(flow, 0.0))
+        ticket = _Ticket(flow, start + cost / self.weights.get(priority, 1.0), cost, deadline)
+        self.last_finish[flow] = ticket.finish
+        self.sequence += 1
+        heapq.heappush(self.queue, (ticket.finish, self.sequence, ticket))
+        self.queued += 1
+        self.stats["admitted"] += 1
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self):
+        """Выдает освободившиеся слоты запросам с наименьшими тегами"""
+        while self.queue and len(self.running) < self.concurrency:
+            _, _, ticket = heapq.heappop(self.queue)
+            # Отмененный запрос: учет ведет его собственный обработчик отмены
+            if ticket.cancelled or ticket.future.cancelled():
+                continue
+            self.queued -= 1
+            if ticket.deadline is not None and time.time() >= ticket.deadline:
+                self.stats["expired"] += 1
+                ticket.future.set_exception(DeadlineExceeded())
+                continue
+            self.virtual_time = ticket.finish
+            ticket.started_at = time.monotonic()
+            self.stats["queue_seconds"] += ticket.started_at - ticket.enqueued_at
+            self.running.append(ticket)
+            ticket.future.set_result(None)
+        if not self.queue and len(self.last_finish) > 4 * self.max_queue:
+            # Потоки без запросов в очереди больше не влияют на теги
+            self.last_finish = {flow: finish for flow, finish in self.last_finish.items()
+                                if finish > self.virtual_time}
+
+    def _release(self, ticket: _Ticket):
+        self.running.remove(ticket)
+        elapsed = time.monotonic() - ticket.started_at
+        if ticket.cost > 0:
+            # Скользящее среднее времени единицы стоимости
+            self.seconds_per_unit += 0.2 * (elapsed / ticket.cost - self.seconds_per_unit)
+        self.stats["completed"] += 1
+        self._dispatch()
+
+    def get_stats(self) -> Dict[str, float]:
+        admitted = self.stats["admitted"]
+        return {
+            "concurrency": self.concurrency,
+            "running": len(self.running),
+            "queued": self.queued,
+            "flows": len({ticket.flow for _, _, ticket in self.queue if not ticket.cancelled}),
+            "predicted_wait": round(self.predict_wait(), 3),
+            "seconds_per_token": round(self.seconds_per_unit, 5),
+            "admitted": admitted,
+            "rejected_deadline": self.stats["rejected_deadline"],
+            "rejected_queue_full": self.stats["rejected_queue_full"],
+            "expired": self.stats["expired"],
+            "completed": self.stats["completed"],
+            "queue_wait_avg": round(self.stats["queue_seconds"] / admitted, 4) if admitted else 0.0,
+        }
+
+
+# Глобальный экземпляр планировщика запросов к модели
+scheduler = FairScheduler()
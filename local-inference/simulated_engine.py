@@ -0,0 +1,119 @@
+import os
+import time
+import random
+import threading
+from typing import Iterator, List
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Средняя длина токена в символах: длина промпта в токенах для модели prefill
+CHARS_PER_TOKEN = 4
+VOCABULARY = (
+    "модель запрос ответ данные время сервер очередь поток память контекст токен генерация "
+    "задача пример результат система параметр значение процесс сеть кэш пакет скорость"
+).split()
+
+
+class SimulatedEngineError(RuntimeError):
+    """Сбой, внесенный симулятором (SIM_ERROR_RATE)"""
+
+
+class SimulatedInferenceEngine:
+    """
+    Симулятор модели для нагрузочных и регрессионных тестов на машине без GPU
+    Текст детерминирован: зависит только от промпта, max_length, seed варианта и SIM_SEED.
+    Время как у настоящей модели: prefill пропорционален длине промпта
+    (SIM_PREFILL_BASE_MS + SIM_PREFILL_MS_PER_TOKEN на токен), затем max_length токенов
+    со скоростью SIM_TOKENS_PER_SECOND; варианты одного запроса декодируются пакетом,
+    то есть за то же время. Сбои (SIM_ERROR_RATE) и зависания на SIM_STALL_SECONDS
+    (SIM_STALL_RATE) вносятся в случайной точке генерации; их последовательность
+    задается SIM_SEED и воспроизводится между прогонами
+    """
+
+    def __init__(self):
+        self.tokens_per_second = float(os.getenv('SIM_TOKENS_PER_SECOND', '50'))
+        self.prefill_base = float(os.getenv('SIM_PREFILL_BASE_MS', '5')) / 1000
+        self.prefill_per_token = float(os.getenv('SIM_PREFILL_MS_PER_TOKEN', '0.5')) / 1000
+        self.error_rate = float(os.getenv('SIM_ERROR_RATE', '0'))
+        self.stall_rate = float(os.getenv('SIM_STALL_RATE', '0'))
+        self.stall_seconds = float(os.getenv('SIM_STALL_SECONDS', '5'))
+        self.seed = int(os.getenv('SIM_SEED', '0'))
+        # Генерации идут из потоков пула: розыгрыш сбоев - под блокировкой
+        self._faults = random.Random(self.seed)
+        self._lock = threading.Lock()
+        self.model_loaded = True
+        self.stats = {
+            "generations": 0,
+            "tokens": 0,
+            "errors": 0,
+            "stalls": 0,
+        }
+        logger.info(f"Simulated inference engine: {self.tokens_per_second} tokens/s, "
+                    f"error rate {self.error_rate}, stall rate {self.stall_rate}")
+
+    def _tokens(self, input_text: str, max_length: int, seed: int) -> List[str]:
+        rng = random.Random(f"{self.seed}:{seed}:{max_length}:{input_text}")
+        return [rng.choice(VOCABULARY) + " " for _ in range(max_length)]
+
+    def _plan_faults(self, max_length: int):
+        """(позиция сбоя, позиция зависания); None - нет"""
+        with self._lock:
+            error = self._faults.random() < self.error_rate
+            stall = self._faults.random() < self.stall_rate
+            error_at = self._faults.randrange(max_length + 1)
+            stall_at = self._faults.randrange(max_length + 1)
+        return (error_at if error else None), (stall_at if stall else None)
+
+    def _prefill(self, input_text: str):
+        time.sleep(self.prefill_base + len(input_text) / CHARS_PER_TOKEN * self.prefill_per_token)
+
+    def _decode(self, max_length: int) -> Iterator[int]:
+        """Номера токенов в темпе SIM_TOKENS_PER_SECOND с внесенными сбоями и зависаниями"""
+        error_at, stall_at = self._plan_faults(max_length)
+        self.stats["generations"] += 1
+        interval = 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        next_at = time.perf_counter()
+        for position in range(max_length + 1):
+            if position == stall_at:
+                self.stats["stalls"] += 1
+                time.sleep(self.stall_seconds)
+                next_at = time.perf_counter()
+            if position == error_at:
+                self.stats["errors"] += 1
+                raise SimulatedEngineError(f"Simulated engine failure after {position} tokens")
+            if position == max_length:
+                return
+            next_at += interval
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.stats["tokens"] += 1
+            yield position
+
+    def generate(self, input_text: str, max_length: int = 100) -> str:
+        return "".join(self.generate_stream(input_text, max_length))
+
+    def generate_stream(self, input_text: str, max_length: int = 100) -> Iterator[str]:
+        """Токены по одному в темпе модели; склеенные части совпадают с результатом generate"""
+        tokens = self._tokens(input_text, max_length, 0)
+        self._prefill(input_text)
+        for position in self._decode(max_length):
+            yield tokens[position]
+
+    def generate_candidates(self, input_text: str, max_length: int, seeds: List[int]) -> List[str]:
+        """Варианты по seed: один prefill и общий (пакетный) проход декодирования"""
+        self._prefill(input_text)
+        for _ in self._decode(max_length):
+            pass
+        return ["".join(self._tokens(input_text, max_length, seed)) for seed in seeds]
+
+    def get_performance_stats(self) -> dict:
+        return {
+            "engine": "simulated",
+            "tokens_per_second": self.tokens_per_second,
+            **self.stats,
+        }
+
+    def is_cuda_available(self) -> bool:
+        return False
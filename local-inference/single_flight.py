@@ -0,0 +1,198 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, AsyncContextManager, AsyncIterator, Callable, Dict, Hashable, Iterable, List, Optional
+
+from local_inference.scheduler import DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """
+    Одна выполняющаяся генерация и ее подписчики
+    Все события сохраняются, чтобы подключившийся позже подписчик получил поток с начала
+    """
+
+    __slots__ = ("key", "events", "done", "error", "waiters", "changed", "cancelled", "task", "started")
+
+    def __init__(self, key: Optional[Hashable]):
+        self.key = key
+        self.events: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+        # Заменяется новым при каждом событии: ожидающие просыпаются от set() старого
+        self.changed = asyncio.Event()
+        # Проверяется потоком генерации между событиями
+        self.cancelled = threading.Event()
+        self.task: Optional[asyncio.Task] = None
+        # Генерация получила модель (прошла gate)
+        self.started = False
+
+    def _notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def push(self, event: Any):
+        self.events.append(event)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов генерации
+    Запросы с одним ключом (промпт и все параметры сэмплирования) разделяют одну
+    генерацию, а ее события транслируются каждому подписчику. Генерация выполняется
+    в пуле потоков и не блокирует цикл событий (перед запуском она может ждать очереди
+    планировщика); подписчики считаются, и генерация отменяется, только когда
+    отключился последний из них. Подписчик с дедлайном перестает ждать в срок и получает
+    уже сгенерированную часть, а если генерация так и не получила модель - DeadlineExceeded;
+    если он был последним, генерация прерывается.
+    Завершенные генерации не кэшируются: ключ освобождается сразу по завершении
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv('INFERENCE_SINGLE_FLIGHT', 'true').lower() == 'true'
+        self.flights: Dict[Hashable, _Flight] = {}
+        self.stats = {
+            "started": 0,
+            "coalesced": 0,
+            "cancelled": 0,
+            "deadline_exceeded": 0,
+        }
+
+    def is_running(self, key: Optional[Hashable]) -> bool:
+        """Выполняется ли генерация, к которой присоединится запрос с этим ключом"""
+        return self.enabled and key is not None and key in self.flights
+
+    async def stream(self, key: Optional[Hashable], produce: Callable[[], Iterable[Any]],
+                     gate: Optional[Callable[[], AsyncContextManager]] = None,
+                     deadline: Optional[float] = None) -> AsyncIterator[Any]:
+        """
+        События генерации produce (синхронный итератор, выполняется в потоке)
+        key=None - запрос не объединяется с другими (недетерминированное сэмплирование);
+        gate - контекст, в котором выполняется генерация (слот планировщика), один на общую генерацию;
+        deadline (unix time) - после него поток событий обрывается без ошибки, если генерация
+        уже началась, и с DeadlineExceeded, если она еще ждет в очереди
+        """
+        if not self.enabled:
+            key = None
+        flight = self.flights.get(key) if key is not None else None
+        if flight is None:
+            flight = self._start(key, produce, gate)
+        else:
+            self.stats["coalesced"] += 1
+        flight.waiters += 1
+
+        try:
+            position = 0
+            while True:
+                changed = flight.changed
+                while position < len(flight.events):
+                    yield flight.events[position]
+                    position += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                if deadline is None:
+                    await changed.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stats["deadline_exceeded"] += 1
+                    if not flight.started:
+                        raise DeadlineExceeded()
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.done:
+                self._cancel(flight)
+
+    async def collect(self, key: Optional[Hashable], produce: Callable[[], Iterable[Any]],
+                      gate: Optional[Callable[[], AsyncContextManager]] = None,
+                      deadline: Optional[float] = None) -> List[Any]:
+        """Все события генерации (до дедлайна) одним списком"""
+        return [event async for event in self.stream(key, produce, gate, deadline)]
+
+    def _start(self, key: Optional[Hashable], produce: Callable[[], Iterable[Any]],
+               gate: Optional[Callable[[], AsyncContextManager]]) -> _Flight:
+        flight = _Flight(key)
+        if key is not None:
+            self.flights[key] = flight
+        self.stats["started"] += 1
+        flight.task = asyncio.ensure_future(self._run(flight, produce, gate))
+        return flight
+
+    async def _run(self, flight: _Flight, produce: Callable[[], Iterable[Any]],
+                   gate: Optional[Callable[[], AsyncContextManager]]):
+        error = None
+        try:
+            if gate is None:
+                await self._execute(flight, produce)
+            else:
+                async with gate():
+                    await self._execute(flight, produce)
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            error = e
+        if not flight.cancelled.is_set():
+            self._release(flight)
+            flight.finish(error)
+
+    async def _execute(self, flight: _Flight, produce: Callable[[], Iterable[Any]]):
+        flight.started = True
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, self._produce, flight, produce, loop)
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Поток остановится на следующем событии; до этого он занимает модель (и слот)
+            await future
+            raise
+
+    @staticmethod
+    def _produce(flight: _Flight, produce: Callable[[], Iterable[Any]], loop: asyncio.AbstractEventLoop):
+        """Выполняется в потоке пула: передает события генерации в цикл событий"""
+        for event in produce():
+            if flight.cancelled.is_set():
+                return
+            loop.call_soon_threadsafe(flight.push, event)
+
+    def _cancel(self, flight: _Flight):
+        """Последний подписчик отключился: генерация снимается с очереди или прерывается на следующем событии"""
+        flight.cancelled.set()
+        flight.task.cancel()
+        self._release(flight)
+        flight.finish(asyncio.CancelledError())
+        self.stats["cancelled"] += 1
+        logger.info(f"Generation cancelled after the last waiter left ({len(flight.events)} events produced)")
+
+    def _release(self, flight: _Flight):
+        if flight.key is not None and self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self.flights),
+            "waiters": sum(flight.waiters for flight in self.flights.values()),
+            **self.stats,
+        }
+
+
+# Глобальный экземпляр объединителя запросов генерации
+single_flight = SingleFlight()
@@ -0,0 +1,12 @@
+import sys
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Модули инференс-сервера импортируют друг друга как пакет local_inference, а каталог
+# называется local-inference: для тестов пакет регистрируется по пути каталога
+if "local_inference" not in sys.modules:
+    package = types.ModuleType("local_inference")
+    package.__path__ = [str(ROOT / "local-inference")]
+    sys.modules["local_inference"] = package
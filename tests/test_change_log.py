@@ -0,0 +1,53 @@
+import pickle
+
+from backend.services.change_log import ChangeLog
+from backend.services.chat_store import ChatStore, MessageRole
+
+
+def make_store():
+    store = ChatStore()
+    log = ChangeLog()
+    store.subscribe(log.on_store_change)
+    return store, log
+
+
+def test_changes_after_cursor():
+    store, log = make_store()
+    user = store.create_user("user", "hash")
+    session_id = store.create_session(user["id"], "s")["id"]
+    cursor, full_resync, _, _ = log.get_changes(user["id"], None)
+    assert full_resync
+
+    message = store.add_message(session_id, MessageRole.USER, "привет")
+    store.update_session(session_id, title="новое")
+    cursor, full_resync, changes, has_more = log.get_changes(user["id"], cursor)
+    assert not full_resync and not has_more
+    # Повторное изменение сессии заменяет ее прежнюю запись
+    assert [(entity, op, obj_id) for _, entity, op, obj_id in changes] == [
+        ("message", "create", message.id), ("session", "update", session_id)]
+
+    _, full_resync, changes, _ = log.get_changes(user["id"], cursor)
+    assert not full_resync and changes == []
+
+
+def test_cursor_from_before_restart_forces_full_resync():
+    store, log = make_store()
+    user = store.create_user("user", "hash")
+    session_id = store.create_session(user["id"], "s")["id"]
+    store.add_message(session_id, MessageRole.USER, "до перезапуска")
+    cursor, _, _, _ = log.get_changes(user["id"], None)
+
+    # Перезапуск: данные восстановлены из снимка, журнал изменений начинается заново
+    state = store.capture_state()
+    state["messages"] = [message.as_tuple() for message in state["messages"]]
+    restored, restarted_log = make_store()
+    restored.load_state(pickle.loads(pickle.dumps(state)))
+    for i in range(5):
+        restored.add_message(session_id, MessageRole.USER, f"после перезапуска {i}")
+    new_cursor, full_resync, changes, _ = restarted_log.get_changes(user["id"], cursor)
+    assert full_resync and changes == []
+
+    # С новым курсором дельты снова работают
+    restored.add_message(session_id, MessageRole.USER, "еще одно")
+    _, full_resync, changes, _ = restarted_log.get_changes(user["id"], new_cursor)
+    assert not full_resync and len(changes) == 1
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from backend.services.chat_journal import ChatJournal, SEGMENT_PREFIX, SNAPSHOT_PREFIX
+from backend.services.chat_store import ChatStore, MessageRole
+
+
+@pytest.fixture
+def open_journal(tmp_path, monkeypatch):
+    """Открывает журнал в tmp_path поверх нового хранилища, как при запуске шлюза"""
+    monkeypatch.setenv("CHAT_JOURNAL_SNAPSHOT_EVERY", str(10 ** 9))
+    journals = []
+
+    def open_journal(policy="never"):
+        monkeypatch.setenv("CHAT_JOURNAL_FSYNC", policy)
+        store = ChatStore()
+        journal = ChatJournal(str(tmp_path))
+        journal.open(store)
+        store.subscribe(journal.on_store_change)
+        journals.append(journal)
+        return store, journal
+
+    yield open_journal
+    for journal in journals:
+        journal.close()
+
+
+def texts(store, session_id):
+    return [message.text for message in store.get_messages(session_id, 100)[0]]
+
+
+def test_recovers_snapshot_and_tail(open_journal, tmp_path):
+    store, journal = open_journal()
+    user = store.create_user("user", "hash")
+    session_id = store.create_session(user["id"], "s")["id"]
+    for i in range(3):
+        store.add_message(session_id, MessageRole.USER, f"до снимка {i}")
+    assert journal.snapshot()
+    journal.snapshot_thread.join()
+    store.add_message(session_id, MessageRole.ASSISTANT, "после снимка")
+    store.update_session(session_id, "новое название")
+    public_ids = [store.public_id(message.id) for message in store.get_messages(session_id, 100)[0]]
+    journal.close()
+
+    restored, restored_journal = open_journal()
+    assert list(tmp_path.glob(f"{SNAPSHOT_PREFIX}*"))
+    assert restored_journal.lsn == journal.lsn
+    assert texts(restored, session_id) == ["до снимка 0", "до снимка 1", "до снимка 2", "после снимка"]
+    assert restored.sessions[session_id]["title"] == "новое название"
+    # Публичные id сообщений переживают перезапуск
+    assert [restored.public_id(message.id) for message in restored.get_messages(session_id, 100)[0]] == public_ids
+
+
+def test_ignores_torn_last_record(open_journal, tmp_path):
+    store, journal = open_journal()
+    user = store.create_user("user", "hash")
+    session_id = store.create_session(user["id"], "s")["id"]
+    store.add_message(session_id, MessageRole.USER, "целая запись")
+    journal.close()
+    segment = sorted(tmp_path.glob(f"{SEGMENT_PREFIX}*"))[-1]
+    with open(segment, "ab") as f:
+        f.write(f'[{journal.lsn + 1},"c","message",'.encode("utf-8"))
+
+    restored, restored_journal = open_journal()
+    assert restored_journal.lsn == journal.lsn
+    assert texts(restored, session_id) == ["целая запись"]
+
+    # Запись продолжается в новом сегменте, и следующий перезапуск видит ее
+    restored.add_message(session_id, MessageRole.ASSISTANT, "после сбоя")
+    restored_journal.close()
+    again, _ = open_journal()
+    assert texts(again, session_id) == ["целая запись", "после сбоя"]
+
+
+def test_replays_branches_edits_and_deletes(open_journal):
+    store, journal = open_journal()
+    user = store.create_user("user", "hash")
+    session_id = store.create_session(user["id"], "s")["id"]
+    first = store.add_message(session_id, MessageRole.USER, "вопрос")
+    answer = store.add_message(session_id, MessageRole.ASSISTANT, "ответ")
+    store.add_message(session_id, MessageRole.USER, "уточнение")
+    # Вторая ветка после первого сообщения, правка и удаление в ней, возврат на первую ветку
+    other = store.add_message(session_id, MessageRole.ASSISTANT, "другой ответ", parent_id=first.id)
+    doomed = store.add_message(session_id, MessageRole.USER, "лишнее")
+    store.update_message(other, "другой ответ (правка)")
+    store.delete_branch(doomed)
+    store.switch_branch(answer)
+    store.update_message(answer, "ответ (правка)")
+    expected = texts(store, session_id)
+    journal.close()
+
+    restored, _ = open_journal()
+    assert texts(restored, session_id) == expected == ["вопрос", "ответ (правка)", "уточнение"]
+    siblings = restored.get_siblings(restored.messages[answer.id])
+    assert [message.text for message in siblings] == ["ответ (правка)", "другой ответ (правка)"]
+    assert doomed.id not in restored.messages
+    restored.switch_branch(restored.messages[other.id])
+    assert texts(restored, session_id) == ["вопрос", "другой ответ (правка)"]
+
+
+def test_always_policy_waits_for_fsync(open_journal):
+    store, journal = open_journal("always")
+    user = store.create_user("user", "hash")
+    session_id = store.create_session(user["id"], "s")["id"]
+
+    async def mutate():
+        store.add_message(session_id, MessageRole.USER, "подтвержденное")
+        await journal.wait_durable()
+        return journal.durable_lsn
+
+    assert asyncio.run(mutate()) == journal.lsn
+    assert journal.waiters == []
@@ -0,0 +1,87 @@
+import pickle
+
+from backend.services.chat_store import ChatStore, MessageRole, _ArchivedIds
+from backend.services.search_index import SearchIndex
+from backend.services.session_archive import SessionArchive
+
+
+def make_store(tmp_path, sessions=3, messages=50):
+    store = ChatStore()
+    archive = SessionArchive(str(tmp_path))
+    archive.idle_seconds = 0
+    store.attach_archive(archive)
+    user = store.create_user("user", "hash")
+    session_ids = []
+    for i in range(sessions):
+        session_id = store.create_session(user["id"], f"s{i}")["id"]
+        session_ids.append(session_id)
+        for k in range(messages):
+            store.add_message(session_id, MessageRole.USER, f"сообщение {i} {k}")
+    return store, session_ids
+
+
+def test_archived_ids_are_ranges(tmp_path):
+    store, session_ids = make_store(tmp_path)
+    assert store.archive_idle() == 3
+
+    # Одна сессия - один диапазон, а не запись на каждое сообщение
+    assert len(store.archived_messages) == 150
+    assert len(store.archived_messages.starts) == 3
+    for session_id in session_ids:
+        assert store.get_messages(session_id, 100)[0]
+    assert len(store.archived_messages) == 0
+
+
+def test_archived_ids_lookup_and_prune():
+    ranges = _ArchivedIds()
+    ranges.add("a", [1, 2, 3, 7, 8])
+    ranges.add("b", [4, 5, 6, 9])
+    assert [ranges.get(i) for i in range(11)] == [None, "a", "a", "a", "b", "b", "b", "a", "a", "b", None]
+
+    ranges.stale = 4
+    ranges.prune({"a": 5})
+    assert len(ranges) == 5 and ranges.get(5) is None and ranges.get(8) == "a"
+
+
+def test_snapshot_keeps_ranges(tmp_path):
+    store, session_ids = make_store(tmp_path)
+    store.archive_idle()
+    state = pickle.loads(pickle.dumps(store.capture_state()))
+
+    restored = ChatStore()
+    restored.attach_archive(store.archive)
+    restored.load_state(state)
+    assert restored.archived_messages.capture() == store.archived_messages.capture()
+    assert restored.get_messages(session_ids[1], 100)[0][0].text == "сообщение 1 0"
+
+
+def test_archive_skipped_when_session_changes_during_write(tmp_path):
+    store, session_ids = make_store(tmp_path, sessions=1)
+    job = store.prepare_archive(session_ids[0])
+    store.write_archive(job)
+    store.add_message(session_ids[0], MessageRole.ASSISTANT, "ответ")
+
+    assert not store.commit_archive(job)
+    assert session_ids[0] in store.session_messages
+    assert store.count_messages(session_ids[0]) == 51
+
+
+def test_reloaded_session_is_indexed(tmp_path):
+    store, session_ids = make_store(tmp_path)
+    store.archive_idle()
+    state = pickle.loads(pickle.dumps(store.capture_state()))
+
+    # После перезапуска индексируются только резидентные сессии, архивные - при загрузке
+    restored = ChatStore()
+    restored.attach_archive(store.archive)
+    restored.load_state(state)
+    index = SearchIndex()
+    restored.on_reload = index.add_messages
+    user_id = restored.sessions[session_ids[1]]["user_id"]
+    assert index.search(user_id, "сообщение")[0] == 0
+
+    restored.get_messages(session_ids[1], 100)
+    assert index.search(user_id, "сообщение")[0] == 50
+    total, ranked = index.search(user_id, "17")
+    assert total == 1
+    assert restored.messages[ranked[0][0]].text == "сообщение 1 17"
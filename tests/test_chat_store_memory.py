@@ -0,0 +1,75 @@
+import tracemalloc
+from datetime import datetime
+from uuid import UUID, uuid4
+
+from backend.services.chat_store import ChatStore, MessageRole
+
+MESSAGES = 20000
+PER_SESSION = 100
+# Потолок накладных расходов на сообщение (байт) с запасом над текущими ~245
+MAX_BYTES_PER_MESSAGE = 300
+# Содержимое у всех сообщений общее, поэтому в замер попадают только накладные расходы
+CONTENT = "Общий текст сообщения, не входящий в замер"
+
+
+def measure(build) -> int:
+    """Число байт, выделенных build() и оставшихся в живых"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    keep = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del keep
+    return size
+
+
+def build_dicts(count: int, session_ids: list):
+    """Прежнее представление: словарь на сообщение в общем словаре по UUID"""
+    messages_db = {}
+    per_session = count // len(session_ids)
+    for i in range(count):
+        msg_id = str(uuid4())
+        messages_db[msg_id] = {
+            "id": msg_id,
+            "session_id": session_ids[i // per_session],
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": CONTENT,
+            "created_at": datetime.now().isoformat()
+        }
+    return messages_db
+
+
+def build_records(count: int, store: ChatStore, session_ids: list):
+    per_session = count // len(session_ids)
+    for i in range(count):
+        role = MessageRole.USER if i % 2 == 0 else MessageRole.ASSISTANT
+        store.add_message(session_ids[i // per_session], role, CONTENT)
+    return store
+
+
+def test_message_record_memory():
+    store = ChatStore()
+    session_ids = [store.create_session("user", "memory")["id"] for _ in range(MESSAGES // PER_SESSION)]
+
+    dict_bytes = measure(lambda: build_dicts(MESSAGES, session_ids))
+    record_bytes = measure(lambda: build_records(MESSAGES, store, session_ids))
+
+    assert record_bytes / MESSAGES < MAX_BYTES_PER_MESSAGE
+    assert record_bytes < dict_bytes * 0.8
+
+
+def test_public_ids_are_not_sequential():
+    store = ChatStore()
+    values = [UUID(store.public_id(msg_id)).int & ((1 << 62) - 1) for msg_id in range(1, 101)]
+    differences = {b - a for a, b in zip(values, values[1:])}
+    assert len(differences) > 90
+
+    for msg_id in (1, 2, 12345, (1 << 62) - 1):
+        assert store.parse_id(store.public_id(msg_id)) == msg_id
+
+
+def test_foreign_ids_are_rejected():
+    store, other = ChatStore(), ChatStore()
+    assert store.parse_id(other.public_id(1)) is None
+    assert store.parse_id("not-a-uuid") is None
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from backend.services.idempotency import IdempotencyConflict, IdempotencyStore
+
+
+def test_retry_replays_result_and_conflicting_retry_is_rejected():
+    store = IdempotencyStore()
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        return {"id": len(calls)}
+
+    async def scenario():
+        first = await store.run("user", "key", "a", handler)
+        again = await store.run("user", "key", "a", handler)
+        # Ключи действуют в пределах пользователя
+        other_user = await store.run("other", "key", "a", handler)
+        with pytest.raises(IdempotencyConflict):
+            await store.run("user", "key", "b", handler)
+        return first, again, other_user
+
+    first, again, other_user = asyncio.run(scenario())
+    assert first == ({"id": 1}, False)
+    assert again == ({"id": 1}, True)
+    assert other_user == ({"id": 2}, False)
+    assert store.get_stats()["conflicts"] == 1
+
+
+def test_concurrent_retry_attaches_to_running_request():
+    store = IdempotencyStore()
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def scenario():
+        return await asyncio.gather(
+            store.run("user", "key", "a", handler),
+            store.run("user", "key", "a", handler),
+        )
+
+    assert asyncio.run(scenario()) == [(1, False), (1, True)]
+    assert store.get_stats()["attached"] == 1
+
+
+def test_failed_request_is_not_remembered():
+    store = IdempotencyStore()
+    attempts = []
+
+    async def handler():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("inference unavailable")
+        return "ok"
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await store.run("user", "key", "a", handler)
+        return await store.run("user", "key", "a", handler)
+
+    assert asyncio.run(scenario()) == ("ok", False)
+    assert len(attempts) == 2
+
+
+def test_cancelled_original_is_executed_again_by_waiting_retry():
+    store = IdempotencyStore()
+    started = []
+
+    async def handler():
+        started.append(1)
+        await asyncio.sleep(0.05 if len(started) == 1 else 0)
+        return len(started)
+
+    async def scenario():
+        original = asyncio.ensure_future(store.run("user", "key", "a", handler))
+        await asyncio.sleep(0)
+        retry = asyncio.ensure_future(store.run("user", "key", "a", handler))
+        await asyncio.sleep(0.01)
+        original.cancel()
+        return await retry
+
+    assert asyncio.run(scenario()) == (2, False)
+
+
+def test_results_expire_and_are_evicted(monkeypatch):
+    monkeypatch.setenv("IDEMPOTENCY_MAX_KEYS", "2")
+    store = IdempotencyStore()
+
+    async def handler():
+        return "ok"
+
+    async def scenario():
+        for key in ("a", "b", "c"):
+            await store.run("user", key, "f", handler)
+
+    asyncio.run(scenario())
+    assert list(store.entries) == [("user", "b"), ("user", "c")]
+    assert store.get_stats()["evicted"] == 1
+
+    for entry in store.entries.values():
+        entry.expires_at = 0
+    store._expire()
+    assert store.get_stats()["keys"] == 0
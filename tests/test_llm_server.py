@@ -0,0 +1,75 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    """
+    Инференс-сервер на резервном движке, один на модуль: остановка сервера отменяет
+    загрузку модели до конца процесса. Рабочие каталоги - во временной папке
+    """
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp("inference"))
+        patch.setenv("RUST_ACCELERATION", "false")
+        from local_inference import llm_server
+
+        with TestClient(llm_server.app) as client:
+            while not llm_server.model_loader.is_ready():
+                time.sleep(0.05)
+            client.engine = llm_server.model_loader.fallback_engine
+            yield client
+
+
+@pytest.fixture
+def client(server, monkeypatch):
+    from local_inference.scheduler import scheduler
+
+    # Оценка длительности занижена, чтобы запросы проходили допуск и истекали уже в очереди
+    monkeypatch.setattr(scheduler, "seconds_per_unit", 1e-6)
+    return server
+
+
+def slow_engine(client, monkeypatch, delay):
+    generate_stream = client.engine.generate_stream
+
+    def slow(prompt, max_length):
+        # Модель занята delay секунд до первого фрагмента
+        time.sleep(delay)
+        yield from generate_stream(prompt, max_length)
+
+    monkeypatch.setattr(client.engine, "generate_stream", slow)
+
+
+def test_expired_budget_returns_504(client):
+    headers = {"X-Request-Budget-Ms": "0"}
+    response = client.post("/generate", json={"prompt": "x", "max_length": 5}, headers=headers)
+    assert response.status_code == 504
+
+    response = client.post("/generate/stream", json={"prompt": "x", "max_length": 5}, headers=headers)
+    assert response.status_code == 504
+
+
+def test_deadline_in_queue_is_not_an_empty_success(client, monkeypatch):
+    slow_engine(client, monkeypatch, 0.4)
+
+    def post(args):
+        delay, budget, path, prompt = args
+        time.sleep(delay)
+        return client.post(path, json={"prompt": prompt, "max_length": 5},
+                           headers={"X-Request-Budget-Ms": str(budget)})
+
+    # Первый запрос занимает модель, второй истекает, так и не дождавшись ее
+    with ThreadPoolExecutor(2) as pool:
+        busy, queued = pool.map(post, [(0, 3000, "/generate", "first"), (0.05, 150, "/generate", "second")])
+    assert busy.status_code == 200 and busy.json()["generated_text"]
+    assert queued.status_code == 504, queued.text
+
+    with ThreadPoolExecutor(2) as pool:
+        busy, queued = pool.map(post, [(0, 3000, "/generate", "third"), (0.05, 150, "/generate/stream", "fourth")])
+    assert busy.status_code == 200
+    events = [json.loads(line) for line in queued.text.splitlines()]
+    assert events == [{"error": "Request deadline exceeded before generation started", "status": "expired"}]
@@ -0,0 +1,42 @@
+import ast
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Шлюз и инференс-сервер разворачиваются отдельно и не импортируют пакеты друг друга,
+# поэтому общие модули наблюдаемости продублированы; код копий должен совпадать
+# (различаются только докстроки, комментарии и аннотации с именем класса метрик)
+COPIES = [
+    ("tracing.py", None),
+    ("loop_monitor.py", None),
+    ("metrics.py", {"MetricsMiddleware", "_StatsCollector"}),
+]
+
+
+class _StripDocs(ast.NodeTransformer):
+    def generic_visit(self, node):
+        node = super().generic_visit(node)
+        body = getattr(node, "body", None)
+        if (isinstance(body, list) and body and isinstance(body[0], ast.Expr)
+                and isinstance(body[0].value, ast.Constant) and isinstance(body[0].value.value, str)):
+            node.body = body[1:] or [ast.Pass()]
+        return node
+
+    def visit_arg(self, node):
+        node.annotation = None
+        return node
+
+
+def _code(path: Path, names):
+    tree = _StripDocs().visit(ast.parse(path.read_text(encoding="utf-8")))
+    if names is not None:
+        tree.body = [node for node in tree.body if getattr(node, "name", None) in names]
+    return ast.dump(tree)
+
+
+@pytest.mark.parametrize("filename, names", COPIES)
+def test_gateway_and_inference_copies_match(filename, names):
+    assert _code(ROOT / "backend" / "services" / filename, names) == \
+        _code(ROOT / "local-inference" / filename, names)
@@ -0,0 +1,72 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from backend.services import rate_limiter as rate_limiter_module
+from backend.services.rate_limiter import RateLimiter, RateLimitExceeded
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемые часы ограничителя: корзины пополняются только при сдвиге now[0]"""
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter_module, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.delenv("RATE_LIMIT_REDIS_URL", raising=False)
+    monkeypatch.setenv("RATE_LIMIT_USER_REQUESTS_PER_MINUTE", "60")
+    monkeypatch.setenv("RATE_LIMIT_USER_REQUEST_BURST", "2")
+    monkeypatch.setenv("RATE_LIMIT_USER_TOKENS_PER_MINUTE", "600")
+    monkeypatch.setenv("RATE_LIMIT_IP_REQUESTS_PER_MINUTE", "600")
+    monkeypatch.setenv("RATE_LIMIT_IP_REQUEST_BURST", "100")
+    monkeypatch.setenv("RATE_LIMIT_IP_TOKENS_PER_MINUTE", "60000")
+    return RateLimiter()
+
+
+def acquire(limiter, user_id="user", ip="10.0.0.1", tokens=1):
+    asyncio.run(limiter.acquire(user_id, ip, tokens))
+
+
+def test_burst_then_refill(limiter, clock):
+    acquire(limiter)
+    acquire(limiter)
+    with pytest.raises(RateLimitExceeded) as error:
+        acquire(limiter)
+    # Корзина запросов пополняется на единицу в секунду
+    assert error.value.retry_after == pytest.approx(1.0)
+
+    clock[0] += 1.0
+    acquire(limiter)
+    # Другой пользователь с того же IP ограничивается своей корзиной
+    acquire(limiter, user_id="other")
+
+
+def test_rejected_request_charges_nothing(limiter, clock):
+    acquire(limiter, tokens=500)
+    # Токенов не хватает: запрос отклонен, и единица из корзины запросов не списана
+    with pytest.raises(RateLimitExceeded) as error:
+        acquire(limiter, tokens=200)
+    assert error.value.retry_after == pytest.approx(10.0)
+    acquire(limiter, tokens=50)
+    assert limiter.get_stats()["limited"] == 1 and limiter.get_stats()["allowed"] == 2
+
+
+def test_full_buckets_are_dropped(limiter, clock):
+    acquire(limiter)
+    assert limiter.get_stats()["local_buckets"] == 4
+
+    # Через минуту все корзины снова полны и при следующей проверке удаляются
+    clock[0] += 60
+    acquire(limiter, user_id=None, ip="10.0.0.2")
+    assert set(limiter.buckets) == {("ip_requests", "10.0.0.2"), ("ip_tokens", "10.0.0.2")}
+
+
+def test_disabled_limiter_allows_everything(limiter, clock):
+    limiter.enabled = False
+    for _ in range(10):
+        acquire(limiter, tokens=10 ** 6)
+    assert limiter.get_stats()["allowed"] == 0
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import pytest
+
+from local_inference.scheduler import AdmissionRejected, DeadlineExceeded, FairScheduler
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    monkeypatch.setenv("INFERENCE_CONCURRENCY", "1")
+    monkeypatch.setenv("SCHEDULER_PRIORITY_WEIGHTS", "interactive:8,background:1")
+    return FairScheduler()
+
+
+def run_queued(scheduler, jobs, hold=0.0):
+    """
+    Ставит jobs (имя, пользователь, приоритет, стоимость, дедлайн) в очередь, пока модель
+    занята, освобождает ее через hold секунд; возвращает порядок выполнения и ошибки
+    """
+    order = []
+
+    async def job(name, user_id, priority, cost, deadline):
+        async with scheduler.slot(user_id, priority, cost, deadline):
+            order.append(name)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def blocker():
+            async with scheduler.slot("blocker", "interactive", 1):
+                await release.wait()
+
+        running = asyncio.ensure_future(blocker())
+        await asyncio.sleep(0)
+        tasks = [asyncio.ensure_future(job(*spec)) for spec in jobs]
+        await asyncio.sleep(hold)
+        release.set()
+        return await asyncio.gather(running, *tasks, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    errors = {spec[0]: type(result) for spec, result in zip(jobs, results[1:]) if result is not None}
+    return order, errors
+
+
+def test_flows_share_the_model_fairly(scheduler):
+    order, errors = run_queued(scheduler, [
+        ("a1", "alice", "interactive", 10, None),
+        ("a2", "alice", "interactive", 10, None),
+        ("a3", "alice", "interactive", 10, None),
+        ("b1", "bob", "interactive", 10, None),
+    ])
+    # Пачка запросов одного пользователя не задерживает другого
+    assert order == ["a1", "b1", "a2", "a3"]
+    assert errors == {}
+
+
+def test_interactive_weight_beats_background(scheduler):
+    jobs = [("bg1", "alice", "background", 10, None), ("bg2", "alice", "background", 10, None)]
+    jobs += [(f"i{i}", "bob", "interactive", 10, None) for i in range(1, 10)]
+    order, _ = run_queued(scheduler, jobs)
+    # Интерактивный класс получает в 8 раз большую долю, но фоновый не вытесняется полностью
+    assert order == ["i1", "i2", "i3", "i4", "i5", "i6", "i7", "bg1", "i8", "i9", "bg2"]
+
+
+def test_expired_request_is_dropped_from_queue(scheduler):
+    deadline = time.time() + 0.02
+    order, errors = run_queued(scheduler, [
+        ("late", "alice", "interactive", 10, deadline),
+        ("patient", "bob", "interactive", 10, None),
+    ], hold=0.05)
+    assert order == ["patient"]
+    assert errors == {"late": DeadlineExceeded}
+    assert scheduler.get_stats()["expired"] == 1
+    assert scheduler.get_stats()["queued"] == 0
+
+
+def test_admission_checks_deadline_and_queue(scheduler):
+    with pytest.raises(DeadlineExceeded):
+        scheduler.check_admission("interactive", 10, time.time() - 1)
+
+    scheduler.seconds_per_unit = 1.0
+    with pytest.raises(AdmissionRejected):
+        scheduler.check_admission("interactive", 10, time.time() + 5)
+    scheduler.check_admission("interactive", 10, time.time() + 60)
+
+    scheduler.max_queue = 0
+    with pytest.raises(AdmissionRejected):
+        scheduler.check_admission("interactive", 10, None)
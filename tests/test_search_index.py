@@ -0,0 +1,122 @@
+import math
+import random
+from collections import Counter
+
+from backend.services.search_index import BM25_B, BM25_K1, SearchIndex, _UserIndex, tokenize
+
+
+def brute_force(texts, terms, top):
+    """Эталон: BM25 по всем документам без индекса"""
+    counts = {message_id: Counter(tokenize(text)) for message_id, text in texts.items()}
+    avg_length = sum(sum(c.values()) for c in counts.values()) / len(counts) or 1.0
+    terms = list(dict.fromkeys(terms))
+    df = {term: sum(1 for c in counts.values() if term in c) for term in terms}
+    scores = {}
+    for message_id, c in counts.items():
+        if not any(term in c for term in terms):
+            continue
+        norm = BM25_K1 * (1 - BM25_B) + BM25_K1 * BM25_B / avg_length * sum(c.values())
+        score = 0.0
+        for term in terms:
+            if c[term]:
+                idf = math.log(1 + (len(counts) - df[term] + 0.5) / (df[term] + 0.5))
+                score += idf * c[term] * (BM25_K1 + 1) / (c[term] + norm)
+        scores[message_id] = score
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top]
+    return len(scores), ranked
+
+
+def test_compact_drops_removed_documents():
+    index = _UserIndex()
+    for message_id in range(3000):
+        index.add(message_id, f"сообщение номер {message_id} общий текст")
+    for message_id in range(2500):
+        index.remove(message_id)
+
+    # Удаление только помечает документы; компактификацию запускает владелец индекса
+    assert index.needs_compaction
+    index.compact()
+    assert index.deleted == 0
+    assert len(index.doc_keys) == index.live_docs == 500
+    assert len(index.postings["общий"].docs) == index.postings["общий"].df == 500
+    assert index.search(["2999"], 5)[1][0][0] == 2999
+
+
+def test_search_after_compaction():
+    index = SearchIndex()
+    for message_id in range(3000):
+        index.add_message("user", message_id, f"message {message_id} common")
+    for message_id in range(2500):
+        index.remove_message("user", message_id)
+
+    total, ranked = index.search("user", "common", limit=5)
+    assert total == 500
+    assert all(message_id >= 2500 for message_id, _ in ranked)
+
+    total, ranked = index.search("user", "2999")
+    assert [message_id for message_id, _ in ranked] == [2999]
+
+
+def test_removed_documents_do_not_count_in_df():
+    index = _UserIndex()
+    index.add(1, "rare word")
+    index.add(2, "rare other")
+    index.add(3, "plain text")
+    _, before = index.search(["rare"], 10)
+    index.remove(2)
+    _, after = index.search(["rare"], 10)
+
+    fresh = _UserIndex()
+    fresh.add(1, "rare word")
+    fresh.add(3, "plain text")
+    _, expected = fresh.search(["rare"], 10)
+    assert after == expected
+    assert before[0][1] != after[0][1]
+
+
+def test_top_k_matches_full_ranking():
+    rng = random.Random(7)
+    words = [f"w{i}" for i in range(40)]
+    texts = {}
+    index = _UserIndex()
+    for message_id in range(2000):
+        # Частые и редкие слова, документы разной длины
+        text = " ".join(rng.choice(words[:5] if rng.random() < 0.5 else words) for _ in range(rng.randint(1, 30)))
+        texts[message_id] = text
+        index.add(message_id, text)
+    for message_id in rng.sample(range(2000), 300):
+        index.remove(message_id)
+        del texts[message_id]
+
+    for query in (["w0"], ["w0", "w1"], ["w3", "w37"], ["w39"], ["w1", "w1", "w20", "w30"]):
+        total, ranked = index.search(query, 10)
+        expected_total, expected = brute_force(texts, query, 10)
+        assert total == expected_total
+        assert [round(score, 9) for _, score in ranked] == [round(score, 9) for _, score in expected]
+
+
+def test_background_compaction_keeps_concurrent_changes():
+    index = SearchIndex()
+    index.on_compaction_needed = lambda: None
+    for message_id in range(3000):
+        index.add_message("user", message_id, f"message {message_id} common")
+    for message_id in range(2000):
+        index.remove_message("user", message_id)
+    assert index.take_compaction_due() == ["user"]
+
+    job = index.prepare_compaction("user")
+    # Изменения, сделанные, пока перестройка идет в потоке
+    index.add_message("user", 5000, "message fresh common")
+    index.remove_message("user", 2500)
+    index.update_message("user", 2600, "edited text")
+    job.run()
+    index.commit_compaction(job)
+
+    user_index = index.user_indexes["user"]
+    assert user_index.compaction_log is None
+    assert user_index.live_docs == 1000
+    assert index.search("user", "fresh")[1][0][0] == 5000
+    assert index.search("user", "edited")[1][0][0] == 2600
+    total, ranked = index.search("user", "common", limit=2000)
+    assert total == 999
+    assert {message_id for message_id, _ in ranked} == (set(range(2000, 3000)) - {2500, 2600}) | {5000}
@@ -0,0 +1,106 @@
+import asyncio
+import contextlib
+import threading
+import time
+
+import pytest
+
+from local_inference.scheduler import DeadlineExceeded
+from local_inference.single_flight import SingleFlight
+
+
+def make_produce(count, step=0.01):
+    """Генерация из count событий; state считает выданные события и отмечает завершение"""
+    state = {"produced": 0, "finished": threading.Event()}
+
+    def produce():
+        for i in range(count):
+            time.sleep(step)
+            state["produced"] += 1
+            yield i
+        state["finished"].set()
+
+    return produce, state
+
+
+def test_identical_requests_share_one_generation():
+    flight = SingleFlight()
+    produce, state = make_produce(5)
+
+    async def scenario():
+        return await asyncio.gather(flight.collect("key", produce), flight.collect("key", produce))
+
+    assert asyncio.run(scenario()) == [[0, 1, 2, 3, 4], [0, 1, 2, 3, 4]]
+    assert state["produced"] == 5
+    stats = flight.get_stats()
+    assert stats["started"] == 1 and stats["coalesced"] == 1 and stats["in_flight"] == 0
+
+
+def test_generation_survives_while_a_waiter_remains():
+    flight = SingleFlight()
+    produce, state = make_produce(10)
+
+    async def scenario():
+        leaving = asyncio.ensure_future(flight.collect("key", produce))
+        staying = asyncio.ensure_future(flight.collect("key", produce))
+        await asyncio.sleep(0.03)
+        leaving.cancel()
+        return await staying
+
+    # Отключение одного подписчика не прерывает общую генерацию
+    assert asyncio.run(scenario()) == list(range(10))
+    assert flight.get_stats()["cancelled"] == 0
+
+
+def test_generation_is_cancelled_when_last_waiter_leaves():
+    flight = SingleFlight()
+    produce, state = make_produce(100)
+
+    async def scenario():
+        waiters = [asyncio.ensure_future(flight.collect("key", produce)) for _ in range(2)]
+        await asyncio.sleep(0.03)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        assert flight.get_stats()["in_flight"] == 0
+        # Поток генерации останавливается на следующем событии
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+    assert flight.get_stats()["cancelled"] == 1
+    assert not state["finished"].is_set() and state["produced"] < 100
+
+
+def test_deadline_while_queued_raises():
+    flight = SingleFlight()
+    produce, state = make_produce(3)
+
+    async def scenario():
+        opened = asyncio.Event()
+
+        @contextlib.asynccontextmanager
+        async def gate():
+            # Модель занята другим запросом, пока не откроется opened
+            await opened.wait()
+            yield
+
+        with pytest.raises(DeadlineExceeded):
+            await flight.collect("key", produce, gate, deadline=time.time() + 0.02)
+
+    asyncio.run(scenario())
+    stats = flight.get_stats()
+    assert stats["deadline_exceeded"] == 1 and stats["cancelled"] == 1
+    assert state["produced"] == 0
+
+
+def test_deadline_after_start_returns_partial_stream():
+    flight = SingleFlight()
+    produce, state = make_produce(100)
+
+    async def scenario():
+        return await flight.collect("key", produce, deadline=time.time() + 0.05)
+
+    events = asyncio.run(scenario())
+    # Подписчик получает уже сгенерированную часть без ошибки
+    assert 0 < len(events) < 100 and events == list(range(len(events)))
+    assert flight.get_stats()["deadline_exceeded"] == 1